@@ -0,0 +1,247 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import numpy as np
+
+from benchmarks.synthetic_data import generate_collections, in_memory_db
+
+# run from betting_module/ as `python -m benchmarks.pipeline_benchmark`, so the processing modules import
+#  the same way they do for processing.py. they're imported in main, once the backend is picked
+
+
+def percentile_ms(timings, q):
+    return float(np.percentile(timings, q) * 1000) if len(timings) else float("nan")
+
+
+# times fn(*args) for every args in calls, then reruns up to alloc_calls of them under tracemalloc
+def run_benchmark(name, fn, calls, alloc_calls, unit="maps"):
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for args in calls:
+            call_start = time.perf_counter()
+            fn(*args)
+            timings.append(time.perf_counter() - call_start)
+        total = time.perf_counter() - start
+
+        peaks = []
+        tracemalloc.start()
+        for args in calls[:alloc_calls]:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn(*args)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+    return {
+        "name": name,
+        "unit": unit,
+        "calls": len(calls),
+        "total_s": total,
+        "per_s": len(calls) / total if total else float("nan"),
+        "p50_ms": percentile_ms(timings, 50),
+        "p90_ms": percentile_ms(timings, 90),
+        "p99_ms": percentile_ms(timings, 99),
+        "peak_kib_p50": float(np.median(peaks) / 1024) if peaks else float("nan"),
+        "peak_kib_max": float(np.max(peaks) / 1024) if peaks else float("nan"),
+    }
+
+
+def print_results(results):
+    print(
+        f"{'benchmark':<44}{'calls':>7}{'per s':>10}{'p50 ms':>9}{'p90 ms':>9}"
+        + f"{'p99 ms':>9}{'peak KiB':>10}{'max KiB':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['name']:<44}{result['calls']:>7}{result['per_s']:>10.1f}"
+            + f"{result['p50_ms']:>9.2f}{result['p90_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+            + f"{result['peak_kib_p50']:>10.1f}{result['peak_kib_max']:>10.1f}"
+        )
+
+
+# benchmarks whose p50 latency grew by more than tolerance over the baseline run
+def find_regressions(results, baseline, tolerance):
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(result["name"])
+        if baseline_result == None:
+            continue
+        ratio = result["p50_ms"] / baseline_result["p50_ms"]
+        if ratio > 1 + tolerance:
+            regressions.append((result["name"], baseline_result["p50_ms"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the feature pipeline on synthetic maps, or on the configured Mongo database"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["fixtures", "mongo"],
+        default="fixtures",
+        help="fixtures exports synthetic collections into a temporary snapshot, mongo reads MONGODB_URI",
+    )
+    parser.add_argument(
+        "--maps", type=int, default=4000, help="synthetic maps to generate"
+    )
+    parser.add_argument("--teams", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--targets", type=int, default=300, help="newest maps to build data points for"
+    )
+    parser.add_argument(
+        "--alloc-calls",
+        type=int,
+        default=50,
+        help="calls per benchmark rerun under tracemalloc",
+    )
+    parser.add_argument("--json", help="writes the results to this file")
+    parser.add_argument(
+        "--baseline", help="results file of an earlier run to compare to"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="slowdown in p50 latency over the baseline reported as a regression",
+    )
+    args = parser.parse_args()
+
+    snapshot_folder = None
+    if args.backend == "fixtures":
+        from snapshot import export_snapshot
+
+        snapshot_folder = tempfile.mkdtemp(prefix="benchmark-snapshot-")
+        collections = generate_collections(args.maps, args.teams, args.seed)
+        with contextlib.redirect_stderr(io.StringIO()):
+            export_snapshot(in_memory_db(collections), snapshot_folder)
+        os.environ["DATA_BACKEND"] = "snapshot"
+        os.environ["SNAPSHOT_FOLDER"] = snapshot_folder
+
+    try:
+        import processing_helper
+        from performance_store import PerformanceStore
+        from sliding_window import SlidingWindowFeatureBuilder
+        from learning_helper import process_frame
+        from feature_schema import feature_schema
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            performance_store = PerformanceStore.load()
+        targets = list(
+            processing_helper.maps.aggregate(
+                [{"$sort": {"hltvId": -1}}, {"$limit": args.targets}]
+                + processing_helper.slice_lookup_aggregation
+            )
+        )
+        targets = [target for target in targets if len(target["match"]) != 0]
+        targets.sort(key=lambda target: target["match"][0]["date"])
+        print(
+            f"{len(performance_store)} maps in the store, {len(targets)} target maps ({args.backend})"
+        )
+
+        def data_point(curr_map, use_vectorized_stats):
+            processing_helper.use_vectorized_stats = use_vectorized_stats
+            np.random.seed(curr_map["hltvId"])
+            return processing_helper.generate_data_point(
+                curr_map, performance_store=performance_store
+            )
+
+        # the stats kernels are timed on the exact arguments generate_data_point passes them
+        stats_calls = []
+        vectorized_stats = processing_helper.generate_round_rating_stats_vectorized
+
+        def record_stats_call(*call_args, **call_kwargs):
+            stats_calls.append(call_args)
+            return vectorized_stats(*call_args, **call_kwargs)
+
+        processing_helper.generate_round_rating_stats_vectorized = record_stats_call
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_points = [data_point(target, True) for target in targets]
+        processing_helper.generate_round_rating_stats_vectorized = vectorized_stats
+        data_points = [w for w in data_points if w != None]
+
+        target_calls = [(target,) for target in targets]
+        window_builder = SlidingWindowFeatureBuilder(performance_store)
+        frame = feature_schema.frame(data_points)
+        results = [
+            run_benchmark(
+                "generate_data_point (store, vectorized)",
+                lambda curr_map: data_point(curr_map, True),
+                target_calls,
+                args.alloc_calls,
+            ),
+            run_benchmark(
+                "generate_data_point (store, list-based)",
+                lambda curr_map: data_point(curr_map, False),
+                target_calls,
+                args.alloc_calls,
+            ),
+            # the window only moves forward, so this has to be the builder's only pass over the targets
+            run_benchmark(
+                "generate_data_point (sliding window)",
+                lambda curr_map: processing_helper.generate_data_point(
+                    curr_map, window_builder=window_builder
+                ),
+                target_calls,
+                0,
+            ),
+            run_benchmark(
+                "generate_round_rating_stats",
+                processing_helper.generate_round_rating_stats,
+                stats_calls,
+                args.alloc_calls,
+            ),
+            run_benchmark(
+                "generate_round_rating_stats_vectorized",
+                vectorized_stats,
+                stats_calls,
+                args.alloc_calls,
+            ),
+            run_benchmark(
+                f"process_frame ({len(frame.index)} rows)",
+                process_frame,
+                [(frame,)] * 20,
+                5,
+                unit="frames",
+            ),
+        ]
+    finally:
+        if snapshot_folder != None:
+            shutil.rmtree(snapshot_folder, ignore_errors=True)
+
+    print_results(results)
+
+    output = {
+        "backend": args.backend,
+        "maps": args.maps,
+        "teams": args.teams,
+        "seed": args.seed,
+        "targets": len(targets),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for name, baseline_p50_ms, ratio in regressions:
+            print(
+                f"Regression: {name} p50 is {ratio:.2f}x the baseline {baseline_p50_ms:.2f}ms"
+            )
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+
+# run from betting_module/ as `python -m benchmarks.query_plan_benchmark`. lists every query shape the modules
+#  issue against Mongo, checks the indexes they assume exist (creating missing ones with --create), then
+#  explains and times each shape on MONGODB_URI (or --uri, e.g. a local mongod), flagging plans that scan a
+#  collection or sort in memory. sample values for the shapes are read from the newest documents
+
+# collection -> keys of the indexes the query shapes below assume
+required_indexes = {
+    "maps": [[("players", 1), ("date", -1)], [("matchId", 1)], [("hltvId", 1)]],
+    "matches": [[("hltvId", 1)]],
+    "events": [[("hltvId", 1)]],
+    "players": [[("hltvId", 1)]],
+    "unplayedmatches": [[("hltvId", 1)], [("played", 1), ("date", -1)]],
+    "wagers": [[("wagerId", 1)], [("creationDate", -1)]],
+}
+
+# newest map ids the shapes sending many ids are built from, few enough that the stream page's lookups and
+#  sort can be timed
+sample_id_count = 4096
+
+
+# one kind of query a module sends. build(samples) returns it for the sample documents, as a find
+#  {"filter", "sort", "limit", "projection"} or an aggregation {"pipeline"} (with "batch_size" only its first
+#  batch is timed). shapes whose samples aren't in the database are skipped. expected_flags are plan flags the shape can't avoid, reported without failing the check
+class QueryShape:
+    def __init__(
+        self, name, collection, issued_by, build, samples=[], expected_flags=[]
+    ):
+        self.name = name
+        self.collection = collection
+        self.issued_by = issued_by
+        self.build = build
+        self.samples = samples
+        self.expected_flags = expected_flags
+
+
+def newest(db, collection_name, query={}):
+    return db[collection_name].find_one(query, sort=[("$natural", -1)])
+
+
+# the newest map with players and a date, its match, the newest map ids, an unplayed match and a wager
+def collect_samples(db):
+    sample_map = newest(
+        db, "maps", {"date": {"$ne": None}, "players.0": {"$exists": True}}
+    )
+    map_ids = [
+        m["hltvId"]
+        for m in db.maps.find({}, {"hltvId": 1, "_id": 0})
+        .sort("hltvId", -1)
+        .limit(sample_id_count)
+    ]
+    return {
+        "map": sample_map,
+        "match": db.matches.find_one({"hltvId": sample_map["matchId"]})
+        if sample_map != None
+        else None,
+        "map_ids": map_ids if len(map_ids) != 0 else None,
+        "unplayed_match": newest(db, "unplayedmatches"),
+        "wager": newest(db, "wagers"),
+    }
+
+
+# the pending filter of a run resumed with every other stretch of map_ids processed, which splits the rest
+#  into the most ranges pending_filter sends before falling back to their bounds
+def pending_sample_filter(map_ids):
+    from checkpoint import ProcessedIds, max_pending_ranges
+
+    map_ids = np.sort(np.array(map_ids, dtype=np.int64))
+    done_ids = ProcessedIds()
+    for stretch in np.array_split(map_ids, 2 * max_pending_ranges)[::2]:
+        done_ids.add(stretch)
+    return done_ids.pending_filter(map_ids)
+
+
+def query_shapes():
+    from processing_helper import (
+        history_pipeline,
+        lookup_aggregation,
+        slice_lookup_aggregation,
+        date_order_pipeline,
+        map_batch_size,
+    )
+
+    return [
+        QueryShape(
+            "map history",
+            "maps",
+            "processing_helper.fetch_performances",
+            lambda samples: {
+                "pipeline": history_pipeline(
+                    samples["map"]["players"], samples["map"]["date"]
+                )
+            },
+            ["map"],
+        ),
+        QueryShape(
+            "map with lookups by match",
+            "maps",
+            "processing.predict_map",
+            lambda samples: {
+                "pipeline": [{"$match": {"matchId": samples["map"]["matchId"]}}]
+                + lookup_aggregation
+            },
+            ["map"],
+        ),
+        QueryShape(
+            "map page",
+            "maps",
+            "processing_helper.stream_maps",
+            lambda samples: {
+                "pipeline": [
+                    {
+                        "$match": {
+                            "hltvId": {
+                                "$in": list(
+                                    range(
+                                        samples["map"]["hltvId"] - map_batch_size + 1,
+                                        samples["map"]["hltvId"] + 1,
+                                    )
+                                )
+                            }
+                        }
+                    },
+                    {"$sort": {"hltvId": -1}},
+                ]
+                + slice_lookup_aggregation
+            },
+            ["map"],
+        ),
+        QueryShape(
+            "map batch",
+            "maps",
+            "processing_pool.process_map_batch",
+            lambda samples: {
+                "pipeline": [
+                    {"$match": {"hltvId": {"$in": [samples["map"]["hltvId"]]}}}
+                ]
+                + slice_lookup_aggregation
+            },
+            ["map"],
+        ),
+        QueryShape(
+            "map ids",
+            "maps",
+            "processing.main",
+            lambda samples: {
+                "filter": {},
+                "projection": {"hltvId": 1, "_id": 0},
+                "sort": [("hltvId", 1)],
+            },
+        ),
+        # past a watermark sample_id_count maps back
+        QueryShape(
+            "new map ids",
+            "maps",
+            "processing.main (--incremental)",
+            lambda samples: {
+                "filter": {"hltvId": {"$gt": samples["map_ids"][-1]}},
+                "projection": {"hltvId": 1, "_id": 0},
+                "sort": [("hltvId", 1)],
+            },
+            ["map_ids"],
+        ),
+        # a run resumed with the pending maps split into max_pending_ranges id ranges. the sort is on the
+        #  looked up match date, after the server has looked up every pending map
+        QueryShape(
+            "stream page",
+            "maps",
+            "processing.main (--mode stream)",
+            lambda samples: {
+                "pipeline": date_order_pipeline(
+                    pending_sample_filter(samples["map_ids"])
+                ),
+                "batch_size": map_batch_size,
+            },
+            ["map_ids"],
+            ["in-memory $sort"],
+        ),
+        # a page of the frame's ids in date order, which are spread over the id range rather than contiguous
+        QueryShape(
+            "recomputed map page",
+            "maps",
+            "feature_families.recompute_families",
+            lambda samples: {
+                "pipeline": [
+                    {
+                        "$match": {
+                            "hltvId": {
+                                "$in": samples["map_ids"][
+                                    :: max(len(samples["map_ids"]) // map_batch_size, 1)
+                                ][:map_batch_size]
+                            }
+                        }
+                    },
+                    {"$sort": {"hltvId": -1}},
+                ]
+                + slice_lookup_aggregation
+            },
+            ["map_ids"],
+        ),
+        QueryShape(
+            "maps by match",
+            "maps",
+            "services.map_service.maps_to_examine",
+            lambda samples: {"filter": {"matchId": samples["map"]["matchId"]}},
+            ["map"],
+        ),
+        QueryShape(
+            "birth years",
+            "players",
+            "metadata_cache.get_birth_years",
+            lambda samples: {
+                "filter": {"hltvId": {"$in": samples["map"]["players"]}},
+                "projection": {"hltvId": 1, "birthYear": 1, "_id": 0},
+            },
+            ["map"],
+        ),
+        QueryShape(
+            "event",
+            "events",
+            "metadata_cache.get_event_stats",
+            lambda samples: {
+                "filter": {"hltvId": samples["match"].get("eventId")},
+                "limit": 1,
+            },
+            ["match"],
+        ),
+        QueryShape(
+            "unplayed match by id",
+            "unplayedmatches",
+            "services.unplayedmatch_service",
+            lambda samples: {
+                "filter": {"hltvId": samples["unplayed_match"]["hltvId"]},
+                "limit": 1,
+            },
+            ["unplayed_match"],
+        ),
+        # the service sorts after its lookups, this is the part of it that needs the index
+        QueryShape(
+            "unplayed matches",
+            "unplayedmatches",
+            "services.unplayedmatch_service.get_all_unplayed_matches",
+            lambda samples: {
+                "filter": {"played": {"$ne": True}},
+                "sort": [("date", -1)],
+            },
+        ),
+        QueryShape(
+            "played unplayed matches",
+            "unplayedmatches",
+            "services.map_service.maps_to_examine",
+            lambda samples: {"filter": {"played": True}, "sort": [("date", -1)]},
+        ),
+        QueryShape(
+            "wager by id",
+            "wagers",
+            "services.wager_service",
+            lambda samples: {
+                "filter": {"wagerId": samples["wager"]["wagerId"]},
+                "limit": 1,
+            },
+            ["wager"],
+        ),
+        QueryShape(
+            "finished wagers",
+            "wagers",
+            "services.wager_service.get_all_finished_wagers",
+            lambda samples: {
+                "filter": {
+                    "$and": [
+                        {"result": {"$ne": None}},
+                        {"result": {"$ne": "UNFINISHED"}},
+                    ]
+                },
+                "sort": [("creationDate", -1)],
+            },
+        ),
+    ]
+
+
+def normalize_keys(keys):
+    return [
+        (field, direction if isinstance(direction, str) else int(direction))
+        for field, direction in keys
+    ]
+
+
+# an index serves keys if they're a prefix of its keys, in the same or the reversed direction
+def has_index(index_information, keys):
+    reversed_keys = [(field, -1 * direction) for field, direction in keys]
+    for index in index_information.values():
+        prefix = normalize_keys(index["key"])[: len(keys)]
+        if prefix == keys or prefix == reversed_keys:
+            return True
+    return False
+
+
+def check_indexes(db, create):
+    results = []
+    for collection_name, key_lists in required_indexes.items():
+        index_information = db[collection_name].index_information()
+        for keys in key_lists:
+            status = "ok"
+            if not has_index(index_information, keys):
+                status = "missing"
+                if create:
+                    db[collection_name].create_index(keys)
+                    status = "created"
+            results.append(
+                {
+                    "collection": collection_name,
+                    "keys": ", ".join(
+                        f"{field}: {direction}" for field, direction in keys
+                    ),
+                    "status": status,
+                }
+            )
+    return results
+
+
+def explain_command(collection_name, query):
+    if "pipeline" in query:
+        return {
+            "aggregate": collection_name,
+            "pipeline": query["pipeline"],
+            "cursor": {},
+        }
+    command = {"find": collection_name, "filter": query["filter"]}
+    if "sort" in query:
+        command["sort"] = dict(query["sort"])
+    if "limit" in query:
+        command["limit"] = query["limit"]
+    if "projection" in query:
+        command["projection"] = query["projection"]
+    return command
+
+
+# what's wrong with the winning plans of an explain result: collection scans, blocking sorts, and lookups
+#  into a collection that isn't indexed on the foreign field
+def plan_flags(explain):
+    flags = []
+
+    def walk(node):
+        if isinstance(node, list):
+            for value in node:
+                walk(value)
+            return
+        if not isinstance(node, dict):
+            return
+        stage = node.get("stage")
+        if stage == "COLLSCAN":
+            flags.append("COLLSCAN")
+        elif stage == "SORT":
+            flags.append("in-memory SORT")
+        # a $sort the server couldn't push down into the query runs as its own stage
+        elif isinstance(node.get("$sort"), dict) and "sortKey" in node["$sort"]:
+            flags.append("in-memory $sort")
+        elif stage == "EQ_LOOKUP" and node.get("strategy") != "IndexedLoopJoin":
+            flags.append(
+                f"$lookup from {node.get('foreignCollection')} without an index ({node.get('strategy')})"
+            )
+        if "$lookup" in node and node.get("collectionScans", 0) > 0:
+            flags.append(
+                f"$lookup from {node['$lookup'].get('from')} scans the collection"
+            )
+        for key, value in node.items():
+            if key in ["rejectedPlans", "allPlansExecution"]:
+                continue
+            walk(value)
+
+    walk(explain)
+    return sorted(set(flags))
+
+
+# keys and documents examined by the winning plan and its lookups, and documents returned by the plan
+def execution_totals(explain):
+    totals = {"keys_examined": 0, "docs_examined": 0, "returned": None}
+
+    def walk(node):
+        if isinstance(node, list):
+            for value in node:
+                walk(value)
+        elif isinstance(node, dict):
+            # the cursor's execution stats come before the lookup stages, which report their own totals
+            if "totalDocsExamined" in node:
+                totals["keys_examined"] += node.get("totalKeysExamined", 0)
+                totals["docs_examined"] += node["totalDocsExamined"]
+                if totals["returned"] == None:
+                    totals["returned"] = node.get("nReturned")
+            for key, value in node.items():
+                if key in ["rejectedPlans", "allPlansExecution"]:
+                    continue
+                walk(value)
+
+    walk(explain)
+    return totals
+
+
+def run_query(collection, query):
+    if "batch_size" in query:
+        with collection.aggregate(
+            query["pipeline"], allowDiskUse=True, batchSize=query["batch_size"]
+        ) as cursor:
+            return list(itertools.islice(cursor, query["batch_size"]))
+    if "pipeline" in query:
+        return list(collection.aggregate(query["pipeline"], allowDiskUse=True))
+    return list(
+        collection.find(
+            query["filter"],
+            query.get("projection"),
+            sort=query.get("sort"),
+            limit=query.get("limit", 0),
+        )
+    )
+
+
+def benchmark_shape(db, shape, samples, runs):
+    result = {
+        "name": shape.name,
+        "collection": shape.collection,
+        "issued_by": shape.issued_by,
+    }
+    missing_samples = [name for name in shape.samples if samples[name] == None]
+    if len(missing_samples) != 0:
+        result["skipped"] = "no sample " + ", ".join(missing_samples)
+        return result
+    query = shape.build(samples)
+    explain = db.command(
+        "explain",
+        explain_command(shape.collection, query),
+        verbosity="executionStats",
+    )
+    result["flags"] = plan_flags(explain)
+    result["expected_flags"] = [
+        flag for flag in result["flags"] if flag in shape.expected_flags
+    ]
+    result |= execution_totals(explain)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_query(db[shape.collection], query)
+        timings.append(time.perf_counter() - start)
+    result["median_ms"] = float(np.median(timings) * 1000)
+    result["max_ms"] = float(np.max(timings) * 1000)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checks the indexes the Mongo queries assume, then explains and times every query shape"
+    )
+    parser.add_argument(
+        "--uri", help="database to check instead of MONGODB_URI, e.g. a local mongod"
+    )
+    parser.add_argument(
+        "--create", action="store_true", help="creates the indexes that are missing"
+    )
+    parser.add_argument("--runs", type=int, default=5, help="timed runs per shape")
+    parser.add_argument("--json", help="writes the results to this file")
+    args = parser.parse_args()
+
+    if args.uri:
+        os.environ["MONGODB_URI"] = args.uri
+    from database import get_mongo_db
+
+    db = get_mongo_db()
+
+    index_results = check_indexes(db, args.create)
+    print(f"{'collection':<18}{'index':<32}status")
+    for index_result in index_results:
+        print(
+            f"{index_result['collection']:<18}{index_result['keys']:<32}{index_result['status']}"
+        )
+
+    samples = collect_samples(db)
+    shape_results = [
+        benchmark_shape(db, shape, samples, args.runs) for shape in query_shapes()
+    ]
+    print()
+    print(
+        f"{'query shape':<28}{'collection':<18}{'median ms':>10}{'max ms':>9}"
+        + f"{'keys':>9}{'docs':>9}{'returned':>10}  flags"
+    )
+    for shape_result in shape_results:
+        if "skipped" in shape_result:
+            print(
+                f"{shape_result['name']:<28}{shape_result['collection']:<18}  skipped: {shape_result['skipped']}"
+            )
+            continue
+        print(
+            f"{shape_result['name']:<28}{shape_result['collection']:<18}"
+            + f"{shape_result['median_ms']:>10.2f}{shape_result['max_ms']:>9.2f}"
+            + f"{shape_result['keys_examined']:>9}{shape_result['docs_examined']:>9}"
+            + f"{str(shape_result['returned']):>10}  "
+            + (
+                "; ".join(
+                    flag
+                    + (" (expected)" if flag in shape_result["expected_flags"] else "")
+                    for flag in shape_result["flags"]
+                )
+                or "-"
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"indexes": index_results, "query_shapes": shape_results},
+                f,
+                indent=2,
+                default=str,
+            )
+
+    missing = [
+        index_result
+        for index_result in index_results
+        if index_result["status"] == "missing"
+    ]
+    flagged = [
+        shape_result
+        for shape_result in shape_results
+        if len(shape_result.get("flags", []))
+        != len(shape_result.get("expected_flags", []))
+    ]
+    if len(missing) != 0 or len(flagged) != 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# run from betting_module/ as `python -m benchmarks.startup_benchmark`. each entry point is imported in a
+#  fresh interpreter, which is what `python <entry point>.py` pays before it does anything. MONGODB_URI
+#  points at an address nothing listens on, so a module that still queries on import fails or stalls here
+
+# entry point module -> cold import target in seconds
+startup_targets = {
+    "processing": 1.5,
+    "predicting": 1.5,
+    "compare_predicting": 1.5,
+    "learning_helper": 1.0,
+    "processing_helper": 1.0,
+}
+
+# modules none of the entry points should load until they're used
+deferred_modules = ["tensorflow", "pymongo"]
+
+# dependencies of the betting and prediction side that a machine only running the feature pipeline may not
+#  have. an entry point that can't import one of them is skipped, any other failure to import fails the run
+optional_dependencies = [
+    "tensorflow",
+    "sklearn",
+    "jellyfish",
+    "dateparser",
+    "selenium",
+    "undetected_chromedriver",
+    "webdriver_manager",
+    "gspread",
+    "googleapiclient",
+    "google_auth_oauthlib",
+]
+
+probe = """
+import sys, json, time
+start = time.perf_counter()
+try:
+    import {module}
+except ModuleNotFoundError as e:
+    if e.name == None or e.name.split(".")[0] not in {optional_dependencies!r}:
+        raise
+    print(json.dumps({{"missing": e.name}}))
+    sys.exit(0)
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "loaded": [name for name in {deferred_modules!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_startup(module, runs):
+    env = dict(
+        os.environ, MONGODB_URI="mongodb://127.0.0.1:9/?serverSelectionTimeoutMS=500"
+    )
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                probe.format(
+                    module=module,
+                    deferred_modules=deferred_modules,
+                    optional_dependencies=optional_dependencies,
+                ),
+            ],
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        if result.returncode != 0:
+            return {
+                "module": module,
+                "error": result.stderr.strip().splitlines()[-1],
+            }
+        output = json.loads(result.stdout.strip().splitlines()[-1])
+        if "missing" in output:
+            return {"module": module, "missing": output["missing"]}
+        timings.append(output["seconds"])
+        loaded = output["loaded"]
+    return {
+        "module": module,
+        "median_s": float(np.median(timings)),
+        "max_s": float(np.max(timings)),
+        "loaded": loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times a cold import of each entry point against its startup target"
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="writes the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    failed = False
+    print(
+        f"{'entry point':<22}{'median s':>10}{'max s':>8}{'target s':>10}  deferred loaded"
+    )
+    for module, target in startup_targets.items():
+        result = measure_startup(module, args.runs)
+        result["target_s"] = target
+        results.append(result)
+        if "missing" in result:
+            # a missing optional dependency isn't a startup regression
+            print(f"{module:<22}  skipped: no {result['missing']} installed")
+            continue
+        if "error" in result:
+            failed = True
+            print(f"{module:<22}  FAILED: {result['error']}")
+            continue
+        over_target = result["median_s"] > target or len(result["loaded"]) != 0
+        failed = failed or over_target
+        print(
+            f"{module:<22}{result['median_s']:>10.3f}{result['max_s']:>8.3f}{target:>10.1f}  "
+            + (", ".join(result["loaded"]) or "-")
+            + ("  OVER TARGET" if over_target else "")
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import random
+from datetime import datetime, timedelta
+
+# shaped after the mongoose models in scraping_module/models, with values in realistic ranges
+
+map_pool = ["Ancient", "Anubis", "Inferno", "Mirage", "Nuke", "Overpass", "Vertigo"]
+nationalities = ["Denmark", "France", "Brazil", "Russia", "Sweden", "United States"]
+locations = ["Cologne", "Katowice", "Paris", "Rio de Janeiro", "Stockholm"]
+match_types = ["Group stage", "Quarter-final", "Semi-final", "Grand final", "Swiss"]
+rounds_per_half = 15
+overtime_rounds = 3
+roster_change_rate = 0.03
+stand_in_rate = 0.05
+unranked_rate = 0.1
+
+
+def half_stats(rng, skill, rounds):
+    kills = max(0, int(rng.gauss(0.7 * rounds * skill, 3)))
+    deaths = max(0, int(rng.gauss(0.7 * rounds, 3)))
+    return {
+        "kills": kills,
+        "hsKills": rng.randint(0, kills) if kills else 0,
+        "assists": rng.randint(0, max(1, rounds // 4)),
+        "flashAssists": rng.randint(0, 3),
+        "deaths": deaths,
+        "kast": round(min(100, max(0, rng.gauss(70 * skill, 10))), 1),
+        "adr": round(max(0, rng.gauss(75 * skill, 15)), 1),
+        "fkDiff": rng.randint(-3, 3),
+        "rating": round(max(0.1, rng.gauss(skill, 0.3)), 2),
+    }
+
+
+def team_stats(rng, roster, skills, opponents, rounds):
+    stats = {}
+    for pid in roster:
+        duels = {str(opponent): rng.randint(0, 6) for opponent in opponents}
+        stats[str(pid)] = {
+            "duelMap": {
+                "all": duels,
+                "firstKill": {
+                    opponent: rng.randint(0, min(kills, 2))
+                    for opponent, kills in duels.items()
+                },
+                "awp": {
+                    opponent: rng.randint(0, min(kills, 1))
+                    for opponent, kills in duels.items()
+                },
+            },
+            "tStats": half_stats(rng, skills[pid], rounds),
+            "ctStats": half_stats(rng, skills[pid], rounds),
+        }
+    return stats
+
+
+# plays out one map between two team strengths, returns the (winner, loser) scores as score dicts
+def play_map(rng, strength_one, strength_two):
+    win_chance = strength_one / (strength_one + strength_two)
+    one_ct = sum(rng.random() < win_chance for _ in range(rounds_per_half))
+    one_t = 0
+    two_ct = 0
+    two_t = rounds_per_half - one_ct
+    while max(one_ct + one_t, two_ct + two_t) <= rounds_per_half and not (
+        one_ct + one_t == rounds_per_half and two_ct + two_t == rounds_per_half
+    ):
+        if rng.random() < win_chance:
+            one_t += 1
+        else:
+            two_ct += 1
+    one_ot = 0
+    two_ot = 0
+    if one_ct + one_t == two_ct + two_t:
+        winner_ot = overtime_rounds + 1
+        loser_ot = rng.randint(0, overtime_rounds)
+        one_wins = rng.random() < win_chance
+        one_ot = winner_ot if one_wins else loser_ot
+        two_ot = loser_ot if one_wins else winner_ot
+    one = {"ct": one_ct, "t": one_t, "ot": one_ot}
+    two = {"ct": two_ct, "t": two_t, "ot": two_ot}
+    if sum(one.values()) >= sum(two.values()):
+        return one, two, True
+    return two, one, False
+
+
+# maps, matches, events and players documents for num_maps maps played by num_teams teams, in date order
+def generate_collections(
+    num_maps=4000, num_teams=60, seed=0, start_date=datetime(2022, 1, 1)
+):
+    rng = random.Random(seed)
+    players = []
+    skills = {}
+
+    def new_player():
+        pid = 1000 + len(players)
+        players.append(
+            {
+                "hltvId": pid,
+                "name": f"player{pid}",
+                "birthYear": rng.choice([None] + list(range(1990, 2006))),
+                "nationality": rng.choice(nationalities),
+            }
+        )
+        skills[pid] = rng.uniform(0.8, 1.25)
+        return pid
+
+    rosters = [[new_player() for _ in range(5)] for _ in range(num_teams)]
+    strengths = [rng.uniform(0.5, 1.5) for _ in range(num_teams)]
+    # world ranking, by strength
+    team_ranks = {
+        team: rank + 1
+        for rank, team in enumerate(
+            sorted(range(num_teams), key=lambda team: -strengths[team])
+        )
+    }
+
+    events = []
+    matches = []
+    maps = []
+    date = start_date
+    while len(maps) < num_maps:
+        event_teams = rng.sample(range(num_teams), min(num_teams, rng.choice([8, 16])))
+        online = rng.random() < 0.4
+        event = {
+            "hltvId": 5000 + len(events),
+            "title": f"Event {len(events)}",
+            "startDate": date,
+            "endDate": date + timedelta(days=7),
+            "prizePool": rng.choice([None, 25000, 100000, 1000000]),
+            "teamNum": len(event_teams),
+            "teamRankings": [
+                None if rng.random() < unranked_rate else team_ranks[team]
+                for team in event_teams
+            ],
+            "location": None if online else rng.choice(locations),
+            "online": online,
+            "format": {"type": rng.choice(["groups", "swiss", "playoffs"])},
+        }
+        events.append(event)
+        for _ in range(len(event_teams)):
+            if len(maps) >= num_maps:
+                break
+            date += timedelta(hours=rng.randint(1, 12))
+            team_one, team_two = rng.sample(event_teams, 2)
+            for team in [team_one, team_two]:
+                if rng.random() < roster_change_rate:
+                    rosters[team][rng.randrange(5)] = new_player()
+            num_maps_in_match = rng.choice([1, 3, 3, 5])
+            match = {
+                "hltvId": 20000 + len(matches),
+                "eventId": event["hltvId"],
+                "title": f"team{team_one} vs team{team_two}",
+                "date": date,
+                "format": f"Best of {num_maps_in_match}",
+                "numMaps": num_maps_in_match,
+                "online": online,
+                "matchType": rng.choice(match_types),
+                "formatCategory": num_maps_in_match,
+                "matchTypeCategory": rng.randint(0, 4),
+            }
+            matches.append(match)
+            wins = {team_one: 0, team_two: 0}
+            for map_num in range(num_maps_in_match):
+                if max(wins.values()) > num_maps_in_match // 2:
+                    break
+                lineups = {
+                    team: [
+                        new_player() if rng.random() < stand_in_rate else pid
+                        for pid in rosters[team]
+                    ]
+                    for team in [team_one, team_two]
+                }
+                winner_score, loser_score, one_won = play_map(
+                    rng, strengths[team_one], strengths[team_two]
+                )
+                # teamOne is the winner
+                winner, loser = (
+                    (team_one, team_two) if one_won else (team_two, team_one)
+                )
+                wins[winner] += 1
+                rounds = sum(winner_score.values()) + sum(loser_score.values())
+                maps.append(
+                    {
+                        "hltvId": 100000 + len(maps),
+                        "matchId": match["hltvId"],
+                        "mapType": rng.choice(map_pool),
+                        "score": {"teamOne": winner_score, "teamTwo": loser_score},
+                        "teamOneRanking": None
+                        if rng.random() < unranked_rate
+                        else team_ranks[winner],
+                        "teamTwoRanking": None
+                        if rng.random() < unranked_rate
+                        else team_ranks[loser],
+                        "teamOneStats": team_stats(
+                            rng, lineups[winner], skills, lineups[loser], rounds // 2
+                        ),
+                        "teamTwoStats": team_stats(
+                            rng, lineups[loser], skills, lineups[winner], rounds // 2
+                        ),
+                        "date": date + timedelta(hours=map_num),
+                        "players": lineups[winner] + lineups[loser],
+                        "pickedBy": rng.choice(["teamOne", "teamTwo", None]),
+                        "mapNum": map_num,
+                    }
+                )
+        date += timedelta(days=rng.randint(1, 4))
+    return {"maps": maps, "matches": matches, "events": events, "players": players}
+
+
+# just enough of a pymongo collection for snapshot.export_snapshot
+class InMemoryCollection(list):
+    def find(self, query={}):
+        return iter(self)
+
+    def estimated_document_count(self):
+        return len(self)
+
+
+def in_memory_db(collections):
+    return {name: InMemoryCollection(docs) for name, docs in collections.items()}
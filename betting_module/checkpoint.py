@@ -0,0 +1,205 @@
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+from frame_store import (
+    atomic_write,
+    write_table,
+    read_frame_file,
+    frame_exists,
+    read_frame,
+    write_frame,
+)
+
+chunk_prefix = "chunk-"
+
+# most id ranges pending_filter sends before falling back to their bounds
+max_pending_ranges = 64
+
+# chunks a run leaves next to the frame before merging them into it. merging rewrites the whole frame, so it
+#  waits until there are enough chunks to be worth it
+consolidate_chunk_threshold = 64
+
+
+# set of processed map hltvIds stored as a bitmap indexed by id, roughly 1 bit per id on disk
+class ProcessedIds:
+    def __init__(self, bitmap=None):
+        self.bitmap = bitmap if bitmap is not None else np.zeros(0, dtype=np.bool_)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.bitmap))
+
+    def __contains__(self, map_id):
+        return map_id < len(self.bitmap) and bool(self.bitmap[map_id])
+
+    def add(self, map_ids):
+        map_ids = np.asarray(map_ids, dtype=np.int64)
+        if len(map_ids) == 0:
+            return
+        max_id = map_ids.max()
+        if max_id >= len(self.bitmap):
+            grown = np.zeros(max(max_id + 1, len(self.bitmap) * 2), dtype=np.bool_)
+            grown[: len(self.bitmap)] = self.bitmap
+            self.bitmap = grown
+        self.bitmap[map_ids] = True
+
+    def save(self, file_path):
+        def write(tmp_file_path):
+            with open(tmp_file_path, "wb") as f:
+                np.save(f, np.packbits(self.bitmap))
+
+        atomic_write(file_path, write)
+
+    @classmethod
+    def load(cls, file_path):
+        if not os.path.exists(file_path):
+            return cls()
+        return cls(np.unpackbits(np.load(file_path)).astype(np.bool_))
+
+    # ids in all_ids processed as a mask, with all_ids made sorted and unique
+    def processed_mask(self, all_ids):
+        all_ids = np.unique(np.asarray(all_ids, dtype=np.int64))
+        processed = np.zeros(len(all_ids), dtype=np.bool_)
+        in_bitmap = all_ids < len(self.bitmap)
+        processed[in_bitmap] = self.bitmap[all_ids[in_bitmap]]
+        return all_ids, processed
+
+    # ids in all_ids that aren't processed yet, sorted ascending
+    def pending(self, all_ids):
+        all_ids, processed = self.processed_mask(all_ids)
+        return all_ids[~processed]
+
+    # contiguous runs of unprocessed ids, taken over the sorted ids that actually exist
+    def pending_ranges(self, all_ids):
+        all_ids, processed = self.processed_mask(all_ids)
+        edges = np.diff(np.concatenate([[0], ~processed, [0]]).astype(np.int8))
+        return [
+            (int(all_ids[start]), int(all_ids[end - 1]))
+            for start, end in zip(
+                np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+            )
+        ]
+
+    # replaces the {"$not": {"$in": [...every processed id...]}} filter with a handful of id ranges. past
+    #  max_pending_ranges of them the filter is only the bounds of the pending ids, so it stays small enough for
+    #  the server to plan, and whoever reads its maps skips the processed ones
+    def pending_filter(self, all_ids):
+        if len(self) == 0:
+            return {}
+        ranges = self.pending_ranges(all_ids)
+        if len(ranges) == 0:
+            return {"hltvId": {"$in": []}}
+        if len(ranges) > max_pending_ranges:
+            return {"hltvId": {"$gte": ranges[0][0], "$lte": ranges[-1][1]}}
+        return {
+            "$or": [{"hltvId": {"$gte": start, "$lte": end}} for start, end in ranges]
+        }
+
+    # the id an incremental run can start past without missing an unprocessed id of all_ids: one below the
+    #  lowest pending id, or the highest id if none are pending. None without ids
+    def watermark(self, all_ids):
+        pending = self.pending(all_ids)
+        if len(pending) != 0:
+            return int(pending[0]) - 1
+        return int(np.max(all_ids)) if len(all_ids) != 0 else None
+
+    def union(self, other):
+        bitmap = np.zeros(max(len(self.bitmap), len(other.bitmap)), dtype=np.bool_)
+        bitmap[: len(self.bitmap)] |= self.bitmap
+        bitmap[: len(other.bitmap)] |= other.bitmap
+        return ProcessedIds(bitmap)
+
+
+# hltvId every map up to which was done (processed or skipped) by the last completed run. newly played maps get
+#  higher hltvIds than every map before them, so an incremental run only looks past it. older maps scraped late
+#  are left to a full run
+def load_watermark(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)["hltvId"]
+
+
+def save_watermark(file_path, hltv_id):
+    def write(tmp_file_path):
+        with open(tmp_file_path, "w") as f:
+            json.dump({"hltvId": int(hltv_id)}, f)
+
+    atomic_write(file_path, write)
+
+
+# append-only frame chunks on disk, plus the bitmap of map ids they contain and the bitmap of map ids that gave
+#  no data point and never will (see processing_helper.is_permanent_skip). skipped maps are done as far as
+#  later runs go, deleting the skipped ids file has them looked at again
+class FrameCheckpoint:
+    def __init__(
+        self, chunk_folder, processed_ids_file_path, skipped_ids_file_path=None
+    ):
+        self.chunk_folder = chunk_folder
+        self.processed_ids_file_path = processed_ids_file_path
+        self.processed_ids = ProcessedIds.load(processed_ids_file_path)
+        self.skipped_ids_file_path = skipped_ids_file_path
+        self.skipped_ids = (
+            ProcessedIds.load(skipped_ids_file_path)
+            if skipped_ids_file_path != None
+            else ProcessedIds()
+        )
+        os.makedirs(chunk_folder, exist_ok=True)
+        self.chunk_num = len(self.chunk_file_paths())
+
+    # ids that are processed or skipped
+    def done_ids(self):
+        return self.processed_ids.union(self.skipped_ids)
+
+    def is_done(self, map_id):
+        return map_id in self.processed_ids or map_id in self.skipped_ids
+
+    def chunk_file_paths(self):
+        # chunks written before the frame was stored as parquet are CSV
+        return sorted(
+            glob.glob(os.path.join(self.chunk_folder, chunk_prefix + "*.parquet"))
+            + glob.glob(os.path.join(self.chunk_folder, chunk_prefix + "*.csv"))
+        )
+
+    # for frames saved before checkpointing existed, marks their map ids as processed
+    def seed_from_frame(self, frame_path):
+        if len(self.processed_ids) != 0 or not frame_exists(frame_path):
+            return
+        self.processed_ids.add(read_frame(frame_path, columns=["map_id"])["map_id"])
+        self.processed_ids.save(self.processed_ids_file_path)
+        print(f"Seeded {len(self.processed_ids)} processed ids from {frame_path}")
+
+    def write(self, frame, skipped_ids=[]):
+        if len(skipped_ids) != 0:
+            self.skipped_ids.add(skipped_ids)
+            if self.skipped_ids_file_path != None:
+                self.skipped_ids.save(self.skipped_ids_file_path)
+        if len(frame.index) == 0:
+            return
+        # the chunk is written before the ids, so a crash in between only means some maps get reprocessed
+        chunk_file_path = os.path.join(
+            self.chunk_folder, f"{chunk_prefix}{self.chunk_num:06d}.parquet"
+        )
+        write_table(frame, chunk_file_path)
+        self.chunk_num += 1
+        self.processed_ids.add(frame["map_id"])
+        self.processed_ids.save(self.processed_ids_file_path)
+
+    # merges the chunks into the full frame that learning.py reads, then removes them. only once there are
+    #  min_chunks of them, if it's given
+    def consolidate(self, frame_path, min_chunks=1):
+        chunk_file_paths = self.chunk_file_paths()
+        if len(chunk_file_paths) == 0 or len(chunk_file_paths) < min_chunks:
+            return
+        frames = [read_frame_file(path) for path in chunk_file_paths]
+        if frame_exists(frame_path):
+            frames.insert(0, read_frame(frame_path))
+        frame = pd.concat(frames, ignore_index=True)
+        frame = frame.drop_duplicates(subset=["map_id"], keep="last")
+        frame = frame.sort_values(by=["map_id"])
+        print(f"Saving frame to {frame_path}, shape", frame.shape)
+        write_frame(frame, frame_path)
+        for path in chunk_file_paths:
+            os.remove(path)
+        self.chunk_num = 0
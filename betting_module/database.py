@@ -0,0 +1,87 @@
+import os
+import threading
+import weakref
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# nothing here connects on import. clients are created on the first query, so entry points that never touch
+#  the database (or only touch it late) don't pay for the connection, or for importing pymongo
+
+database_name = "scraped-hltv"
+
+# upper bound on each client's pool. connections are opened as threads need them, none are opened up front
+max_pool_size = 88
+
+lock = threading.Lock()
+# "mongo" / "configured" -> database, filled in on first use
+databases = {}
+
+
+def get_mongo_db():
+    with lock:
+        if not "mongo" in databases:
+            import pymongo
+
+            client = pymongo.MongoClient(
+                os.environ["MONGODB_URI"], maxPoolSize=max_pool_size
+            )
+            databases["mongo"] = client[database_name]
+        return databases["mongo"]
+
+
+# the database the feature pipeline reads: "mongo" queries MONGODB_URI, "snapshot" reads the column files
+#  written by snapshot.py, with no network I/O
+def get_db():
+    with lock:
+        db = databases.get("configured")
+    if db != None:
+        return db
+    if os.environ.get("DATA_BACKEND", "mongo") == "snapshot":
+        from snapshot import Snapshot, default_snapshot_folder
+
+        db = Snapshot(os.environ.get("SNAPSHOT_FOLDER", default_snapshot_folder))
+        print("Helper snapshot opened, exported", db.manifest["exported"])
+    else:
+        db = get_mongo_db()
+        print("Helper client connected")
+    with lock:
+        return databases.setdefault("configured", db)
+
+
+# every LazyCollection, so a forked child can drop the collections it resolved from its parent's client
+lazy_collections = weakref.WeakSet()
+
+
+# stands in for a collection until it's first used, then passes everything through to it
+class LazyCollection:
+    def __init__(self, name, get_database=get_db):
+        self.name = name
+        self.get_database = get_database
+        self.collection = None
+        lazy_collections.add(self)
+
+    def resolve(self):
+        if self.collection == None:
+            self.collection = self.get_database()[self.name]
+        return self.collection
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+
+# pymongo clients aren't fork-safe, so a forked child forgets its parent's and connects its own on its first
+#  query. snapshots only read files, the child keeps sharing its parent's
+def forget_mongo_clients():
+    global lock
+    lock = threading.Lock()
+    mongo_db = databases.pop("mongo", None)
+    if mongo_db == None:
+        return
+    if databases.get("configured") is mongo_db:
+        del databases["configured"]
+    for collection in lazy_collections:
+        collection.collection = None
+
+
+os.register_at_fork(after_in_child=forget_mongo_clients)
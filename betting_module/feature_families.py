@@ -0,0 +1,320 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from feature_schema import (
+    feature_schema,
+    label,
+    map_list,
+    stat_categories,
+    category_stat_types,
+    sided_prefixes,
+    winrate_stats,
+)
+from processing_helper import (
+    stream_maps_in_order,
+    map_batch_size,
+    generate_data_point,
+    max_threshold,
+    apart_threshold,
+    default_rounds,
+    default_rating,
+    default_side_stat,
+    default_last,
+    default_birth_year,
+    default_stdevs,
+    default_rating_variance,
+    default_side_winrate,
+    ranking_threshold,
+    sided_stats,
+)
+from metadata_cache import max_ranking
+from performance_store import batch_histories
+from frame_store import atomic_write, read_frame, write_frame
+from row_buffer import RowBuffer, column_dtype
+from stage_timing import stage_timer
+
+# every feature column belongs to one family, registered with a version and the parameters its values are
+#  computed with. the frame records each family's fingerprint next to it, so when a family changes (its
+#  version is bumped, or a parameter such as a default or the stat categories changes) it and the families
+#  depending on it are stale, and only their columns are recomputed for the maps already in the frame
+
+feature_families_file_name = "feature-families.json"
+
+# identify a row and the team order it was computed in, never recomputed
+key_columns = ["map_id", label]
+
+
+class FeatureFamily:
+    def __init__(self, name, version, columns, params={}, depends_on=[]):
+        self.name = name
+        self.version = version
+        self.columns = columns
+        self.params = params
+        self.depends_on = depends_on
+
+    def fingerprint(self):
+        return hashlib.sha1(
+            json.dumps(
+                {"version": self.version, "params": self.params},
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()[:12]
+
+
+# name -> FeatureFamily, in registration order
+feature_families = {}
+
+
+def register_family(name, version, columns, params={}, depends_on=[]):
+    for dependency in depends_on:
+        if not dependency in feature_families:
+            raise ValueError(f"{name} depends on unregistered family {dependency}")
+    feature_families[name] = FeatureFamily(name, version, columns, params, depends_on)
+
+
+def slot_names(slots):
+    return [feature_schema.names[slot] for slot in np.ravel(slots)]
+
+
+register_family(
+    "map",
+    1,
+    ["map_date", "online_bool", "bestof", "map_num"]
+    + slot_names(feature_schema.map_slots)
+    + slot_names(feature_schema.team_slots["map_pick"])
+    + [name for name in feature_schema.names if name.startswith("map_score_")],
+    {"map_list": map_list},
+)
+register_family(
+    "event",
+    1,
+    ["event_teamnum", "event_avg_rankings", "event_stdev_rankings"],
+    {"max_ranking": max_ranking},
+)
+register_family(
+    "ranking",
+    1,
+    slot_names(feature_schema.team_slots["ranking"]),
+    {"max_ranking": max_ranking},
+)
+register_family(
+    "ages",
+    1,
+    slot_names(feature_schema.team_slots["age_avg"]),
+    {"default_birth_year": default_birth_year},
+)
+# the history window every stat family is taken over, it has no columns of its own
+register_family("history", 1, [], {"max_threshold_days": max_threshold.days})
+register_family(
+    "categories",
+    1,
+    [
+        name
+        for key, (slots, _) in feature_schema.category_slots.items()
+        for name in slot_names(slots) + slot_names(feature_schema.mapsplayed_slots[key])
+    ],
+    {
+        "stat_categories": stat_categories,
+        "category_stat_types": category_stat_types,
+        "default_rounds": default_rounds,
+        "default_rating": default_rating,
+        "default_stdevs": default_stdevs,
+        "ranking_threshold": ranking_threshold,
+    },
+    ["history", "ranking"],
+)
+register_family(
+    "sided",
+    1,
+    [
+        name
+        for prefix in sided_prefixes
+        for name in slot_names(feature_schema.sided_slots[prefix])
+    ],
+    {
+        "sided_stats": sided_stats,
+        "default_side_stat": default_side_stat,
+        "default_rating_variance": default_rating_variance,
+    },
+    ["history"],
+)
+register_family(
+    "winrates",
+    1,
+    slot_names(feature_schema.winrate_slots),
+    {"winrate_stats": winrate_stats, "default_side_winrate": default_side_winrate},
+    ["history"],
+)
+register_family(
+    "timing",
+    1,
+    [
+        name
+        for prefix in ["timetogether", "lastwin", "lastloss"]
+        for name in slot_names(feature_schema.team_slots[prefix])
+    ],
+    {"apart_threshold": apart_threshold, "default_last": default_last},
+    ["history"],
+)
+
+owned_columns = [
+    column for family in feature_families.values() for column in family.columns
+]
+if sorted(owned_columns + key_columns) != sorted(feature_schema.names):
+    raise ValueError("Every feature column must belong to exactly one feature family")
+
+
+def family_fingerprints():
+    return {name: family.fingerprint() for name, family in feature_families.items()}
+
+
+# families whose fingerprint differs from the recorded one, and every family depending on one of them
+def stale_families(recorded_fingerprints):
+    stale = set(
+        name
+        for name, fingerprint in family_fingerprints().items()
+        if recorded_fingerprints.get(name) != fingerprint
+    )
+    changed = True
+    while changed:
+        changed = False
+        for name, family in feature_families.items():
+            if not name in stale and any(
+                dependency in stale for dependency in family.depends_on
+            ):
+                stale.add(name)
+                changed = True
+    return [name for name in feature_families if name in stale]
+
+
+# whether the family's values come from the map's history window
+def needs_history(name):
+    family = feature_families[name]
+    return name == "history" or any(
+        needs_history(dependency) for dependency in family.depends_on
+    )
+
+
+# the fingerprints the frame in folder was computed with, None if they were never recorded
+def load_family_fingerprints(folder):
+    file_path = os.path.join(folder, feature_families_file_name)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def save_family_fingerprints(folder):
+    def write(tmp_file_path):
+        with open(tmp_file_path, "w") as f:
+            json.dump(family_fingerprints(), f, indent=2)
+
+    atomic_write(os.path.join(folder, feature_families_file_name), write)
+
+
+def same_value(value, stored_value):
+    return float(value) == float(stored_value) or (
+        np.isnan(float(value)) and np.isnan(float(stored_value))
+    )
+
+
+# team order a tied map was stored in. ties don't record it in the label, so the columns of unchanged families
+#  that don't need the history are recomputed both ways round and compared to the stored ones. None if neither
+#  or both orders match
+def tied_winner(curr_map, stored_row, family_names):
+    columns = [
+        column
+        for name, family in feature_families.items()
+        if not name in family_names and not needs_history(name)
+        for column in family.columns
+    ]
+    matches = []
+    for winner in [1, 0]:
+        w = generate_data_point(curr_map, winner=winner, with_history=False)
+        if w != None and all(
+            same_value(w[column], stored_row[column]) for column in columns
+        ):
+            matches.append(winner)
+    return matches[0] if len(matches) == 1 else None
+
+
+# recomputes the columns of the given families for every map in the frame file and merges them into it. the
+#  maps are walked in date order, through a sliding history window when a family needs the history, and keep
+#  the team order they were stored in. tied maps whose order can't be told are redone whole
+# with a window_builder the histories come from its store, otherwise they're fetched batch_size maps at a
+#  time as process_maps does. the maps are fetched in pages of batch_size ids, in the frame's date order,
+#  which is the order a sliding window walks them in
+def recompute_families(
+    frame_path, family_names, window_builder=None, batch_size=map_batch_size
+):
+    frame = read_frame(frame_path)
+    columns = [
+        column for name in family_names for column in feature_families[name].columns
+    ]
+    with_history = any(needs_history(name) for name in family_names)
+    stored_rows = frame.set_index(frame["map_id"].astype(int))
+    partial_rows = RowBuffer(["map_id"] + columns)
+    full_rows = RowBuffer(feature_schema.names)
+    failed = 0
+    date_order = np.lexsort(
+        (stored_rows.index.to_numpy(), stored_rows["map_date"].to_numpy())
+    )
+    maps_in_order = stream_maps_in_order(stored_rows.index[date_order], batch_size)
+    map_histories = (
+        ((curr_map, None) for curr_map in maps_in_order)
+        if window_builder != None or not with_history
+        else batch_histories(maps_in_order, batch_size)
+    )
+    for curr_map, history_store in tqdm(
+        map_histories,
+        total=len(stored_rows.index),
+        desc="Recomputing " + ", ".join(family_names),
+        ncols=150,
+    ):
+        stored_row = stored_rows.loc[curr_map["hltvId"]]
+        winner = stored_row[label]
+        if not winner in [0, 1]:
+            winner = tied_winner(curr_map, stored_row, family_names)
+        with stage_timer.stage("data_point"):
+            w = generate_data_point(
+                curr_map,
+                performance_store=history_store,
+                window_builder=window_builder,
+                winner=1 if winner == None else int(winner),
+                with_history=with_history or winner == None,
+            )
+        if w == None:
+            failed += 1
+            continue
+        (full_rows if winner == None else partial_rows).append(w)
+
+    frame_positions = pd.Index(frame["map_id"].astype(int))
+    for updates in [partial_rows.to_frame(), full_rows.to_frame()]:
+        positions = frame_positions.get_indexer(updates["map_id"].astype(int))
+        for column in updates.columns:
+            if column == "map_id":
+                continue
+            values = (
+                frame[column].to_numpy(dtype=np.float64, copy=True)
+                if column in frame
+                else np.full(len(frame.index), np.nan)
+            )
+            values[positions] = updates[column].to_numpy(dtype=np.float64)
+            frame[column] = (
+                values
+                if np.isnan(values).any()
+                else values.astype(column_dtype(column))
+            )
+    # columns of removed features are dropped, new ones were added above
+    frame = frame[feature_schema.names]
+    print(
+        f"Recomputed {', '.join(family_names)} for {len(partial_rows)} maps, "
+        + f"{len(full_rows)} tied maps in an unknown team order redone whole, {failed} failed and kept as they were"
+    )
+    write_frame(frame, frame_path)
+    return frame
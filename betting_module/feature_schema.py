@@ -0,0 +1,315 @@
+import numpy as np
+import pandas as pd
+
+# the feature columns every data point has, each given a fixed slot in a float row. slots follow the sorted
+#  column names, which is the order learning has always fed columns to the model in, so rows and frames
+#  built from the schema never need sorting again
+
+label = "winner"
+
+# These are the most common active duty maps, and the map_vector effectively creates a multi-classifier based on these
+map_list = [
+    "Ancient",
+    "Anubis",
+    "Cache",
+    "Cobblestone",
+    "Dust2",
+    "Inferno",
+    "Mirage",
+    "Nuke",
+    "Overpass",
+    "Train",
+    "Vertigo",
+]
+
+team_suffixes = ["team_one", "team_two"]
+
+game_sides = ["ct", "t"]
+
+matchup_category = "matchup"
+
+stat_categories = ["rank", "map", "online", "event", matchup_category]
+
+# order of the type axis of category values: rounds won by the player's team, and the player's rating
+category_stat_types = ["round", "rating"]
+stat_types = ["avg", "stdev"]
+winrate_stats = ["twinrate", "ctwinrate", "otwinrate"]
+# per side team stats
+sided_prefixes = [
+    "team_avg_ratingvariance",
+    "individual_avg_rating",
+    "individual_avg_ratingvariance",
+    "total_avg_kast",
+    "total_avg_fkdiff",
+]
+# per team stats
+team_prefixes = [
+    "ranking",
+    "age_avg",
+    "timetogether",
+    "lastwin",
+    "lastloss",
+    "map_pick",
+] + [f"total_avg_{winrate_stat}" for winrate_stat in winrate_stats]
+
+
+def build_column_names():
+    column_names = []
+
+    column_names.append(label)
+    column_names.append("map_date")
+    column_names.append("online_bool")
+    column_names.append("event_teamnum")
+    column_names.append("event_avg_rankings")
+    column_names.append("event_stdev_rankings")
+    column_names.append("bestof")
+    column_names.append("map_id")
+    column_names.append("map_num")
+
+    # extremely flawed metric but
+    # column_names.append("match_category")
+
+    for map in map_list:
+        column_names.append(f"map_{map.lower()}_bool")
+
+    for suffix in team_suffixes:
+        for side in game_sides:
+            for prefix in sided_prefixes:
+                column_names.append(f"{prefix}_{side}_{suffix}")
+        for side in game_sides + ["ot"]:
+            column_names.append(f"map_score_{side}_{suffix}")
+        for prefix in team_prefixes:
+            column_names.append(f"{prefix}_{suffix}")
+        # column_names.append(f"total_wonduels_{suffix}")
+        # column_names.append(f"total_avg_awpkills_{suffix}")
+
+    for category in stat_categories:
+        for suffix in team_suffixes:
+            for type in category_stat_types:
+                # only one side of the matchup has round stats
+                if (
+                    category == matchup_category
+                    and suffix == "team_two"
+                    and type == "round"
+                ):
+                    continue
+                for side in game_sides:
+                    for stat_type in stat_types:
+                        column_names.append(
+                            f"{type}_{stat_type}_{side}_{suffix}_{category}"
+                        )
+            # shared between round stats and rating stats
+            column_names.append(f"mapsplayed_avg_{suffix}_{category}")
+    return column_names
+
+
+# a data point as one float row in schema slot order, with a mask of the slots that were assigned so it reads
+#  like the dict data points used to: only the features that were set are keys, even ones set to NaN or None
+class FeatureRow:
+    __slots__ = ["schema", "values", "assigned"]
+
+    def __init__(self, schema, values=None, assigned=None):
+        self.schema = schema
+        self.values = np.full(schema.num_features, np.nan) if values is None else values
+        if assigned is None:
+            assigned = (
+                np.zeros(schema.num_features, dtype=np.bool_)
+                if values is None
+                else ~np.isnan(values)
+            )
+        self.assigned = assigned
+
+    def __getitem__(self, name):
+        slot = self.schema.slots[name]
+        if not self.assigned[slot]:
+            raise KeyError(name)
+        return self.values[slot]
+
+    def __setitem__(self, name, value):
+        self.set_slots(self.schema.slots[name], np.nan if value is None else value)
+
+    # writes values to slots (one, or an array of them) and marks them assigned
+    def set_slots(self, slots, values):
+        self.values[slots] = values
+        self.assigned[slots] = True
+
+    def __delitem__(self, name):
+        slot = self.schema.slots[name]
+        self.values[slot] = np.nan
+        self.assigned[slot] = False
+
+    def __contains__(self, name):
+        slot = self.schema.slots.get(name)
+        return slot != None and bool(self.assigned[slot])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.assigned))
+
+    def keys(self):
+        return [self.schema.names[slot] for slot in np.flatnonzero(self.assigned)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return self.to_dict().items()
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    # sets every feature of other that's set, from either a row or a dict
+    def __ior__(self, other):
+        if isinstance(other, FeatureRow):
+            np.copyto(self.values, other.values, where=other.assigned)
+            self.assigned |= other.assigned
+        else:
+            for name, value in other.items():
+                self[name] = value
+        return self
+
+    def to_dict(self):
+        return {name: self.values[self.schema.slots[name]] for name in self.keys()}
+
+    # only the values and the mask are pickled, rows sent back from worker processes are rebuilt on the shared
+    #  schema
+    def __reduce__(self):
+        return (restore_row, (self.values, self.assigned))
+
+
+def restore_row(values, assigned=None):
+    return FeatureRow(feature_schema, values, assigned)
+
+
+class FeatureSchema:
+    def __init__(self, column_names):
+        self.names = sorted(column_names)
+        self.slots = {name: slot for slot, name in enumerate(self.names)}
+        self.num_features = len(self.names)
+
+        # slot tables the stat code writes through, so no keys are formatted per data point
+        self.map_slots = self.slot_array(
+            [f"map_{name.lower()}_bool" for name in map_list]
+        )
+        # prefix -> (team suffix x side) slots
+        self.sided_slots = {
+            prefix: self.slot_array(
+                [
+                    [f"{prefix}_{side}_{suffix}" for side in game_sides]
+                    for suffix in team_suffixes
+                ]
+            )
+            for prefix in sided_prefixes
+        }
+        # prefix -> slot per team suffix
+        self.team_slots = {
+            prefix: self.slot_array([f"{prefix}_{suffix}" for suffix in team_suffixes])
+            for prefix in team_prefixes
+        }
+        # (team suffix x winrate stat) slots
+        self.winrate_slots = self.slot_array(
+            [
+                [f"total_avg_{winrate_stat}_{suffix}" for winrate_stat in winrate_stats]
+                for suffix in team_suffixes
+            ]
+        )
+        # (suffix index, category) -> slots and the flat (type x stat type x side) indices written to them
+        self.category_slots = {}
+        # (suffix index, category) -> mapsplayed slot
+        self.mapsplayed_slots = {}
+        category_value_shape = (
+            len(category_stat_types),
+            len(stat_types),
+            len(game_sides),
+        )
+        for suffix_idx, suffix in enumerate(team_suffixes):
+            for category in stat_categories:
+                category_slots = []
+                value_idxs = []
+                for t, type in enumerate(category_stat_types):
+                    for a, stat_type in enumerate(stat_types):
+                        for k, side in enumerate(game_sides):
+                            name = f"{type}_{stat_type}_{side}_{suffix}_{category}"
+                            if name in self.slots:
+                                category_slots.append(self.slots[name])
+                                value_idxs.append(
+                                    np.ravel_multi_index(
+                                        (t, a, k), category_value_shape
+                                    )
+                                )
+                self.category_slots[(suffix_idx, category)] = (
+                    np.array(category_slots, dtype=np.int64),
+                    np.array(value_idxs, dtype=np.int64),
+                )
+                self.mapsplayed_slots[(suffix_idx, category)] = self.slots[
+                    f"mapsplayed_avg_{suffix}_{category}"
+                ]
+
+        # tuple of category names -> category_table
+        self.category_tables = {}
+
+    # the slots of categories in the given order for both teams, the flat indices written to them from a
+    #  (team suffix x category x type x stat type x side) array, and the (team suffix x category) mapsplayed slots
+    def category_table(self, category_names):
+        table = self.category_tables.get(category_names)
+        if table == None:
+            category_value_num = (
+                len(category_stat_types) * len(stat_types) * len(game_sides)
+            )
+            table_slots = [np.empty(0, dtype=np.int64)]
+            table_idxs = [np.empty(0, dtype=np.int64)]
+            for suffix_idx in range(len(team_suffixes)):
+                for c, category in enumerate(category_names):
+                    category_slots, value_idxs = self.category_slots[
+                        (suffix_idx, category)
+                    ]
+                    table_slots.append(category_slots)
+                    table_idxs.append(
+                        value_idxs
+                        + (suffix_idx * len(category_names) + c) * category_value_num
+                    )
+            table = self.category_tables[category_names] = (
+                np.concatenate(table_slots),
+                np.concatenate(table_idxs),
+                self.slot_array(
+                    [
+                        [
+                            f"mapsplayed_avg_{suffix}_{category}"
+                            for category in category_names
+                        ]
+                        for suffix in team_suffixes
+                    ]
+                ),
+            )
+        return table
+
+    def slot_array(self, names):
+        return np.vectorize(self.slots.__getitem__, otypes=[np.int64])(
+            np.array(names, dtype=object)
+        )
+
+    def new_row(self):
+        return FeatureRow(self)
+
+    def row(self, features):
+        row = self.new_row()
+        row |= features
+        return row
+
+    # (rows x features) matrix in slot order
+    def matrix(self, rows):
+        if len(rows) == 0:
+            return np.empty((0, self.num_features))
+        return np.stack([row.values for row in rows])
+
+    def frame(self, rows):
+        return pd.DataFrame(self.matrix(rows), columns=self.names)
+
+
+# frames written from schema rows are already in slot order, so only other frames are reindexed
+def sort_columns(frame):
+    if frame.columns.is_monotonic_increasing:
+        return frame
+    return frame.reindex(sorted(frame.columns), axis=1)
+
+
+feature_schema = FeatureSchema(build_column_names())
@@ -0,0 +1,117 @@
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# feature frames are kept as parquet datasets, a folder holding one partition per map year (map_year=2019/),
+#  so a frame loads typed (booleans stay booleans) and compressed, on every core, with only the columns asked
+#  for, and a map_date range only opens the years it spans. single frames such as learning.py's intermediates
+#  and the frame chunks are plain parquet files. a frame still saved as CSV next to the folder, from before,
+#  is converted the first time it's read
+
+partition_column = "map_year"
+compression = "zstd"
+
+
+# writes to a temporary file then renames it, so a crash never leaves a half-written file behind
+def atomic_write(file_path, write_fn):
+    tmp_file_path = file_path + ".tmp"
+    write_fn(tmp_file_path)
+    os.replace(tmp_file_path, file_path)
+
+
+partitioning = ds.partitioning(
+    pa.schema([(partition_column, pa.int32())]), flavor="hive"
+)
+
+
+def map_years(map_dates):
+    return pd.to_datetime(map_dates, unit="s", utc=True).dt.year.astype("int32")
+
+
+def date_year(date):
+    return pd.Timestamp(date, unit="s", tz="UTC").year
+
+
+def write_frame(frame, path):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.append_column(
+        partition_column, pa.array(map_years(frame["map_date"]).to_numpy())
+    )
+    # written next to the old folder and swapped in, so a crash leaves one whole frame
+    tmp_path = path + ".tmp"
+    old_path = path + ".old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ds.write_dataset(
+        table,
+        tmp_path,
+        format="parquet",
+        partitioning=partitioning,
+        file_options=ds.ParquetFileFormat().make_write_options(compression=compression),
+    )
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+# converts a frame saved as path + ".csv" into the dataset at path. returns whether there was one
+def migrate_csv_frame(path):
+    csv_file_path = path + ".csv"
+    if not os.path.exists(csv_file_path):
+        return False
+    print(f"Converting {csv_file_path} to {path}")
+    write_frame(pd.read_csv(csv_file_path, index_col=[0], low_memory=False), path)
+    os.remove(csv_file_path)
+    return True
+
+
+def frame_exists(path):
+    # a crash between the swaps in write_frame leaves only the old folder
+    if not os.path.exists(path) and os.path.exists(path + ".old"):
+        os.replace(path + ".old", path)
+    return os.path.exists(path) or migrate_csv_frame(path)
+
+
+# the frame at path, with only the given columns and the maps from min_date up to max_date (timestamps, as in
+#  map_date) if they're given. rows come in map year order, the order they were written in within a year
+def read_frame(path, columns=None, min_date=None, max_date=None):
+    if not frame_exists(path):
+        raise FileNotFoundError(path)
+    dataset = ds.dataset(path, format="parquet", partitioning=partitioning)
+    if columns == None:
+        columns = [name for name in dataset.schema.names if name != partition_column]
+    expression = None
+    if min_date != None:
+        expression = (ds.field(partition_column) >= date_year(min_date)) & (
+            ds.field("map_date") >= min_date
+        )
+    if max_date != None:
+        max_expression = (ds.field(partition_column) <= date_year(max_date)) & (
+            ds.field("map_date") <= max_date
+        )
+        expression = (
+            max_expression if expression is None else expression & max_expression
+        )
+    return dataset.to_table(
+        columns=columns, filter=expression, use_threads=True
+    ).to_pandas()
+
+
+def write_table(frame, file_path):
+    atomic_write(
+        file_path,
+        lambda tmp_file_path: frame.to_parquet(tmp_file_path, compression=compression),
+    )
+
+
+def read_table(file_path, columns=None):
+    return pd.read_parquet(file_path, columns=columns)
+
+
+# a frame chunk, or any single frame, whether it was saved as parquet or as CSV
+def read_frame_file(file_path):
+    if file_path.endswith(".csv"):
+        return pd.read_csv(file_path, index_col=[0])
+    return read_table(file_path)
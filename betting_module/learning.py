@@ -1,5 +1,6 @@
 import pickle
 import os
+import shutil
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 import traceback
@@ -12,15 +13,18 @@ from datetime import datetime
 import tensorflow_model_optimization as tfmot
 from tensorflow import keras
 from sklearn.model_selection import train_test_split
-from learning_helper import process_frame
+from learning_helper import process_frame, truncation_date
+from processing_helper import feature_constants_file_name
+from feature_schema import sort_columns
 from predicting import map_ids_to_examine
+from frame_store import read_frame, read_table, write_table
 
 csv_folder = "learning_data/"
 
-frame_file_path = csv_folder + "saved-frame.csv"
-processed_frame_file_path = csv_folder + "processed-frame.csv"
-examine_frame_file_path = csv_folder + "examine-frame.csv"
-examine_ids_file_path = csv_folder + "examine-ids.csv"
+frame_path = csv_folder + "saved-frame"
+processed_frame_file_path = csv_folder + "processed-frame.parquet"
+examine_frame_file_path = csv_folder + "examine-frame.parquet"
+examine_ids_file_path = csv_folder + "examine-ids.parquet"
 matrix_file_path = csv_folder + "cached-matrix.npy"
 
 feature_frame = None
@@ -46,15 +50,16 @@ def split_dataset(dataset, test_ratio=0.30, seed=1234):
 cached_frame = True
 
 try:
-    feature_frame = pd.read_csv(processed_frame_file_path, index_col=[0])
-    examine_frame = pd.read_csv(examine_frame_file_path)
-    examine_ids = pd.read_csv(examine_ids_file_path)
+    feature_frame = read_table(processed_frame_file_path)
+    examine_frame = read_table(examine_frame_file_path)
+    examine_ids = read_table(examine_ids_file_path)
     print("Cached frames loaded")
 except:
     print("Reprocessing frames")
     cached_frame = False
-    feature_frame = pd.read_csv(frame_file_path, index_col=[0], low_memory=False)
-    feature_frame = feature_frame.reindex(sorted(feature_frame.columns), axis=1)
+    # process_frame drops the maps from before the truncation date, so they aren't read
+    feature_frame = read_frame(frame_path, min_date=truncation_date)
+    feature_frame = sort_columns(feature_frame)
     feature_frame = feature_frame.sort_values(by=["map_date"])
     # examine_ids = map_ids_to_examine()[:-1:2]
     examine_ids = []
@@ -63,15 +68,15 @@ except:
     ]
     examine_ids = examine_frame["map_id"]
 
-    examine_ids.to_csv(examine_ids_file_path)
+    write_table(examine_ids.to_frame(), examine_ids_file_path)
     feature_frame = feature_frame[
         (feature_frame[label] != 0.5) & ~(feature_frame["map_id"].isin(examine_ids))
     ].dropna()
     (feature_frame, y, sample_weights) = process_frame(feature_frame, label)
     (examine_frame, examine_y, _) = process_frame(examine_frame, label)
-    examine_frame.to_csv(examine_frame_file_path)
+    write_table(examine_frame, examine_frame_file_path)
     print("Feature frame loaded, shape:", feature_frame.shape)
-    feature_frame.to_csv(processed_frame_file_path)
+    write_table(feature_frame, processed_frame_file_path)
 
 try:
     if not cached_frame:
@@ -90,13 +95,13 @@ except:
         )
         np.save(matrix_file_path, feature_matrix)
     except Exception as e:
-        print(f"ERROR: Unable to load frame from {frame_file_path}.", e)
+        print(f"ERROR: Unable to load frame from {frame_path}.", e)
         traceback.print_exc()
 
 print("Feature matrix processed, shape:", feature_matrix.shape)
 
 try:
-    examine_ids = pd.read_csv(examine_ids_file_path, index_col=[0])
+    examine_ids = read_table(examine_ids_file_path)
 except:
     print("Unable to get examine ids")
 
@@ -259,6 +264,9 @@ model_path = "./prediction_model"
 
 print("Saving Model")
 model.save(model_path)
+# the constants the training frame was computed with, for predicting to compute live features with
+if os.path.exists(csv_folder + feature_constants_file_name):
+    shutil.copy(csv_folder + feature_constants_file_name, model_path)
 
 # hyperparam tuning
 
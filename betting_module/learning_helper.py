@@ -1,8 +1,8 @@
 import numpy as np
 import pandas as pd
-from copy import deepcopy
-from processing_helper import quantize_time
+from processing_helper import quantize_time, load_feature_constants
 from datetime import datetime
+from feature_schema import feature_schema, label as schema_label
 
 
 delete_keywords = ["map_id", "map_score", "stdev", "wonduels"]
@@ -14,35 +14,110 @@ truncation_date = 1456815600
 # truncation_date = quantize_time(datetime(year=2018, month=1, day=1))
 
 
+# what process_frame does to a frame, compiled once per column layout: the rows it keeps (by map date), the
+#  columns it keeps in sorted order, and how each one is cast. a frame or a NumPy batch of rows is then
+#  transformed in one pass, without the copies of reindexing and dropping column by column
+class FrameTransform:
+    def __init__(self, column_names, dtypes=None, label=None, dropped=[]):
+        column_names = list(column_names)
+        if dtypes == None:
+            dtypes = [np.dtype(np.float64)] * len(column_names)
+        self.label = label
+        self.date_idx = column_names.index("map_date")
+        # source index of every kept column, sorted by name
+        self.kept_idxs = [
+            i
+            for i in sorted(range(len(column_names)), key=lambda i: column_names[i])
+            if len([x for x in delete_keywords if x in column_names[i]]) == 0
+            and not column_names[i] in dropped
+        ]
+        self.kept_names = [column_names[i] for i in self.kept_idxs]
+        self.casts = [
+            self.compile_cast(column_names[i], dtypes[i]) for i in self.kept_idxs
+        ]
+
+    def compile_cast(self, column_name, dtype):
+        # converts booleans to ints
+        if dtype == bool:
+            if column_name == self.label:
+                return lambda values: values.astype("int32")
+            return lambda values: values.astype("int64")
+        # ensuring label is an int so that decision tree viz works
+        if column_name == self.label:
+            return lambda values: (values * 1).astype("int32")
+        if dtype == object:
+            return lambda values: (
+                pd.to_numeric(values * 1, errors="coerce").astype(bool).astype("int64")
+            )
+        return None
+
+    # same (frame, y, sample_weights) as the column by column version of process_frame
+    def transform_frame(self, frame):
+        row_mask = frame.iloc[:, self.date_idx].to_numpy() > truncation_date
+        dates = frame.iloc[row_mask, self.date_idx] * 1
+        sample_weights = (dates - np.min(dates)) / (np.max(dates) - np.min(dates))
+        sample_weights = sample_weights * 0.5
+        sample_weights = sample_weights + 0.5
+        columns = {}
+        for name, i, cast in zip(self.kept_names, self.kept_idxs, self.casts):
+            values = frame.iloc[:, i].to_numpy()[row_mask]
+            columns[name] = values if cast == None else cast(values)
+        processed_frame = pd.DataFrame(columns, index=frame.index[row_mask])
+        y = None
+        if self.label:
+            y = processed_frame["winner"].to_numpy().astype(int)
+        return processed_frame, y, sample_weights
+
+    # kept rows and columns of a (rows x columns) float matrix, such as feature rows in schema slot order
+    def transform_matrix(self, matrix):
+        return matrix[matrix[:, self.date_idx] > truncation_date][:, self.kept_idxs]
+
+
+# column layout -> its FrameTransform
+compiled_transforms = {}
+
+
+def compile_transform(column_names, dtypes=None, label=None):
+    key = (tuple(column_names), None if dtypes == None else tuple(dtypes), label)
+    transform = compiled_transforms.get(key)
+    if transform == None:
+        transform = compiled_transforms[key] = FrameTransform(
+            column_names, dtypes, label
+        )
+    return transform
+
+
+# the model's inputs at inference time, read straight out of feature rows: every schema feature but the label
+inference_transform = FrameTransform(feature_schema.names, dropped=[schema_label])
+
+
+model_name = "prediction_model"
+
+# model path -> loaded model
+loaded_models = {}
+
+
+# loads a saved model once per process, along with the feature constants saved next to it. TensorFlow is
+#  only imported here, so entry points that never predict don't pay for it
+def load_model(model_path=model_name):
+    if not model_path in loaded_models:
+        import tensorflow as tf
+
+        load_feature_constants(model_path)
+        loaded_models[model_path] = tf.keras.models.load_model(model_path)
+    return loaded_models[model_path]
+
+
 # prunes unwanted features using the data frame's column names
 def process_frame(frame, label=None):
-    y = None
-    frame = frame[(frame["map_date"] > truncation_date)]
-    # converts booleans to ints
-    frame = frame * 1
-    # orders columns for consistency in matrix
-    frame = frame.reindex(sorted(frame.columns), axis=1)
-    # removing non-integer tie values
-    # ensuring label is an int so that decision tree viz works
-    sample_weights = deepcopy(frame["map_date"])
-    sample_weights = (sample_weights - np.min(sample_weights)) / (
-        np.max(sample_weights) - np.min(sample_weights)
+    return compile_transform(frame.columns, list(frame.dtypes), label).transform_frame(
+        frame
+    )
+
+
+# model inputs for feature rows, as a frame with the columns process_frame would have left in
+def process_rows(rows):
+    return pd.DataFrame(
+        inference_transform.transform_matrix(feature_schema.matrix(rows)),
+        columns=inference_transform.kept_names,
     )
-    sample_weights = sample_weights * 0.5
-    sample_weights = sample_weights + 0.5
-    if label:
-        frame = frame.astype({label: "int32"})
-        y = np.array(frame["winner"].to_list()).astype(int)
-    for column_name in frame.columns:
-        to_delete = False
-        if frame.dtypes[column_name] == object:
-            frame[column_name] = pd.to_numeric(frame[column_name], errors="coerce")
-            frame = frame.astype({column_name: bool})
-            frame = frame.astype({column_name: "int64"})
-
-        if len([x for x in delete_keywords if x in column_name]) != 0:
-            # print(column_nae)
-            to_delete = True
-        if to_delete:
-            frame = frame.drop(column_name, axis=1)
-    return frame, y, sample_weights
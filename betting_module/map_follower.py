@@ -0,0 +1,93 @@
+import os
+import time
+from bson import json_util
+
+from processing_helper import maps, slice_lookup_aggregation, process_maps
+from checkpoint import atomic_write
+
+# follows the inserts into maps through a change stream and turns new maps into feature rows, written out as
+#  a frame chunk every poll. change streams need a replica set, a local single node one for trying this out
+#  is `mongod --replSet rs0 --dbpath <folder>` and then `mongosh --eval "rs.initiate()"`. the scraper inserts a
+#  match's maps before the match itself, so a new map waits until its match lookup finds something, for up to
+#  match_wait seconds
+
+default_poll_interval = 2
+default_match_wait = 3600
+
+
+def load_resume_token(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json_util.loads(f.read())
+
+
+def save_resume_token(file_path, resume_token):
+    def write(tmp_file_path):
+        with open(tmp_file_path, "w") as f:
+            f.write(json_util.dumps(resume_token))
+
+    atomic_write(file_path, write)
+
+
+# new maps whose match has been inserted, in date order, and the ids of the others
+def ready_maps(map_ids):
+    new_maps = list(
+        maps.aggregate(
+            [{"$match": {"hltvId": {"$in": map_ids}}}]
+            + slice_lookup_aggregation
+            + [{"$sort": {"hltvId": 1}}]
+        )
+    )
+    ready = [curr_map for curr_map in new_maps if len(curr_map["match"]) != 0]
+    ready.sort(key=lambda curr_map: curr_map["match"][0]["date"])
+    return ready
+
+
+# runs until stop is set, or forever. the stream resumes from the token saved after the last poll, so maps
+#  inserted while nothing was following are picked up on the next start. maps still waiting for their match
+#  when it stops are past the watermark, and left to the next incremental run
+def follow_maps(
+    feature_data,
+    checkpoint,
+    resume_token_file_path,
+    poll_interval=default_poll_interval,
+    match_wait=default_match_wait,
+    stop=None,
+):
+    # hltvId -> when its insert was seen
+    waiting = {}
+    with maps.watch(
+        [{"$match": {"operationType": "insert"}}],
+        resume_after=load_resume_token(resume_token_file_path),
+        max_await_time_ms=int(poll_interval * 1000),
+    ) as stream:
+        print("Following new maps")
+        while stop == None or not stop.is_set():
+            poll_end = time.monotonic() + poll_interval
+            while time.monotonic() < poll_end:
+                change = stream.try_next()
+                if change == None:
+                    break
+                map_id = change["fullDocument"]["hltvId"]
+                if not checkpoint.is_done(map_id):
+                    waiting[map_id] = time.monotonic()
+            if len(waiting) != 0:
+                ready = ready_maps(list(waiting.keys()))
+                for curr_map in ready:
+                    del waiting[curr_map["hltvId"]]
+                expired = [
+                    map_id
+                    for map_id, seen in waiting.items()
+                    if time.monotonic() - seen > match_wait
+                ]
+                for map_id in expired:
+                    print(f"Map {map_id} had no match after {match_wait}s, skipping")
+                    del waiting[map_id]
+                if len(ready) != 0:
+                    process_maps(
+                        ready, feature_data, "follower", history_batch_size=len(ready)
+                    )
+                    checkpoint.write(*feature_data.rows.drain())
+            if stream.resume_token != None:
+                save_resume_token(resume_token_file_path, stream.resume_token)
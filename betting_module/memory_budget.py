@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from datetime import datetime
+
+# sizes processing.py's batches, workers, checkpoint interval and caches so an estimate of the run's memory
+#  fits a budget, and reports the RSS and the largest allocations while it runs. the per-document sizes
+#  below are rough upper bounds, measured with tracemalloc on the processing loops and rounded up for the
+#  duel maps and player lists real maps carry
+
+mib = 1024 * 1024
+
+# interpreter, numpy, pandas, pyarrow and pymongo, per process
+process_base_bytes = 400 * mib
+# a map in the performance store, with its match and event and its rows of the per-player pack columns
+store_bytes_per_map = 25 * 1024
+# share of the store a forked worker process ends up copying, as it touches the documents of its windows
+forked_store_share = 0.5
+# a map with its match lookup, as streamed to the workers
+map_doc_bytes = 24 * 1024
+# history maps fetched per map of a batch when there is no performance store, after overlaps
+history_docs_per_map = 40
+# a history memo entry, its performances and packed condition windows
+memo_entry_bytes = 256 * 1024
+# a birth year or event stats cache entry
+cache_entry_bytes = 512
+# a feature row in the row buffer, which can hold twice the rows it's grown to while a chunk is written
+row_overhead = 3
+
+# share of the budget the performance store may take before histories are fetched in batches instead
+store_share = 0.6
+rows_share = 0.1
+cache_share = 0.02
+
+units = {"K": 1024, "M": mib, "G": 1024 * mib, "T": 1024 * 1024 * mib}
+
+
+# bytes in a size such as "8G", "512M" or "1073741824"
+def parse_size(size):
+    size = size.strip().upper().removesuffix("B").removesuffix("I")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(num_bytes):
+    return f"{num_bytes / mib:.0f} MiB"
+
+
+# the settings for a run that fit budget bytes, starting from the ones asked for and only ever lowering them.
+#  raises ValueError if even the smallest settings don't fit
+def plan_memory(
+    budget,
+    num_maps,
+    num_features,
+    mode,
+    history,
+    workers,
+    batch_size,
+    checkpoint_interval,
+    birth_year_cache_size,
+    event_cache_size,
+    history_memo_size,
+):
+    processes = mode == "processes"
+    available = budget - process_base_bytes
+    if available <= 0:
+        raise ValueError(
+            f"A budget of {format_size(budget)} doesn't cover the {format_size(process_base_bytes)} one process needs"
+        )
+    store_bytes = num_maps * store_bytes_per_map
+    if mode == "stream" and store_bytes > available * store_share:
+        raise ValueError(
+            f"Stream mode needs the performance store, about {format_size(store_bytes)} for {num_maps} maps, "
+            + f"which doesn't fit in {format_size(budget)}. Use threads or processes mode"
+        )
+    # worker processes are forked from the process holding the store, and each copies part of it
+    store_copies = 1 + workers * forked_store_share if processes else 1
+    if history == "store" and store_bytes * store_copies > available * store_share:
+        history = "batched"
+    if mode == "stream":
+        history = "store"
+    shared_store_bytes = store_bytes if history == "store" else 0
+
+    row_bytes = num_features * 8 * row_overhead
+    checkpoint_interval = max(
+        1, min(checkpoint_interval, int(available * rows_share / row_bytes))
+    )
+    cache_entries = int(available * cache_share / cache_entry_bytes)
+    birth_year_cache_size = min(birth_year_cache_size, cache_entries)
+    event_cache_size = min(event_cache_size, max(1, cache_entries // 8))
+
+    def worker_bytes(batch_size, history_memo_size):
+        num_bytes = batch_size * map_doc_bytes + history_memo_size * memo_entry_bytes
+        if history == "batched":
+            num_bytes += batch_size * history_docs_per_map * store_bytes_per_map
+        if processes:
+            num_bytes += process_base_bytes
+            num_bytes += store_bytes * forked_store_share if history == "store" else 0
+        return num_bytes
+
+    worker_budget = (
+        available
+        - shared_store_bytes
+        - checkpoint_interval * row_bytes
+        - (birth_year_cache_size + event_cache_size) * cache_entry_bytes
+    )
+    while (
+        batch_size > 1 and worker_bytes(batch_size, history_memo_size) > worker_budget
+    ):
+        batch_size //= 2
+    while (
+        history_memo_size > 1
+        and worker_bytes(batch_size, history_memo_size) > worker_budget
+    ):
+        history_memo_size //= 2
+    if worker_bytes(batch_size, history_memo_size) > worker_budget:
+        raise ValueError(
+            f"A single worker needs about {format_size(worker_bytes(batch_size, history_memo_size))}, "
+            + f"more than the {format_size(max(worker_budget, 0))} left of {format_size(budget)}"
+        )
+    if mode != "stream":
+        workers = max(
+            1,
+            min(
+                workers,
+                int(worker_budget // worker_bytes(batch_size, history_memo_size)),
+            ),
+        )
+
+    return SimpleNamespace(
+        budget=budget,
+        history=history,
+        workers=workers,
+        batch_size=batch_size,
+        checkpoint_interval=checkpoint_interval,
+        cache_sizes={
+            "birth_years": birth_year_cache_size,
+            "event_stats": event_cache_size,
+            "history_memo": history_memo_size,
+        },
+        estimate={
+            "base": process_base_bytes,
+            "store": shared_store_bytes,
+            "rows": checkpoint_interval * row_bytes,
+            "caches": (birth_year_cache_size + event_cache_size) * cache_entry_bytes,
+            "workers": (1 if mode == "stream" else workers)
+            * worker_bytes(batch_size, history_memo_size),
+        },
+    )
+
+
+# sets the capacities of this process's caches, in the main process and in every worker process
+def apply_cache_sizes(cache_sizes):
+    import metadata_cache
+    import processing_helper
+
+    if "birth_years" in cache_sizes:
+        metadata_cache.birth_year_cache.max_size = cache_sizes["birth_years"]
+    if "event_stats" in cache_sizes:
+        metadata_cache.event_stats_cache.max_size = cache_sizes["event_stats"]
+    if "history_memo" in cache_sizes:
+        processing_helper.default_history_memo_size = cache_sizes["history_memo"]
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+# ru_maxrss is in KiB on Linux. the children's is the largest of the worker processes that have exited
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+# current and peak RSS, and when tracemalloc is tracing (--trace-allocations), the lines holding the most memory
+def memory_report(budget=None, top=10):
+    rss = rss_bytes()
+    report = {
+        "time": datetime.now().isoformat(),
+        "rss_mib": None if rss == None else round(rss / mib, 1),
+        "peak_rss_mib": round(peak_rss_bytes() / mib, 1),
+        "children_peak_rss_mib": round(
+            peak_rss_bytes(resource.RUSAGE_CHILDREN) / mib, 1
+        ),
+    }
+    if budget != None:
+        report["budget_mib"] = round(budget / mib, 1)
+        report["over_budget"] = rss != None and rss > budget
+    if tracemalloc.is_tracing():
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        report["traced_mib"] = round(traced / mib, 1)
+        report["traced_peak_mib"] = round(traced_peak / mib, 1)
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        report["top_allocations"] = [
+            {
+                "line": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_kib": round(stat.size / 1024, 1),
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics("lineno")[:top]
+        ]
+    return report
+
+
+# appends one JSON line per report
+def dump_memory_report(file_path, budget=None, top=10):
+    report = memory_report(budget, top)
+    with open(file_path, "a") as f:
+        f.write(json.dumps(report) + "\n")
+    if report.get("over_budget"):
+        print(
+            f"RSS of {report['rss_mib']} MiB is over the {report['budget_mib']} MiB memory budget"
+        )
+    return report
+
+
+def start_periodic_memory_report(file_path, interval, budget=None, top=10):
+    def report_loop():
+        while True:
+            time.sleep(interval)
+            dump_memory_report(file_path, budget, top)
+
+    threading.Thread(target=report_loop, daemon=True).start()
@@ -0,0 +1,126 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from database import LazyCollection
+from stage_timing import stage_timer
+
+# player and event metadata used by generate_data_point, cached by hltvId so the slice aggregations don't
+#  have to join the full player and event documents onto every map. caches are shared by the threads of a
+#  process; every worker process fills its own, and their hit counters are merged with the stage timings
+
+players = LazyCollection("players")
+events = LazyCollection("events")
+
+default_birth_year_cache_size = 65536
+default_event_cache_size = 8192
+
+# max observed team ranking. keep an eye on match rankings to see if any ever approach this
+#  as of 4/7/23, max observed ranking is 404
+max_ranking = 500
+
+
+class LRUCache:
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # the cached values of keys, and the keys that weren't cached
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+                else:
+                    missing.append(key)
+            self.hits += len(found)
+            self.misses += len(missing)
+        stage_timer.count(f"cache.{self.name}.hits", len(found))
+        stage_timer.count(f"cache.{self.name}.misses", len(missing))
+        return found, missing
+
+    def put_many(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else float("nan")
+
+
+birth_year_cache = LRUCache("birth_years", default_birth_year_cache_size)
+event_stats_cache = LRUCache("event_stats", default_event_cache_size)
+
+
+# hltvId -> birthYear (None if unknown) of the given players. joined_players are player documents that came
+#  with the map, which are cached as they are; otherwise uncached players are fetched in one query
+def get_birth_years(player_ids, joined_players=None):
+    if joined_players != None:
+        birth_years = {
+            player["hltvId"]: player["birthYear"] for player in joined_players
+        }
+        birth_year_cache.put_many(birth_years)
+        return birth_years
+    birth_years, missing = birth_year_cache.get_many(player_ids)
+    if len(missing) != 0:
+        loaded = {pid: None for pid in missing}
+        for player in players.find(
+            {"hltvId": {"$in": missing}}, {"hltvId": 1, "birthYear": 1, "_id": 0}
+        ):
+            loaded[player["hltvId"]] = player["birthYear"]
+        birth_year_cache.put_many(loaded)
+        birth_years |= loaded
+    return birth_years
+
+
+def compute_event_stats(event):
+    event_team_rankings = np.array(
+        list(
+            map(
+                # normalizes rankings by subtracting them by max observed ranking and turning to 0 if it's null
+                lambda ranking: max_ranking - ranking if ranking != None else 0,
+                event["teamRankings"],
+            )
+        )
+    )
+    return {
+        "hltvId": event["hltvId"],
+        "event_teamnum": event["teamNum"],
+        # mean and stdev of team rankings at event
+        "event_avg_rankings": np.mean(event_team_rankings),
+        "event_stdev_rankings": np.std(event_team_rankings),
+    }
+
+
+# the event features of an event. joined_events is the event lookup that came with the map, if it did,
+#  which replaces what's cached, since an upcoming event's rankings can still change
+def get_event_stats(event_id, joined_events=None):
+    if joined_events != None:
+        event_stats = compute_event_stats(joined_events[0])
+        event_stats_cache.put_many({event_stats["hltvId"]: event_stats})
+        return event_stats
+    found, missing = event_stats_cache.get_many([event_id])
+    if len(missing) == 0:
+        return found[event_id]
+    event = events.find_one(
+        {"hltvId": event_id},
+        {"hltvId": 1, "teamNum": 1, "teamRankings": 1, "_id": 0},
+    )
+    if event == None:
+        raise KeyError(f"No event with hltvId {event_id}")
+    event_stats = compute_event_stats(event)
+    event_stats_cache.put_many({event_id: event_stats})
+    return event_stats
@@ -0,0 +1,202 @@
+import threading
+import numpy as np
+from tqdm import tqdm
+
+from processing_helper import (
+    maps,
+    matches,
+    events,
+    max_threshold,
+    history_range_pipeline,
+    default_history_batch_size,
+)
+from stage_timing import stage_timer
+
+# stats the round/rating code never reads, dropped on load to keep the store small
+unused_player_stats = ["duelMap"]
+
+
+def compact_performance(performance):
+    for stats_key in ["teamOneStats", "teamTwoStats"]:
+        for player_stats in (performance.get(stats_key) or {}).values():
+            for unused_stat in unused_player_stats:
+                player_stats.pop(unused_stat, None)
+    return performance
+
+
+def to_datetime64(date):
+    return np.datetime64(date, "us")
+
+
+# held while a store builds the columns derived from it, see PerformanceStore.derived
+derived_lock = threading.Lock()
+
+
+# the performances of a store window, newest first, along with the store, their idxs in it and per player
+#  the [lo, hi) of the player's entries in player_idxs and their positions in the window, so code that knows
+#  the store can read the store's per-player columns for the window instead of the documents
+class PerformanceWindow(list):
+    def __init__(self, store, idxs, player_slices):
+        super().__init__(store.performances[idx] for idx in idxs)
+        self.store = store
+        self.idxs = idxs
+        self.player_slices = player_slices
+
+
+# map history held in memory and indexed per player by date, so that generate_data_point
+#  can take its history window without a maps.aggregate round trip per map
+class PerformanceStore:
+    def __init__(self, performances):
+        self.performances = sorted(performances, key=lambda p: p["date"])
+        player_idxs = {}
+        for idx, performance in enumerate(self.performances):
+            for pid in set(performance.get("players") or []):
+                player_idxs.setdefault(pid, []).append(idx)
+        self.player_idxs = {}
+        self.player_dates = {}
+        for pid, idxs in player_idxs.items():
+            idxs = np.array(idxs, dtype=np.int64)
+            self.player_idxs[pid] = idxs
+            self.player_dates[pid] = np.array(
+                [to_datetime64(self.performances[i]["date"]) for i in idxs],
+                dtype="datetime64[us]",
+            )
+        # key -> columns built from the whole store, see derived
+        self.derived_columns = {}
+
+    def __len__(self):
+        return len(self.performances)
+
+    # store idxs of the window, newest first, and per player of it that's in the store the [lo, hi) of their
+    #  entries in player_idxs and the positions of those performances in the window
+    def window_slices(self, player_ids, raw_date, threshold=max_threshold):
+        start = to_datetime64(raw_date - threshold)
+        end = to_datetime64(raw_date)
+        player_bounds = {}
+        idx_slices = []
+        for pid in player_ids:
+            pid = int(pid)
+            dates = self.player_dates.get(pid)
+            if dates is None or pid in player_bounds:
+                continue
+            lo = dates.searchsorted(start, side="left")
+            hi = dates.searchsorted(end, side="left")
+            player_bounds[pid] = (lo, hi)
+            idx_slices.append(self.player_idxs[pid][lo:hi])
+        if len(idx_slices) == 0:
+            return np.empty(0, dtype=np.int64), {}
+        # unique sorts ascending by index, which is ascending by date
+        idxs, inverse = np.unique(np.concatenate(idx_slices), return_inverse=True)
+        positions = len(idxs) - 1 - inverse
+        player_slices = {}
+        offset = 0
+        for pid, (lo, hi) in player_bounds.items():
+            player_slices[pid] = (lo, hi, positions[offset : offset + hi - lo])
+            offset += hi - lo
+        return idxs[::-1], player_slices
+
+    def window_idxs(self, player_ids, raw_date, threshold=max_threshold):
+        return self.window_slices(player_ids, raw_date, threshold)[0]
+
+    # equivalent of maps with date in [raw_date - threshold, raw_date) played by any of player_ids, sorted by date descending
+    def window(self, player_ids, raw_date, threshold=max_threshold):
+        return PerformanceWindow(
+            self, *self.window_slices(player_ids, raw_date, threshold)
+        )
+
+    # columns over every performance of the store, built by build(store) the first time key is asked for and
+    #  shared by every window from then on
+    def derived(self, key, build):
+        columns = self.derived_columns.get(key)
+        if columns == None:
+            with derived_lock:
+                columns = self.derived_columns.get(key)
+                if columns == None:
+                    columns = self.derived_columns[key] = build(self)
+        return columns
+
+    @classmethod
+    def load(cls, query={}):
+        print("Loading events and matches into performance store")
+        event_dict = {event["hltvId"]: event for event in events.find({})}
+        match_dict = {match["hltvId"]: match for match in matches.find({})}
+        performances = []
+        for performance in tqdm(
+            maps.find({"$and": [query, {"date": {"$ne": None}}]}),
+            total=maps.estimated_document_count(),
+            desc="Performance Store",
+            ncols=150,
+        ):
+            related_match = match_dict.get(performance.get("matchId"))
+            related_event = (
+                event_dict.get(related_match.get("eventId")) if related_match else None
+            )
+            # same shape as the matches/events $lookup stages
+            performance["match"] = [related_match] if related_match else []
+            performance["event"] = [related_event] if related_event else []
+            performances.append(compact_performance(performance))
+        store = cls(performances)
+        print(
+            f"Performance store loaded: {len(store)} maps, {len(store.player_idxs)} players"
+        )
+        return store
+
+    # the maps any of player_ids played in [start_date, end_date), joined like fetch_performances, in one query
+    @classmethod
+    def fetch(cls, player_ids, start_date, end_date):
+        with stage_timer.stage("fetch"):
+            performances = list(
+                maps.aggregate(
+                    history_range_pipeline(player_ids, start_date, end_date),
+                    allowDiskUse=True,
+                )
+            )
+        stage_timer.count("history_queries")
+        stage_timer.count("documents", len(performances))
+        return cls(performances)
+
+
+# the [start, end) window generate_data_point takes a played map's history over, and the players it takes it
+#  for. None for a map it would fail on before fetching, which is left to fail the same way on its own
+def history_key(curr_map):
+    try:
+        raw_date = curr_map["match"][0]["date"]
+        return (
+            raw_date - max_threshold,
+            raw_date,
+            [
+                int(pid)
+                for pid in list(curr_map["teamOneStats"].keys())
+                + list(curr_map["teamTwoStats"].keys())
+            ],
+        )
+    except Exception:
+        return None
+
+
+# pairs every map with a store holding at least its history. maps are taken batch_size at a time, and each
+#  batch's history is one query for the union of its players over the union of its windows, which
+#  PerformanceStore.window then cuts back down to each map's own [date - max_threshold, date) and roster
+def batch_histories(maps_to_process, batch_size=default_history_batch_size):
+    batch = []
+    for curr_map in maps_to_process:
+        batch.append(curr_map)
+        if len(batch) == batch_size:
+            yield from history_batch(batch)
+            batch = []
+    yield from history_batch(batch)
+
+
+def history_batch(batch):
+    keys = [history_key(curr_map) for curr_map in batch]
+    valid_keys = [key for key in keys if key != None]
+    store = None
+    if len(valid_keys) != 0:
+        player_ids = sorted(set(pid for _, _, ids in valid_keys for pid in ids))
+        store = PerformanceStore.fetch(
+            player_ids,
+            min(start for start, _, _ in valid_keys),
+            max(end for _, end, _ in valid_keys),
+        )
+    for curr_map, key in zip(batch, keys):
+        yield curr_map, store if key != None else None
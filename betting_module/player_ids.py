@@ -0,0 +1,53 @@
+import threading
+
+# hltv player ids interned to dense ints, so a team's roster can be held as a sorted tuple of small ints and
+#  overlaps and membership tests don't build sets out of string-keyed stat maps. ids are interned by their
+#  string form, the one the stat maps are keyed by, so 7 and "7" are the same player. dense ids only mean
+#  something inside the process that made them
+
+
+class PlayerIdTable:
+    def __init__(self):
+        # player id, as given and as a string -> dense id
+        self.ids = {}
+        self.num_ids = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.num_ids
+
+    def intern(self, player_id):
+        dense_id = self.ids.get(player_id)
+        if dense_id == None:
+            with self.lock:
+                dense_id = self.ids.get(str(player_id))
+                if dense_id == None:
+                    dense_id = self.ids[str(player_id)] = self.num_ids
+                    self.num_ids += 1
+                self.ids[player_id] = dense_id
+        return dense_id
+
+    # the dense ids of player_ids, sorted and without repeats
+    def roster(self, player_ids):
+        return tuple(sorted(set(self.intern(player_id) for player_id in player_ids)))
+
+    # number of players of roster among player_ids. player_ids are in the form the stat maps are keyed by, such
+    #  as a side's stats keys, so ids that were never interned can't be in it and aren't interned
+    def overlap(self, roster, player_ids):
+        return len(set(roster).intersection(map(self.ids.get, player_ids)))
+
+
+player_id_table = PlayerIdTable()
+
+
+def roster(player_ids):
+    return player_id_table.roster(player_ids)
+
+
+# number of players of a roster among player_ids, see PlayerIdTable.overlap
+def roster_overlap(roster, player_ids):
+    return player_id_table.overlap(roster, player_ids)
+
+
+def in_roster(roster, player_id):
+    return player_id_table.intern(player_id) in roster
@@ -1,10 +1,8 @@
 import sys
-import pandas as pd
-import tensorflow as tf
 from datetime import datetime
 
-from processing_helper import generate_data_point
-from learning_helper import process_frame
+from processing_helper import generate_data_point, new_history_memo
+from learning_helper import process_rows, load_model
 from services.unplayedmatch_service import (
     get_all_unplayed_matches,
     get_cached_predictions,
@@ -15,7 +13,6 @@ from services.unplayedmatch_service import (
 from services.map_service import maps_to_examine
 
 
-model_name = "prediction_model"
 csv_folder = "learning_data/"
 
 
@@ -50,11 +47,15 @@ def predict_match(match, map_infos=None, same_order=True, ignore_cache=False):
             print("Returning cached predictions...")
             return cached_predictions
     print("Generating new predictions...")
-    model = tf.keras.models.load_model(model_name)
+    model = load_model()
     map_predictions = {}
+    # every map info shares the match's roster and date, only the map conditions are redone per map
+    history_memo = new_history_memo()
     for i, map_info in enumerate(map_infos):
-        w = generate_data_point(match, played=False, map_info=map_info)
-        processed_w = process_frame(pd.DataFrame([w]))[0]
+        w = generate_data_point(
+            match, played=False, map_info=map_info, history_memo=history_memo
+        )
+        processed_w = process_rows([w])
         # print(processed_w)
         # with open("t.txt", "w") as f:
         #     f.write("\n".join(sorted(list(processed_w.columns))))
@@ -1,69 +1,76 @@
-import pymongo
 import json
 import atexit
 import threading
 import numpy as np
-import pandas as pd
-import time
-import os
-import threading
-import tensorflow as tf
+import argparse
+import tracemalloc
 from datetime import datetime
 from types import SimpleNamespace
-from processing_helper import process_maps, generate_data_point
-from predicting import process_frame
-
-client = pymongo.MongoClient(os.environ["MONGODB_URI"])
-db = client["scraped-hltv"]
-maps = db["maps"]
+from processing_helper import (
+    maps,
+    process_maps,
+    stream_maps,
+    generate_data_point,
+    lookup_aggregation,
+    date_order_pipeline,
+    load_feature_constants,
+    save_feature_constants,
+    new_history_memo,
+    default_history_memo_size,
+)
+from performance_store import PerformanceStore
+from processing_pool import process_pool
+from sliding_window import SlidingWindowFeatureBuilder, process_maps_stream
+from row_buffer import RowBuffer
+from checkpoint import (
+    FrameCheckpoint,
+    load_watermark,
+    save_watermark,
+    consolidate_chunk_threshold,
+)
+from frame_store import frame_exists
+from map_follower import follow_maps
+from metadata_cache import birth_year_cache, event_stats_cache
+from memory_budget import (
+    parse_size,
+    format_size,
+    plan_memory,
+    apply_cache_sizes,
+    dump_memory_report,
+    start_periodic_memory_report,
+)
+from stage_timing import stage_timer
+from feature_schema import feature_schema
+from learning_helper import process_rows, load_model
+from feature_families import (
+    stale_families,
+    needs_history,
+    recompute_families,
+    load_family_fingerprints,
+    save_family_fingerprints,
+)
 
 csv_folder = "learning_data/"
 
-lookup_aggregation = [
-    {
-        "$lookup": {
-            "from": "matches",
-            "localField": "matchId",
-            "foreignField": "hltvId",
-            "as": "match",
-        }
-    },
-    {
-        "$lookup": {
-            "from": "events",
-            "localField": "match.0.eventId",
-            "foreignField": "hltvId",
-            "as": "event",
-        }
-    },
-    {
-        "$lookup": {
-            "from": "players",
-            "localField": "players",
-            "foreignField": "hltvId",
-            "as": "players_info",
-        }
-    },
-]
-
 
 def predict_played_match(hltv_id):
     played_maps = list(
         maps.aggregate([{"$match": {"matchId": int(hltv_id)}}] + lookup_aggregation)
     )
-    return {m["mapType"]: predict_map(m, i) for i, m in enumerate(played_maps)}
-
-
-model_name = "prediction_model"
+    # the maps share the match's roster and date, so they share its history
+    history_memo = new_history_memo()
+    return {
+        m["mapType"]: predict_map(m, i, history_memo) for i, m in enumerate(played_maps)
+    }
 
 
-def predict_map(map, i):
-    model = tf.keras.models.load_model(model_name)
-    w = generate_data_point(map)
+def predict_map(map, i, history_memo=None):
+    model = load_model()
+    w = generate_data_point(map, history_memo=history_memo)
     same_order = w["winner"] == 1
     winner = w["winner"]
     del w["winner"]
-    processed_w = process_frame(pd.DataFrame([w]))[0]
+    processed_w = process_rows([w])
     processed_w.to_csv(csv_folder + f"w_{i}_played.csv")
     prediction = list(model.predict(processed_w.to_numpy())[0].round(5))
     # if not same_order:
@@ -72,169 +79,290 @@ def predict_map(map, i):
 
 
 if __name__ == "__main__":
-    frame_file_path = csv_folder + "frame.csv"
-    map_history_file_path = csv_folder + "processed-maps.json"
+    parser = argparse.ArgumentParser(
+        description="Builds the feature frame from scraped maps"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["threads", "processes", "stream"],
+        default="threads",
+        help="threads share one interpreter (and the GIL), processes use one Mongo client per worker and "
+        + "share the performance store loaded once before they start, stream walks the maps in date order on one thread, sliding a single history window along",
+    )
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=64,
+        help="maps fetched per query, and sent to a worker process at a time in processes mode",
+    )
+    parser.add_argument(
+        "--history",
+        choices=["store", "batched"],
+        default="store",
+        help="store loads every map into memory up front, batched fetches the histories of each batch of "
+        + "maps in one query instead (threads and processes modes)",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=2000,
+        help="number of new data points written to disk as one frame chunk",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=60,
+        help="seconds between stage timing and memory reports appended to their files",
+    )
+    parser.add_argument(
+        "--no-recompute",
+        action="store_true",
+        help="leaves the columns of feature families that changed since the frame was computed as they are",
+    )
+    parser.add_argument(
+        "--consolidate",
+        action="store_true",
+        help="merges the frame chunks into the frame at the end of the run, however few there are. otherwise "
+        + f"they're only merged past {consolidate_chunk_threshold} chunks",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only looks at maps past the hltvId watermark recorded by the last completed run, instead of the "
+        + "whole collection (pairs well with --history batched)",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="after processing, keeps following inserts into maps through a change stream (needs a replica "
+        + "set) and turns new maps into feature rows as their matches come in",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_size,
+        help="memory the run should fit in, such as 8G. lowers the workers, batch size, checkpoint interval "
+        + "and cache capacities to fit, and fetches histories in batches if the performance store doesn't",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="traces allocations with tracemalloc, so memory reports list the lines holding the most memory "
+        + "(slows processing down)",
+    )
+    args = parser.parse_args()
+
+    frame_path = csv_folder + "frame"
+    chunk_folder = csv_folder + "frame-chunks/"
+    processed_ids_file_path = csv_folder + "processed-ids.npy"
+    skipped_ids_file_path = csv_folder + "skipped-ids.npy"
+    stage_timings_file_path = csv_folder + "stage-timings.jsonl"
+    watermark_file_path = csv_folder + "watermark.json"
+    resume_token_file_path = csv_folder + "maps-resume-token.json"
+    memory_report_file_path = csv_folder + "memory-report.jsonl"
+
+    if args.trace_allocations:
+        tracemalloc.start()
+    if args.memory_budget != None:
+        try:
+            memory_plan = plan_memory(
+                args.memory_budget,
+                maps.estimated_document_count(),
+                feature_schema.num_features,
+                args.mode,
+                args.history,
+                args.workers,
+                args.batch_size,
+                args.checkpoint_interval,
+                birth_year_cache.max_size,
+                event_stats_cache.max_size,
+                default_history_memo_size,
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        args.history = memory_plan.history
+        args.workers = memory_plan.workers
+        args.batch_size = memory_plan.batch_size
+        args.checkpoint_interval = memory_plan.checkpoint_interval
+        apply_cache_sizes(memory_plan.cache_sizes)
+        print(
+            f"Fitting {format_size(args.memory_budget)}: {args.workers} workers, batches of {args.batch_size}, "
+            + f"{args.history} histories, chunks of {args.checkpoint_interval} rows, cache sizes "
+            + f"{memory_plan.cache_sizes}, estimated "
+            + ", ".join(
+                f"{name} {format_size(num_bytes)}"
+                for name, num_bytes in memory_plan.estimate.items()
+            )
+        )
+    cache_sizes = memory_plan.cache_sizes if args.memory_budget != None else {}
+
+    # a resumed run keeps the constants its earlier chunks were computed with
+    if load_feature_constants(csv_folder):
+        print("Feature constants loaded")
+    save_feature_constants(csv_folder)
 
     # we use this so that the matrix is mutated, not replaced, within threads
     feature_data = SimpleNamespace()
 
-    column_names = []
-
-    column_names.append("winner")
-    column_names.append("map_date")
-    column_names.append("online_bool")
-    column_names.append("event_teamnum")
-    column_names.append("event_avg_rankings")
-    column_names.append("event_stdev_rankings")
-    column_names.append("bestof")
-    column_names.append("map_id")
-    column_names.append("map_num")
-
-    # extremely flawed metric but
-    # column_names.append("match_category")
-
-    map_list = [
-        "Ancient",
-        "Anubis",
-        "Cache",
-        "Cobblestone",
-        "Dust2",
-        "Inferno",
-        "Mirage",
-        "Nuke",
-        "Overpass",
-        "Train",
-        "Vertigo",
-    ]
+    # only the processed-id bitmap is loaded on start, previous data points stay on disk
+    checkpoint = FrameCheckpoint(
+        chunk_folder, processed_ids_file_path, skipped_ids_file_path
+    )
+    checkpoint.seed_from_frame(frame_path)
+    print(
+        f"Resuming with {len(checkpoint.processed_ids)} maps already processed, "
+        + f"{len(checkpoint.skipped_ids)} skipped"
+    )
 
-    for map in map_list:
-        column_names.append(f"map_{map.lower()}_bool")
-
-    team_suffixes = ["team_one", "team_two"]
-    sides = ["ct", "t"]
-    stat_types = ["avg", "stdev"]
-
-    round_stats_columns = []
-    rating_stats_columns = []
-    for suffix in team_suffixes:
-        for side in sides:
-            column_names.append(f"team_avg_ratingvariance_{side}_{suffix}")
-            # probably redundant
-            column_names.append(f"individual_avg_rating_{side}_{suffix}")
-            column_names.append(f"individual_avg_ratingvariance_{side}_{suffix}")
-            column_names.append(f"total_avg_kast_{side}_{suffix}")
-            column_names.append(f"total_avg_fkdiff_{side}_{suffix}")
-
-            for type in stat_types:
-                round_stats_columns.append(f"round_{type}_{side}_{suffix}")
-                rating_stats_columns.append(f"rating_{type}_{side}_{suffix}")
-            column_names.append(f"map_score_{side}_{suffix}")
-        # shared between round stats and rating stats
-        rating_stats_columns.append(f"mapsplayed_avg_{suffix}")
-        column_names.append(f"ranking_{suffix}")
-        column_names.append(f"age_avg_{suffix}")
-        # column_names.append(f"total_wonduels_{suffix}")
-        column_names.append(f"timetogether_{suffix}")
-        column_names.append(f"lastwin_{suffix}")
-        column_names.append(f"lastloss_{suffix}")
-
-        # column_names.append(f"total_avg_awpkills_{suffix}")
-
-        column_names.append(f"total_avg_twinrate_{suffix}")
-        column_names.append(f"total_avg_ctwinrate_{suffix}")
-        column_names.append(f"total_avg_otwinrate_{suffix}")
-
-        column_names.append(f"map_pick_{suffix}")
-
-        column_names.append(f"map_score_ot_{suffix}")
-
-    matchup_category = "matchup"
-
-    stat_categories = ["rank", "map", "online", "event", matchup_category]
-
-    for category in stat_categories:
-        round_category_columns = [f"{col}_{category}" for col in round_stats_columns]
-        rating_category_columns = [f"{col}_{category}" for col in rating_stats_columns]
-        if category == matchup_category:
-            round_category_columns = [
-                col for col in round_category_columns if not team_suffixes[1] in col
-            ]
-        column_names += round_category_columns
-        column_names += rating_category_columns
-        # feature_data.matrix = np.empty([0, 630])
-        feature_data.frame = pd.DataFrame(columns=column_names)
-        feature_data.history = set()
-        # feature_data.history = None
+    # feature families that changed since the frame was computed have their columns recomputed for the maps
+    #  already in it, before new maps are added. a frame without recorded fingerprints is taken as current
+    recorded_fingerprints = load_family_fingerprints(csv_folder)
+    if recorded_fingerprints != None and not args.no_recompute:
+        stale = stale_families(recorded_fingerprints)
+        if len(stale) != 0:
+            checkpoint.consolidate(frame_path)
+        if len(stale) != 0 and frame_exists(frame_path):
+            print(f"Feature families changed since the frame was computed: {stale}")
+            recompute_families(
+                frame_path,
+                stale,
+                SlidingWindowFeatureBuilder(PerformanceStore.load())
+                if args.history == "store"
+                and any(needs_history(name) for name in stale)
+                else None,
+                args.batch_size,
+            )
+    if recorded_fingerprints == None or not args.no_recompute:
+        save_family_fingerprints(csv_folder)
+
+    # new data points are accumulated here and written out as a chunk every checkpoint interval
+    feature_data.rows = RowBuffer(
+        feature_schema.names,
+        checkpoint_size=args.checkpoint_interval,
+        on_checkpoint=checkpoint.write,
+    )
 
     with open("columns.txt", "w") as f:
-        f.write("\n".join(sorted(column_names)))
+        f.write("\n".join(feature_schema.names))
         print("E")
 
-    try:
-        feature_data.frame = pd.read_csv(frame_file_path, index_col=[0])
-        feature_data.history = set(feature_data.frame["map_id"])
-        print("Feature frame loaded, shape", feature_data.frame.shape)
-    except:
-        print(f"Unable to load frame from {frame_file_path}.")
-
     def save_frame():
-        print(f"Saving frame to {frame_file_path}, shape", feature_data.frame.shape)
-        feature_data.frame.sort_values(by=["map_id"], inplace=True)
-        feature_data.frame.to_csv(frame_file_path)
+        checkpoint.write(*feature_data.rows.drain())
+        checkpoint.consolidate(
+            frame_path, 1 if args.consolidate else consolidate_chunk_threshold
+        )
 
     start_time = datetime.now()
-    initial_map_num = len(feature_data.history or [])
 
     def print_process_rate():
         end_time = datetime.now()
         elapsed_time = end_time - start_time
         elapsed_time = elapsed_time.seconds / 60
-        feature_data.history = set(feature_data.frame["map_id"])
-        if feature_data.history != None:
-            final_map_num = len(feature_data.history)
-            maps_processed = final_map_num - initial_map_num
-            maps_per_minute = maps_processed / elapsed_time
-            print(f"Average of {maps_per_minute} processed per minute.")
+        maps_processed = len(feature_data.rows)
+        maps_per_minute = maps_processed / elapsed_time
+        print(f"Average of {maps_per_minute} processed per minute.")
+
+    def dump_stage_timings():
+        report = stage_timer.dump(stage_timings_file_path)
+        print("Stage timings:", json.dumps(report["total"], indent=2))
+        memory_report = dump_memory_report(memory_report_file_path, args.memory_budget)
+        print(
+            f"Peak RSS {memory_report['peak_rss_mib']} MiB, "
+            + f"worker processes {memory_report['children_peak_rss_mib']} MiB"
+        )
 
     atexit.register(save_frame)
     atexit.register(print_process_rate)
-
-    num_maps = maps.count_documents(
-        {"hltvId": {"$not": {"$in": list(feature_data.history or [])}}}
+    atexit.register(dump_stage_timings)
+    stage_timer.start_periodic_dump(stage_timings_file_path, args.report_interval)
+    start_periodic_memory_report(
+        memory_report_file_path, args.report_interval, args.memory_budget
     )
 
-    thread_num = 16
-
-    slice_size = np.ceil(num_maps / thread_num)
-
-    print(f"Processing {num_maps} maps in {thread_num} slices of {slice_size}")
-
-    frame_lock = threading.Lock()
-    history_lock = threading.Lock()
-    exit_lock = threading.Lock()
-
-    for i in range(thread_num):
-        maps_slice = list(
-            maps.aggregate(
-                [
-                    {
-                        "$match": {
-                            "hltvId": {
-                                "$not": {"$in": list(feature_data.history or [])}
-                            }
-                        }
-                    },
-                    {"$sort": {"hltvId": -1}},
-                    {"$skip": slice_size * i},
-                    {"$limit": slice_size},
-                ]
-                + lookup_aggregation,
+    watermark = load_watermark(watermark_file_path) if args.incremental else None
+    new_maps_filter = {} if watermark == None else {"hltvId": {"$gt": watermark}}
+    if watermark != None:
+        print(f"Looking at maps past hltvId {watermark}")
+    # sorted so the server reads the ids off the hltvId index instead of every map
+    all_map_ids = [
+        m["hltvId"]
+        for m in maps.find(new_maps_filter, {"hltvId": 1, "_id": 0}).sort("hltvId", 1)
+    ]
+    done_ids = checkpoint.done_ids()
+    unprocessed_filter = done_ids.pending_filter(all_map_ids)
+    if watermark != None:
+        unprocessed_filter = {"$and": [new_maps_filter, unprocessed_filter]}
+    # newest first, the order maps have always been processed in
+    pending_map_ids = done_ids.pending(all_map_ids)[::-1].tolist()
+
+    if args.mode == "processes":
+        print(
+            f"Processing {len(pending_map_ids)} maps with {args.workers} worker processes"
+        )
+        process_pool(
+            pending_map_ids,
+            feature_data,
+            args.workers,
+            args.batch_size,
+            performance_store=(
+                PerformanceStore.load() if args.history == "store" else None
+            ),
+            cache_sizes=cache_sizes,
+        )
+    elif args.mode == "stream":
+        num_maps = len(pending_map_ids)
+        print(f"Processing {num_maps} maps in date order")
+        window_builder = SlidingWindowFeatureBuilder(PerformanceStore.load())
+        # sorted on the match date, which is the date generate_data_point takes the window before
+        # the filter can be just the bounds of the pending ids, so done maps in between are skipped here
+        maps_to_process = (
+            curr_map
+            for curr_map in maps.aggregate(
+                date_order_pipeline(unprocessed_filter),
                 allowDiskUse=True,
+                batchSize=args.batch_size,
             )
+            if not curr_map["hltvId"] in done_ids
         )
-        # print([m["hltvId"] for m in maps_slice])
-        threading.Thread(
-            target=process_maps,
-            args=(maps_slice, frame_lock, feature_data, i),
-        ).start()
-        time.sleep(1)
+        process_maps_stream(maps_to_process, feature_data, window_builder, num_maps)
+    else:
+        num_maps = len(pending_map_ids)
+
+        thread_num = args.workers
+
+        print(f"Processing {num_maps} maps in {thread_num} hltvId ranges")
+
+        # loaded once and shared by every thread, instead of one history aggregation per map
+        performance_store = PerformanceStore.load() if args.history == "store" else None
+
+        # each thread gets a contiguous hltvId range holding an equal share of the pending maps, and streams
+        #  its ids in pages rather than loading the maps up front
+        threads = []
+        for i, slice_ids in enumerate(np.array_split(pending_map_ids, thread_num)):
+            if len(slice_ids) == 0:
+                continue
+            maps_slice = stream_maps(slice_ids, args.batch_size)
+            thread = threading.Thread(
+                target=process_maps,
+                args=(
+                    maps_slice,
+                    feature_data,
+                    i,
+                    performance_store,
+                    len(slice_ids),
+                    args.batch_size,
+                ),
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    # the next incremental run starts below the lowest map that failed or wasn't reached, so those are retried
+    checkpoint.write(*feature_data.rows.drain())
+    next_watermark = checkpoint.done_ids().watermark(all_map_ids)
+    if next_watermark != None:
+        save_watermark(watermark_file_path, next_watermark)
+
+    if args.follow:
+        follow_maps(feature_data, checkpoint, resume_token_file_path)
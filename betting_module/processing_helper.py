@@ -1,78 +1,123 @@
-import pymongo
 import os
-from dotenv import load_dotenv
+import json
 import numpy as np
 import pandas as pd
 import traceback
 from datetime import timedelta
+from types import SimpleNamespace
 from tqdm import tqdm
-
-load_dotenv()
-
-num_pools = 80
-
-client = pymongo.MongoClient(
-    os.environ["MONGODB_URI"], maxPoolSize=num_pools + 8, minPoolSize=num_pools
+from stage_timing import stage_timer
+from feature_schema import (
+    feature_schema,
+    map_list,
+    team_suffixes,
+    game_sides,
+    matchup_category,
+    category_stat_types,
+    winrate_stats,
 )
-print("Helper client connected")
-db = client["scraped-hltv"]
-maps = db["maps"]
-matches = db["matches"]
-events = db["events"]
-players = db["players"]
 
+from database import LazyCollection
+from metadata_cache import max_ranking, get_birth_years, get_event_stats, LRUCache
+from player_ids import (
+    roster,
+    roster_overlap,
+    in_roster,
+)
 
-month_delta = timedelta(days=1) * 30
+# resolved against the configured backend (see database.get_db) on first use
+maps = LazyCollection("maps")
+matches = LazyCollection("matches")
+events = LazyCollection("events")
+players = LazyCollection("players")
+
+
+# joins a map's match, event and player documents for generate_data_point. the event and player joins are
+#  optional, without them generate_data_point reads events and birth years through metadata_cache
+lookup_aggregation = [
+    {
+        "$lookup": {
+            "from": "matches",
+            "localField": "matchId",
+            "foreignField": "hltvId",
+            "as": "match",
+        }
+    },
+    {
+        "$lookup": {
+            "from": "events",
+            "localField": "match.0.eventId",
+            "foreignField": "hltvId",
+            "as": "event",
+        }
+    },
+    {
+        "$lookup": {
+            "from": "players",
+            "localField": "players",
+            "foreignField": "hltvId",
+            "as": "players_info",
+        }
+    },
+]
 
-max_threshold = 3 * month_delta
+# what the map slices processing.py streams join on: just the match, so every map doesn't carry a copy of
+#  its event and its players' documents
+slice_lookup_aggregation = lookup_aggregation[:1]
 
+# maps fetched per query when streaming them, see stream_maps
+map_batch_size = 64
 
-team_suffixes = ["team_one", "team_two"]
+# maps whose histories are fetched together when there's no performance store, see process_maps
+default_history_batch_size = 64
 
-game_sides = ["ct", "t"]
+month_delta = timedelta(days=1) * 30
 
-# These are the most common active duty maps, and the map_vector effectively creates a multi-classifier based on these
-map_list = [
-    "Ancient",
-    "Anubis",
-    "Cache",
-    "Cobblestone",
-    "Dust2",
-    "Inferno",
-    "Mirage",
-    "Nuke",
-    "Overpass",
-    "Train",
-    "Vertigo",
-]
+max_threshold = 3 * month_delta
 
 
+# same rounding as np.round(seconds, 5), which scales, rounds half to even and scales back, without the
+#  cost of a NumPy call per timing feature
 def quantize_timedelta(date):
-    return np.round(date.total_seconds(), 5)
+    return round(date.total_seconds() * 1e5) / 1e5
 
 
 def quantize_time(date):
     return np.round(date.timestamp(), 5)
 
 
-def get_map_vector(map_name):
-    map_dict = {f"map_{name.lower()}_bool": map_name in name for name in map_list}
-    return map_dict
+# constants features are computed with that depend on the data, kept with the frame they went into and with
+#  the model trained on it, so live features are computed the same way the training features were
+feature_constants_file_name = "feature-constants.json"
+feature_constants = {}
 
 
-# max observed team ranking. keep an eye on match rankings to see if any ever approach this
-#  as of 4/7/23, max observed ranking is 404
-max_ranking = 500
+def get_min_birth_year():
+    if not "min_birth_year" in feature_constants:
+        feature_constants["min_birth_year"] = (
+            players.find({"birthYear": {"$ne": None}})
+            .sort("birthYear")
+            .limit(1)
+            .next()["birthYear"]
+        )
+    return feature_constants["min_birth_year"]
 
 
-min_birth_year = (
-    players.find({"birthYear": {"$ne": None}})
-    .sort("birthYear")
-    .limit(1)
-    .next()["birthYear"]
-)
+# loads the constants saved in folder, if there are any. returns whether there were
+def load_feature_constants(folder):
+    file_path = os.path.join(folder, feature_constants_file_name)
+    if not os.path.exists(file_path):
+        return False
+    with open(file_path) as f:
+        feature_constants.update(json.load(f))
+    return True
+
+
+def save_feature_constants(folder):
+    get_min_birth_year()
+    with open(os.path.join(folder, feature_constants_file_name), "w") as f:
+        json.dump(feature_constants, f, indent=2)
 
-matchup_category = "matchup"
 
 # number of matches in a row a team needs to not play together to be marked as a roster change
 apart_threshold = 6
@@ -87,6 +132,36 @@ default_stdevs = {"round": 2.75, "rating": 0.4}
 default_rating_variance = 0.45
 default_side_winrate = 0.375
 
+# timing features, and the defaults they're left at where the history never sets them
+timing_prefixes = ["timetogether", "lastwin", "lastloss"]
+# (timing feature x team suffix) slots and defaults
+timing_slots = np.stack(
+    [feature_schema.team_slots[prefix] for prefix in timing_prefixes]
+)
+timing_defaults = np.repeat(
+    [[0], [default_last], [default_last]], len(team_suffixes), axis=1
+)
+category_default_stdevs = np.array(
+    [default_stdevs[type] for type in category_stat_types]
+)
+
+# generate_round_rating_stats is kept as the reference implementation of the vectorized kernel. the vectorized
+#  kernel and the sliding window builder give the same output as it does, for frames computed by either to
+#  match, which tests/test_kernels.py checks. that includes what it does with malformed performances, which
+#  is kept on purpose rather than fixed in one kernel only:
+#  (a) a performance where a lookup or computation raises (stats, scores or rosters that can't be read, a
+#      winrate over zero rounds, a condition that can't be evaluated) is printed and counted as a
+#      performance_error, and only its players walked before the error count: their values, timing results
+#      and conditions evaluated up to the one that raised are kept
+#  (b) a player whose stats raise partway keeps the values appended before the error
+#  (c) a window of other than ten players fails that assert for every performance, so none of them count
+#  (d) a None stat value makes np.mean raise, which fails the whole map
+#  (e) the overtime winrate is ot + 1 / (ot + away ot + 1), by operator precedence
+#  the vectorized kernel re-raises these where they happen, by redoing the list-based lookup that raised, and
+#  only reads the store's pack columns when none of them can happen in the window. the sliding window builder
+#  leaves windows where any of them can happen to the vectorized kernel
+use_vectorized_stats = True
+
 
 def generate_round_rating_stats(
     team_one_ids, team_two_ids, performances, condition_dict, raw_date
@@ -117,6 +192,8 @@ def generate_round_rating_stats(
                 "round": {"ct": [default_rounds], "t": [default_rounds]},
                 "rating": {"ct": [default_rating], "t": [default_rating]},
             }
+    team_one_roster = roster(team_one_ids)
+    team_two_roster = roster(team_two_ids)
     team_one_apart_maps = 0
     team_two_apart_maps = 0
     # add stats to list for each player
@@ -146,8 +223,9 @@ def generate_round_rating_stats(
                     if player_id in team_one_ids:
                         if not "timetogether_team_one" in results_dict:
                             if (
-                                intersection_length(
-                                    team_one_ids, performance[f"{team_key}Stats"].keys()
+                                roster_overlap(
+                                    team_one_roster,
+                                    performance[f"{team_key}Stats"].keys(),
                                 )
                                 != 5
                             ):
@@ -171,8 +249,9 @@ def generate_round_rating_stats(
                     elif player_id in team_two_ids:
                         if not "timetogether_team_two" in results_dict:
                             if (
-                                intersection_length(
-                                    team_two_ids, performance[f"{team_key}Stats"].keys()
+                                roster_overlap(
+                                    team_two_roster,
+                                    performance[f"{team_key}Stats"].keys(),
                                 )
                                 != 5
                             ):
@@ -260,6 +339,7 @@ def generate_round_rating_stats(
                                 ]
                             )
         except Exception as e:
+            stage_timer.count(f"performance_error.{type(e).__name__}")
             print(
                 "Error processing performance from map", performance["hltvId"], ":", e
             )
@@ -267,26 +347,30 @@ def generate_round_rating_stats(
     for player_id, player_stats in category_stats_dict.items():
         team_suffix = "team_one" if player_id in team_one_ids else "team_two"
         for category, category_stats in player_stats.items():
-            for type, type_stats in category_stats.items():
+            for stat_type, type_stats in category_stats.items():
                 if (
                     category == matchup_category
                     and team_suffix == "team_two"
-                    and type == "round"
+                    and stat_type == "round"
                 ):
                     continue
                 for side, side_stats in type_stats.items():
-                    results_key_mean = f"{type}_avg_{side}_{team_suffix}_{category}"
+                    results_key_mean = (
+                        f"{stat_type}_avg_{side}_{team_suffix}_{category}"
+                    )
                     if not results_key_mean in results_dict:
                         results_dict[results_key_mean] = []
                     results_dict[results_key_mean].append(np.mean(side_stats))
 
-                    results_key_stdev = f"{type}_stdev_{side}_{team_suffix}_{category}"
+                    results_key_stdev = (
+                        f"{stat_type}_stdev_{side}_{team_suffix}_{category}"
+                    )
                     if not results_key_stdev in results_dict:
                         results_dict[results_key_stdev] = []
                     results_dict[results_key_stdev].append(
                         np.std(side_stats)
                         if len(side_stats) > 2
-                        else default_stdevs[type]
+                        else default_stdevs[stat_type]
                     )
 
             results_key_mapsplayed = f"mapsplayed_avg_{team_suffix}_{category}"
@@ -360,25 +444,758 @@ def generate_round_rating_stats(
     return results_dict
 
 
+# sided stats collected per player, in the order of the vectorized kernel's stat axis
+sided_stats = ["kast", "rating", "fkDiff"]
+# defaults prepended to each category's (type x side) lists
+category_defaults = np.array(
+    [[default_rounds, default_rounds], [default_rating, default_rating]]
+)
+# sided stats (stat x side), then winrates, then category values (type x side)
+packed_value_num = (
+    len(sided_stats) * len(game_sides)
+    + len(winrate_stats)
+    + len(category_stat_types) * len(game_sides)
+)
+# where the sided stats and the winrates end in the packed values
+sided_end = len(sided_stats) * len(game_sides)
+winrate_end = sided_end + len(winrate_stats)
+# defaults prepended to the lists of the sided stats, then of the winrates
+side_value_defaults = np.array(
+    [default_side_stat] * sided_end + [default_side_winrate] * len(winrate_stats)
+)
+
+
+# appends a (performance, player)'s packed values in order, stopping wherever the list-based code would raise,
+#  see (b) above
+def append_packed_values(values, player_stats, team_score, away_team_score):
+    for stat in sided_stats:
+        for side in game_sides:
+            values.append(player_stats[f"{side}Stats"][stat])
+    values.append(team_score["t"] / (team_score["t"] + away_team_score["ct"]))
+    values.append(team_score["ct"] / (team_score["ct"] + away_team_score["t"]))
+    values.append(team_score["ot"] + 1 / (team_score["ot"] + away_team_score["ot"] + 1))
+    values.append(team_score["ct"])
+    values.append(team_score["t"])
+    values.append(player_stats["ctStats"]["rating"])
+    values.append(player_stats["tStats"]["rating"])
+
+
+# side of a performance a player is on (see ConditionWindow.player_sides), looked up as
+#  generate_round_rating_stats does, so it raises where that does
+def player_side(performance, player_id):
+    if player_id in performance["teamOneStats"].keys():
+        return 1
+    if player_id in performance["teamTwoStats"].keys():
+        return 2
+    return 0
+
+
+# which side of each performance every player is on, and the index of the player whose lookup raised, if one
+#  did
+def performance_player_sides(performances, player_ids):
+    player_sides = np.zeros((len(performances), len(player_ids)), dtype=np.int8)
+    side_errors = np.full(len(performances), len(player_ids), dtype=np.int64)
+    for p, performance in enumerate(performances):
+        for j, player_id in enumerate(player_ids):
+            try:
+                player_sides[p, j] = player_side(performance, player_id)
+            except Exception:
+                side_errors[p] = j
+                break
+    return player_sides, side_errors
+
+
+# the values append_packed_values would append for every player of a performance, keyed by the player's
+#  int id, with the side they're on. raises wherever pack_window could: a side's stats, rosters or scores that
+#  can't be read, a value that can't be computed or is None, a player on both sides or ids that don't match
+#  the performance's players
+def performance_pack_values(performance):
+    player_values = {}
+    for side, team_key, away_key in [
+        (1, "teamOne", "teamTwo"),
+        (2, "teamTwo", "teamOne"),
+    ]:
+        team_score = performance["score"][team_key]
+        away_team_score = performance["score"][away_key]
+        for player_id, player_stats in performance[f"{team_key}Stats"].items():
+            pid = int(player_id)
+            if str(pid) != player_id or pid in player_values:
+                raise ValueError(f"player id {player_id}")
+            values = []
+            append_packed_values(values, player_stats, team_score, away_team_score)
+            if None in values:
+                raise TypeError("None stat value")
+            player_values[pid] = (side, np.array(values, dtype=np.float64))
+    if set(player_values) != set(performance.get("players") or []):
+        raise ValueError("stats don't match players")
+    return player_values
+
+
+# side (see ConditionWindow.player_sides) of a player of a performance that isn't clean, 0 if the stats can't
+#  be read
+def stats_side(performance, player_id):
+    try:
+        if player_id in (performance.get("teamOneStats") or {}):
+            return 1
+        if player_id in (performance.get("teamTwoStats") or {}):
+            return 2
+    except Exception:
+        pass
+    return 0
+
+
+# the columns pack_window reads, over every performance of a store: per player, aligned with the store's
+#  player_idxs, the side they were on and their packed values, and per performance whether it's clean (nothing
+#  in it raises, see performance_pack_values) and its outcome for team one (1 won, -1 lost, 0 drew). sides
+#  are filled in for performances that aren't clean too, for the roster timelines
+def build_pack_columns(store):
+    clean = np.zeros(len(store), dtype=np.bool_)
+    outcomes = np.zeros(len(store), dtype=np.int8)
+    sides = {
+        pid: np.zeros(len(idxs), dtype=np.int8)
+        for pid, idxs in store.player_idxs.items()
+    }
+    values = {
+        pid: np.zeros((len(idxs), packed_value_num))
+        for pid, idxs in store.player_idxs.items()
+    }
+    # position of the next performance in each player's columns
+    positions = dict.fromkeys(store.player_idxs, 0)
+    for idx, performance in enumerate(store.performances):
+        players = set(performance.get("players") or [])
+        try:
+            player_values = performance_pack_values(performance)
+            team_score = performance["score"]["teamOne"]
+            away_team_score = performance["score"]["teamTwo"]
+            home_score = team_score["ct"] + team_score["t"] + team_score["ot"]
+            away_score = (
+                away_team_score["ct"] + away_team_score["t"] + away_team_score["ot"]
+            )
+            outcomes[idx] = (home_score > away_score) - (away_score > home_score)
+        except Exception:
+            player_values = None
+        clean[idx] = player_values != None
+        for pid in players:
+            if player_values != None:
+                side, player_pack_values = player_values[pid]
+                sides[pid][positions[pid]] = side
+                values[pid][positions[pid]] = player_pack_values
+            else:
+                sides[pid][positions[pid]] = stats_side(performance, str(pid))
+            positions[pid] += 1
+    return SimpleNamespace(clean=clean, outcomes=outcomes, sides=sides, values=values)
+
+
+# sides, packed values and outcomes of a store window's performances, gathered from the store's pack columns
+#  by slicing each player's columns. None unless pack_window can take them instead of walking the documents:
+#  ten players in two teams of five, all of them the window's players, and performances that are all clean
+def window_pack_columns(performances, player_ids, num_team_one):
+    store = getattr(performances, "store", None)
+    if store == None or len(player_ids) != 10 or num_team_one != 5:
+        return None
+    pids = [int(player_id) for player_id in player_ids if player_id.isdigit()]
+    if [str(pid) for pid in pids] != player_ids:
+        return None
+    pack_columns = store.derived("pack_columns", build_pack_columns)
+    if not pack_columns.clean[performances.idxs].all():
+        return None
+    sides = np.zeros((len(performances), len(player_ids)), dtype=np.int8)
+    values = np.zeros((len(performances), len(player_ids), packed_value_num))
+    for j, pid in enumerate(pids):
+        player_slice = performances.player_slices.get(pid)
+        if player_slice == None:
+            if pid in store.player_idxs:
+                return None
+            continue
+        lo, hi, positions = player_slice
+        sides[positions, j] = pack_columns.sides[pid][lo:hi]
+        values[positions, j] = pack_columns.values[pid][lo:hi]
+    return SimpleNamespace(
+        sides=sides,
+        values=values,
+        outcomes=pack_columns.outcomes[performances.idxs],
+    )
+
+
+# the ConditionWindow of a history, with its sides and packed values from the store's pack columns where
+#  window_pack_columns gives them, and from the documents otherwise
+def condition_window(performances, player_ids, num_team_one):
+    pack_columns = window_pack_columns(performances, player_ids, num_team_one)
+    if pack_columns != None:
+        return ConditionWindow(
+            performances,
+            player_ids,
+            num_team_one,
+            pack_columns.sides,
+            np.full(len(performances), len(player_ids), dtype=np.int64),
+            pack_columns,
+        )
+    player_sides, side_errors = performance_player_sides(performances, player_ids)
+    return ConditionWindow(
+        performances, player_ids, num_team_one, player_sides, side_errors
+    )
+
+
+# first pass of the vectorized kernel: walks the performances once, in the same order and with the same
+#  per-performance error handling as generate_round_rating_stats, then packs every value it would have
+#  appended into (performances x players x ...) arrays with matching masks. conditions are evaluated
+#  up front over the whole window by condition_masks. with a history from history_memo, the window and the
+#  packing are reused by every map of the match that has the same team order and condition validity
+def pack_round_rating_stats(
+    team_one_ids, team_two_ids, performances, condition_dict, raw_date, history=None
+):
+    player_ids = team_one_ids + team_two_ids
+    conditions = list(condition_dict.values())
+    windows = history.windows if history != None else {}
+    window_key = (tuple(team_one_ids), tuple(team_two_ids))
+    window = windows.get(window_key)
+    if window == None:
+        window = windows[window_key] = condition_window(
+            performances, player_ids, len(team_one_ids)
+        )
+    masks, valids = condition_masks(condition_dict, window)
+    # the packing loop only looks at the conditions to raise where one of them does
+    pack_key = (valids.shape, np.packbits(valids).tobytes())
+    packed = window.packs.get(pack_key)
+    if packed == None:
+        packed = window.packs[pack_key] = pack_window(
+            window, conditions, valids, raw_date
+        )
+    category_mask = masks & (
+        np.arange(len(conditions)) < packed.condition_counts[:, :, None]
+    )
+    return SimpleNamespace(**vars(packed), category_mask=category_mask)
+
+
+# the packing loop of pack_round_rating_stats: everything it packs except which categories each value falls
+#  in, which comes from the masks of the conditions and the number of them each (performance, player)
+#  evaluated, 0 where no row was reached. windows where none of the kept error behaviors above can happen are
+#  packed from the store's columns instead, the rest are walked here
+def pack_window(window, conditions, valids, raw_date):
+    if (
+        window.pack_columns != None
+        and (valids.all(axis=-1) | (window.player_sides == 0)).all()
+    ):
+        return pack_window_columns(window, len(conditions), raw_date)
+    performances = window.performances
+    player_ids = window.player_ids
+    num_team_one = window.num_team_one
+    player_sides = window.player_sides
+    side_errors = window.side_errors
+    team_rosters = window.team_rosters
+    all_valid = valids.all(axis=-1)
+    results_dict = {}
+    apart_maps = [0, 0]
+    timetogether_keys = [f"timetogether_{suffix}" for suffix in team_suffixes]
+    lastwin_keys = [f"lastwin_{suffix}" for suffix in team_suffixes]
+    lastloss_keys = [f"lastloss_{suffix}" for suffix in team_suffixes]
+    # one row per (performance, player) that was reached: [p, j, values in the order of append_packed_values,
+    #  number of conditions evaluated]. rows are registered before they're filled, so a performance that
+    #  raises keeps what was appended before it did
+    rows = []
+    for p, performance in enumerate(performances):
+        try:
+            assert len(player_ids) == 10
+            # roster overlap with each side of this performance, per team suffix
+            overlaps = {}
+            for j, player_id in enumerate(player_ids):
+                if j == side_errors[p]:
+                    # kept error behavior (a), re-raised here
+                    player_side(performance, player_id)
+                side = player_sides[p, j]
+                if side == 0:
+                    continue
+                team_key = "teamOne" if side == 1 else "teamTwo"
+                away_key = "teamTwo" if side == 1 else "teamOne"
+                team_score = performance["score"][team_key]
+                away_team_score = performance["score"][away_key]
+                home_score = team_score["ct"] + team_score["t"] + team_score["ot"]
+                away_score = (
+                    away_team_score["ct"] + away_team_score["t"] + away_team_score["ot"]
+                )
+                suffix_idx = 0 if j < num_team_one else 1
+                if not timetogether_keys[suffix_idx] in results_dict:
+                    if (suffix_idx, team_key) not in overlaps:
+                        overlaps[(suffix_idx, team_key)] = roster_overlap(
+                            team_rosters[suffix_idx],
+                            performance[f"{team_key}Stats"].keys(),
+                        )
+                    if overlaps[(suffix_idx, team_key)] != 5:
+                        apart_maps[suffix_idx] += 1
+                    else:
+                        apart_maps[suffix_idx] = 0
+                    if apart_maps[suffix_idx] >= apart_threshold:
+                        results_dict[
+                            timetogether_keys[suffix_idx]
+                        ] = quantize_timedelta(raw_date - performance["date"])
+                if not lastwin_keys[suffix_idx] in results_dict:
+                    if home_score > away_score:
+                        results_dict[lastwin_keys[suffix_idx]] = quantize_timedelta(
+                            raw_date - performance["date"]
+                        )
+                if not lastloss_keys[suffix_idx] in results_dict:
+                    if away_score > home_score:
+                        results_dict[lastloss_keys[suffix_idx]] = quantize_timedelta(
+                            raw_date - performance["date"]
+                        )
+
+                values = []
+                row = [p, j, values, 0]
+                rows.append(row)
+                player_stats = performance[f"{team_key}Stats"][player_id]
+                try:
+                    ct_stats = player_stats["ctStats"]
+                    t_stats = player_stats["tStats"]
+                    values += [
+                        ct_stats["kast"],
+                        t_stats["kast"],
+                        ct_stats["rating"],
+                        t_stats["rating"],
+                        ct_stats["fkDiff"],
+                        t_stats["fkDiff"],
+                        team_score["t"] / (team_score["t"] + away_team_score["ct"]),
+                        team_score["ct"] / (team_score["ct"] + away_team_score["t"]),
+                        # kept error behavior (e)
+                        team_score["ot"]
+                        + 1 / (team_score["ot"] + away_team_score["ot"] + 1),
+                        team_score["ct"],
+                        team_score["t"],
+                        ct_stats["rating"],
+                        t_stats["rating"],
+                    ]
+                except Exception:
+                    # kept error behavior (b), redone one value at a time
+                    append_packed_values(
+                        values, player_stats, team_score, away_team_score
+                    )
+                if all_valid[p, j]:
+                    row[3] = len(conditions)
+                else:
+                    row[3] = int(np.argmin(valids[p, j]))
+                    # kept error behavior (a), re-raised here
+                    conditions[row[3]](performance, player_id)
+        except Exception as e:
+            stage_timer.count(f"performance_error.{type(e).__name__}")
+            print(
+                "Error processing performance from map", performance["hltvId"], ":", e
+            )
+
+    num_rows = len(rows)
+    row_values = np.zeros((num_rows, packed_value_num))
+    row_value_mask = np.zeros((num_rows, packed_value_num), dtype=np.bool_)
+    # kept error behavior (d), tracked so the reduction raises as np.mean does
+    missing_value = False
+    for r, (_, _, values, _) in enumerate(rows):
+        if None in values:
+            missing_value = True
+            values = [np.nan if value is None else value for value in values]
+        row_values[r, : len(values)] = values
+        row_value_mask[r, : len(values)] = True
+    p_idxs = np.array([row[0] for row in rows], dtype=np.int64)
+    j_idxs = np.array([row[1] for row in rows], dtype=np.int64)
+
+    def scatter(row_array, value_shape, dtype=np.float64):
+        packed_array = np.zeros(
+            (len(performances), len(player_ids)) + value_shape, dtype=dtype
+        )
+        packed_array[p_idxs, j_idxs] = row_array.reshape((num_rows,) + value_shape)
+        return packed_array
+
+    category_shape = (len(category_stat_types), len(game_sides))
+    return SimpleNamespace(
+        side_values=scatter(row_values[:, :winrate_end], (winrate_end,)),
+        side_value_mask=scatter(
+            row_value_mask[:, :winrate_end], (winrate_end,), np.bool_
+        ),
+        category_values=scatter(row_values[:, winrate_end:], category_shape),
+        missing_value=missing_value,
+        results_dict=results_dict,
+        condition_counts=scatter(
+            np.array([row[3] for row in rows], dtype=np.int64), (), np.int64
+        ),
+    )
+
+
+# pack_window for windows with pack columns where no condition raises, so nothing is dropped: every present
+#  player gets a row with all its values and conditions, timetogether is read from the store's roster
+#  timelines and the other timing features are found from the sides and outcomes rather than walked player by
+#  player
+def pack_window_columns(window, num_conditions, raw_date):
+    from roster_timeline import store_roster_timeline
+
+    performances = window.performances
+    sides = window.player_sides
+    outcomes = window.pack_columns.outcomes[:, None, None]
+    present = sides != 0
+    # (performances x team suffix x player)
+    team_sides = sides.reshape(
+        len(performances), len(team_suffixes), sides.shape[1] // len(team_suffixes)
+    )
+    team_present = present.reshape(team_sides.shape)
+    team_outcomes = np.where(team_sides == 1, outcomes, -outcomes)
+    # (timing feature x performances x team suffix), for the timing features after timetogether
+    reached = np.array(
+        [
+            (team_present & (team_outcomes > 0)).any(axis=2),
+            (team_present & (team_outcomes < 0)).any(axis=2),
+        ]
+    )
+    results_dict = {}
+    roster_timeline = store_roster_timeline(performances.store)
+    for suffix, team_ids in zip(
+        team_suffixes,
+        [
+            window.player_ids[: window.num_team_one],
+            window.player_ids[window.num_team_one :],
+        ],
+    ):
+        time_together = roster_timeline.time_together(team_ids, raw_date)
+        if time_together != None:
+            results_dict[f"timetogether_{suffix}"] = time_together
+    if len(performances) != 0:
+        first_reached = reached.argmax(axis=1).tolist()
+        any_reached = reached.any(axis=1).tolist()
+        for t, prefix in enumerate(timing_prefixes[1:]):
+            for suffix_idx, suffix in enumerate(team_suffixes):
+                if any_reached[t][suffix_idx]:
+                    p = first_reached[t][suffix_idx]
+                    results_dict[f"{prefix}_{suffix}"] = quantize_timedelta(
+                        raw_date - performances[p]["date"]
+                    )
+
+    values = window.pack_columns.values
+    return SimpleNamespace(
+        side_values=values[:, :, :winrate_end],
+        # left to broadcast over the values, which is all the reductions need
+        side_value_mask=present[:, :, None],
+        category_values=values[:, :, winrate_end:].reshape(
+            sides.shape + (len(category_stat_types), len(game_sides))
+        ),
+        missing_value=False,
+        results_dict=results_dict,
+        condition_counts=np.where(present, num_conditions, 0),
+    )
+
+
+# mean and population stdev over each masked list, with the default value prepended like the list-based code
+def masked_mean_std(values, mask, defaults):
+    counts = mask.sum(axis=0) + 1
+    means = (np.where(mask, values, 0).sum(axis=0) + defaults) / counts
+    sq_devs = (
+        np.where(mask, (values - means) ** 2, 0).sum(axis=0) + (defaults - means) ** 2
+    )
+    return means, np.sqrt(sq_devs / counts), counts
+
+
+# second pass of the vectorized kernel: masked reductions over the performance axis,
+#  then the team-wise aggregation generate_round_rating_stats does with dicts of lists
+def reduce_round_rating_stats(packed, team_one_ids, category_names):
+    if packed.missing_value:
+        raise TypeError("None stat value in performance history")
+
+    # (players, categories, type, side), with the counts broadcast over type and side
+    category_means, category_stdevs, category_counts = masked_mean_std(
+        packed.category_values[:, :, None],
+        packed.category_mask[:, :, :, None, None],
+        category_defaults,
+    )
+    side_means, side_stdevs, _ = masked_mean_std(
+        packed.side_values, packed.side_value_mask, side_value_defaults
+    )
+    # (players, stat, side)
+    sided_shape = (len(side_means), len(sided_stats), len(game_sides))
+    sided_means = side_means[:, :sided_end].reshape(sided_shape)
+    sided_stdevs = side_stdevs[:, :sided_end].reshape(sided_shape)
+    winrate_means = side_means[:, sided_end:]
+    return aggregate_round_rating_stats(
+        packed.results_dict,
+        len(team_one_ids),
+        category_names,
+        category_means,
+        category_stdevs,
+        category_counts[:, :, 0, 0],
+        sided_means,
+        sided_stdevs,
+        winrate_means,
+    )
+
+
+# team-wise aggregation of per-player stats, shared by the vectorized kernel and the sliding window builder.
+#  category arrays are (players x categories x type x side), counts include the prepended default, sided
+#  arrays are (players x stat x side) and winrate means are (players x winrate stat). results are written
+#  into a feature row through the schema's slot tables, on top of the timing features in results_dict
+def aggregate_round_rating_stats(
+    results_dict,
+    num_team_one,
+    category_names,
+    category_means,
+    category_stdevs,
+    category_counts,
+    sided_means,
+    sided_stdevs,
+    winrate_means,
+):
+    row = feature_schema.row(results_dict)
+    # each team's players are reduced over their slice, into (suffix x ...) arrays written through the
+    #  schema's slot tables
+    team_slices = [slice(0, num_team_one), slice(num_team_one, None)]
+    team_sizes = np.array([num_team_one, len(category_means) - num_team_one])
+
+    def team_sums(values):
+        return np.array([values[players].sum(axis=0) for players in team_slices])
+
+    # np.mean is the sum divided by the size
+    def team_means(values):
+        sums = team_sums(values)
+        return sums / team_sizes.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+    category_stdevs = np.where(
+        (category_counts > 2)[:, :, None, None],
+        category_stdevs,
+        category_default_stdevs[:, None],
+    )
+    category_slots, value_idxs, mapsplayed_slots = feature_schema.category_table(
+        tuple(category_names)
+    )
+    # (suffix x categories x type x stat type x side), in the order of the schema's category value indices
+    team_category_values = team_means(
+        np.stack([category_means, category_stdevs], axis=3)
+    )
+    row.set_slots(category_slots, team_category_values.ravel()[value_idxs])
+    row.set_slots(mapsplayed_slots, team_means(category_counts))
+
+    unassigned = ~row.assigned[timing_slots]
+    row.set_slots(timing_slots[unassigned], timing_defaults[unassigned])
+
+    sided_slots = feature_schema.sided_slots
+    kast_idx = sided_stats.index("kast")
+    rating_idx = sided_stats.index("rating")
+    fkdiff_idx = sided_stats.index("fkDiff")
+    row.set_slots(feature_schema.winrate_slots, team_sums(winrate_means))
+    team_sided_totals = team_sums(sided_means)
+    # (players x side)
+    avg_ratings = sided_means[:, rating_idx]
+    team_avg_ratings = team_means(avg_ratings)
+    # np.std of each team's ratings, from the same sums np.std takes. teams of two or less take the stdev of
+    #  the default alone, which is 0
+    rating_devs = avg_ratings - np.repeat(team_avg_ratings, team_sizes, axis=0)
+    rating_variances = np.sqrt(team_means(rating_devs * rating_devs))
+    rating_variances[team_sizes <= 2] = 0
+    row.set_slots(sided_slots["team_avg_ratingvariance"], rating_variances)
+    row.set_slots(sided_slots["individual_avg_rating"], team_avg_ratings)
+    row.set_slots(
+        sided_slots["individual_avg_ratingvariance"],
+        team_means(sided_stdevs[:, rating_idx]),
+    )
+    row.set_slots(sided_slots["total_avg_kast"], team_sided_totals[:, kast_idx])
+    row.set_slots(sided_slots["total_avg_fkdiff"], team_sided_totals[:, fkdiff_idx])
+    return row
+
+
+# same output as generate_round_rating_stats, but reduces NumPy arrays instead of nested dicts of lists
+def generate_round_rating_stats_vectorized(
+    team_one_ids, team_two_ids, performances, condition_dict, raw_date, history=None
+):
+    # the list-based code keys its stats by player id, so repeated ids are left to it
+    if len(set(team_one_ids + team_two_ids)) != len(team_one_ids + team_two_ids):
+        return generate_round_rating_stats(
+            team_one_ids, team_two_ids, performances, condition_dict, raw_date
+        )
+    with stage_timer.stage("accumulation"):
+        packed = pack_round_rating_stats(
+            team_one_ids, team_two_ids, performances, condition_dict, raw_date, history
+        )
+    with stage_timer.stage("aggregation"):
+        return reduce_round_rating_stats(
+            packed, team_one_ids, list(condition_dict.keys())
+        )
+
+
+# per-performance columns and player sides of a history window, shared by every condition's mask
+class ConditionWindow:
+    def __init__(
+        self,
+        performances,
+        player_ids,
+        num_team_one,
+        player_sides,
+        side_errors=None,
+        pack_columns=None,
+    ):
+        self.performances = performances
+        self.player_ids = player_ids
+        self.num_team_one = num_team_one
+        self.team_rosters = [
+            roster(player_ids[:num_team_one]),
+            roster(player_ids[num_team_one:]),
+        ]
+        # (performances x players), 0 if absent, 1 if in teamOneStats, 2 if in teamTwoStats
+        self.player_sides = player_sides
+        self.side_errors = side_errors
+        # sides, packed values and outcomes from window_pack_columns, if it gave them
+        self.pack_columns = pack_columns
+        self.columns = {}
+        # condition validity -> pack_window result, see pack_round_rating_stats
+        self.packs = {}
+
+    @property
+    def shape(self):
+        return self.player_sides.shape
+
+    # extracts one value per performance, with whether extracting it raised, cached by key
+    def column(self, key, extract):
+        if not key in self.columns:
+            self.columns[key] = extract_column(self.performances, extract)
+        return self.columns[key]
+
+    # column, with the values converted to an array by to_array. store windows take theirs from the column
+    #  built over the whole store
+    def array_column(self, key, extract, to_array):
+        store = getattr(self.performances, "store", None)
+        if store == None:
+            values, valid = self.column(key, extract)
+            return to_array(values), valid
+        values, valid = store_column(store, key, extract, to_array)
+        return values[self.performances.idxs], valid[self.performances.idxs]
+
+
+# array_column over every performance of the store
+def store_column(store, key, extract, to_array):
+    return store.derived(
+        ("column", key),
+        lambda store: extract_array_column(store.performances, extract, to_array),
+    )
+
+
+# one value per performance, None where extracting it raised, and whether it didn't
+def extract_column(performances, extract):
+    values = []
+    valid = np.ones(len(performances), dtype=np.bool_)
+    for p, performance in enumerate(performances):
+        try:
+            values.append(extract(performance))
+        except Exception:
+            values.append(None)
+            valid[p] = False
+    return values, valid
+
+
+def extract_array_column(performances, extract, to_array):
+    values, valid = extract_column(performances, extract)
+    return to_array(values), valid
+
+
+def object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+# a condition that only depends on the performance, so its mask is evaluated once per performance
+#  rather than once per player. still callable as condition(performance, pid) like the original lambdas
+class PerformanceCondition:
+    def test(self, performance):
+        raise NotImplementedError
+
+    # conditions of the same type and parameters accept the same performances, so they share window columns
+    def __eq__(self, other):
+        return type(self) == type(other) and vars(self) == vars(other)
+
+    def __hash__(self):
+        return hash((type(self), tuple(sorted(vars(self).items()))))
+
+    def __call__(self, performance, pid):
+        return self.test(performance)
+
+    def evaluate(self, window):
+        values, valid = window.column(self, self.test)
+        mask = np.array([bool(value) for value in values], dtype=np.bool_)
+        return mask, valid
+
+
+# a condition comparing one field of the performance to the condition's value. every condition on the field
+#  shares its window column, whatever its value
+class FieldCondition(PerformanceCondition):
+    field = None
+
+    @staticmethod
+    def extract(performance):
+        raise NotImplementedError
+
+    def value(self):
+        raise NotImplementedError
+
+    def test(self, performance):
+        return self.extract(performance) == self.value()
+
+    # key, extract and to_array of the condition's array_column
+    @classmethod
+    def column_spec(cls):
+        return cls.field, cls.extract, object_array
+
+    def evaluate(self, window):
+        values, valid = window.array_column(*self.column_spec())
+        mask = (values == self.value()) & valid
+        return mask, valid
+
+
+class MapCondition(FieldCondition):
+    field = "mapType"
+
+    def __init__(self, map_name):
+        self.map_name = map_name
+
+    @staticmethod
+    def extract(performance):
+        return performance["mapType"]
+
+    def value(self):
+        return self.map_name
+
+
+class OnlineCondition(FieldCondition):
+    field = "online"
+
+    def __init__(self, online):
+        self.online = online
+
+    @staticmethod
+    def extract(performance):
+        return performance["match"][0]["online"]
+
+    def value(self):
+        return self.online
+
+
+class EventCondition(FieldCondition):
+    field = "eventId"
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+
+    @staticmethod
+    def extract(performance):
+        return performance["match"][0]["eventId"]
+
+    def value(self):
+        return self.event_id
+
+
 def map_condition(map_name):
-    return lambda performance, pid: performance["mapType"] == map_name
+    return MapCondition(map_name)
 
 
 def online_condition(online):
-    return lambda performance, pid: performance["match"][0]["online"] == online
+    return OnlineCondition(online)
 
 
 def event_condition(event_id):
-    return lambda performance, pid: performance["match"][0]["eventId"] == event_id
+    return EventCondition(event_id)
 
 
 ranking_threshold = 4
 
 
-def intersection_length(lst1, lst2):
-    return len(list(set(lst1) & set(lst2)))
-
-
 def correct_ranking(home_ranking, away_ranking, relative_ranking_int):
     if relative_ranking_int == 0:
         if np.abs(home_ranking - away_ranking) < ranking_threshold:
@@ -392,16 +1209,32 @@ def correct_ranking(home_ranking, away_ranking, relative_ranking_int):
     return False
 
 
-def rank_condition(team_one_ids, team_one_ranking, team_two_ranking):
-    # 1 if team1 higher than team2, 0 if theyre similar, -1 if team2 higher than team1
-    relative_ranking = 0
-    if team_one_ranking - team_two_ranking > ranking_threshold:
-        relative_ranking = 1
-    elif team_one_ranking - team_two_ranking < -1 * ranking_threshold:
-        relative_ranking = -1
+# correct_ranking over arrays of home and away rankings and relative ranking ints
+def correct_ranking_mask(home_rankings, away_rankings, relative_ranking_ints):
+    ranking_diffs = home_rankings - away_rankings
+    return np.where(
+        relative_ranking_ints == 0,
+        np.abs(ranking_diffs) < ranking_threshold,
+        np.where(
+            relative_ranking_ints == 1,
+            ranking_diffs > ranking_threshold,
+            ranking_diffs < -1 * ranking_threshold,
+        ),
+    )
+
+
+class RankCondition:
+    def __init__(self, team_one_ids, team_one_ranking, team_two_ranking):
+        self.team_one_roster = roster(team_one_ids)
+        # 1 if team1 higher than team2, 0 if theyre similar, -1 if team2 higher than team1
+        self.relative_ranking = 0
+        if team_one_ranking - team_two_ranking > ranking_threshold:
+            self.relative_ranking = 1
+        elif team_one_ranking - team_two_ranking < -1 * ranking_threshold:
+            self.relative_ranking = -1
 
     # returns true if a given performance can be used in either teams history against their opposing team's rank
-    def valid_ranking_performance(performance, pid):
+    def __call__(self, performance, pid):
         home_team_key = None
         away_team_key = None
         if pid in performance["teamOneStats"].keys():
@@ -415,28 +1248,233 @@ def rank_condition(team_one_ids, team_one_ranking, team_two_ranking):
         return correct_ranking(
             performance[f"{home_team_key}Ranking"] or max_ranking,
             performance[f"{away_team_key}Ranking"] or max_ranking,
-            relative_ranking if pid in team_one_ids else -1 * relative_ranking,
+            self.relative_ranking
+            if in_roster(self.team_one_roster, pid)
+            else -1 * self.relative_ranking,
         )
 
-    return valid_ranking_performance
+    @staticmethod
+    def extract_rankings(performance):
+        return (
+            performance["teamOneRanking"] or max_ranking,
+            performance["teamTwoRanking"] or max_ranking,
+        )
+
+    @staticmethod
+    def rankings_array(values):
+        return np.array(
+            [
+                value if value != None else (max_ranking, max_ranking)
+                for value in values
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+
+    @classmethod
+    def column_spec(cls):
+        return "rankings", cls.extract_rankings, cls.rankings_array
+
+    def evaluate(self, window):
+        rankings, valid = window.array_column(*self.column_spec())
+        sides = window.player_sides
+        home_rankings = np.where(sides == 2, rankings[:, 1:2], rankings[:, 0:1])
+        away_rankings = np.where(sides == 2, rankings[:, 0:1], rankings[:, 1:2])
+        relative_rankings = np.where(
+            np.arange(sides.shape[1]) < window.num_team_one,
+            self.relative_ranking,
+            -1 * self.relative_ranking,
+        )
+        mask = (sides != 0) & correct_ranking_mask(
+            home_rankings, away_rankings, relative_rankings[None, :]
+        )
+        # absent players return False before the rankings are read
+        return mask, valid[:, None] | (sides == 0)
+
+
+class MatchupCondition(PerformanceCondition):
+    def __init__(self, team_one_ids, team_two_ids):
+        self.team_one_roster = roster(team_one_ids)
+        self.team_two_roster = roster(team_two_ids)
+
+    def test(self, performance):
+        return (
+            roster_overlap(self.team_one_roster, performance["teamOneStats"].keys())
+            >= 3
+            and roster_overlap(self.team_two_roster, performance["teamTwoStats"].keys())
+            >= 3
+        ) or (
+            roster_overlap(self.team_one_roster, performance["teamTwoStats"].keys())
+            >= 3
+            and roster_overlap(self.team_two_roster, performance["teamOneStats"].keys())
+            >= 3
+        )
+
+    # windows with pack columns have every player's side, so the overlaps are counted from them when the
+    #  window's teams are the condition's
+    def evaluate(self, window):
+        if window.pack_columns == None or window.team_rosters != [
+            self.team_one_roster,
+            self.team_two_roster,
+        ]:
+            return super().evaluate(window)
+        # (performances x team suffix) players on each side, the teams being five each with pack columns
+        team_sides = window.player_sides.reshape(
+            len(window.performances), 2, window.player_sides.shape[1] // 2
+        )
+        team_one_counts = (team_sides == 1).sum(axis=2) >= 3
+        team_two_counts = (team_sides == 2).sum(axis=2) >= 3
+        mask = (team_one_counts[:, 0] & team_two_counts[:, 1]) | (
+            team_two_counts[:, 0] & team_one_counts[:, 1]
+        )
+        return mask, np.ones(len(mask), dtype=np.bool_)
+
+
+def rank_condition(team_one_ids, team_one_ranking, team_two_ranking):
+    return RankCondition(team_one_ids, team_one_ranking, team_two_ranking)
 
 
 def matchup_condition(team_one_ids, team_two_ids):
-    return lambda performance, pid: (
-        intersection_length(team_one_ids, performance["teamOneStats"].keys()) >= 3
-        and intersection_length(team_two_ids, performance["teamTwoStats"].keys()) >= 3
-    ) or (
-        intersection_length(team_one_ids, performance["teamTwoStats"].keys()) >= 3
-        and intersection_length(team_two_ids, performance["teamOneStats"].keys()) >= 3
+    return MatchupCondition(team_one_ids, team_two_ids)
+
+
+# builds the columns store windows read up front: the pack columns and the column of every condition with a
+#  column_spec. processes forked after it share them rather than each building its own
+def build_store_columns(store):
+    store.derived("pack_columns", build_pack_columns)
+    for condition_type in [
+        MapCondition,
+        OnlineCondition,
+        EventCondition,
+        RankCondition,
+    ]:
+        store_column(store, *condition_type.column_spec())
+
+
+# fallback for plain condition(performance, pid) callables: called once per present player
+def scalar_condition_mask(condition, window):
+    mask = np.zeros(window.shape, dtype=np.bool_)
+    valid = np.ones(window.shape, dtype=np.bool_)
+    for p, j in zip(*np.nonzero(window.player_sides)):
+        try:
+            mask[p, j] = condition(window.performances[p], window.player_ids[j])
+        except Exception:
+            valid[p, j] = False
+    return mask, valid
+
+
+# evaluates every category's condition over a window into (performances x players x categories) masks,
+#  with whether evaluating it would have raised for that performance and player
+def condition_masks(condition_dict, window):
+    masks = np.zeros(window.shape + (len(condition_dict),), dtype=np.bool_)
+    valids = np.zeros(masks.shape, dtype=np.bool_)
+    for c, condition in enumerate(condition_dict.values()):
+        if hasattr(condition, "evaluate"):
+            mask, valid = condition.evaluate(window)
+        else:
+            mask, valid = scalar_condition_mask(condition, window)
+        # conditions that only depend on the performance give one value per performance
+        masks[:, :, c] = mask if mask.ndim == 2 else mask[:, None]
+        valids[:, :, c] = valid if valid.ndim == 2 else valid[:, None]
+    return masks, valids
+
+
+# every map any of the given players played in [start_date, end_date), newest first. the $match only needs the
+#  (players, date) index of maps once the server moves it ahead of the lookups, which
+#  benchmarks/query_plan_benchmark.py checks
+def history_range_pipeline(player_ids, start_date, end_date):
+    return [
+        {
+            "$lookup": {
+                "from": "matches",
+                "localField": "matchId",
+                "foreignField": "hltvId",
+                "as": "match",
+            }
+        },
+        {
+            "$lookup": {
+                "from": "events",
+                "localField": "match.0.eventId",
+                "foreignField": "hltvId",
+                "as": "event",
+            }
+        },
+        {
+            "$match": {
+                "$and": [
+                    {"date": {"$lt": end_date}},
+                    {"date": {"$gte": start_date}},
+                    {"players": {"$in": [int(pid) for pid in player_ids]}},
+                ]
+            }
+        },
+        {"$sort": {"date": -1}},
+    ]
+
+
+def history_pipeline(player_ids, raw_date):
+    return history_range_pipeline(player_ids, raw_date - max_threshold, raw_date)
+
+
+# fetches every map any of the given players played in the max_threshold window before raw_date, newest first
+def fetch_performances(player_ids, raw_date):
+    return list(maps.aggregate(history_pipeline(player_ids, raw_date)))
+
+
+# histories kept by a history memo. every map of a series has the same ten players and cutoff date, and an
+#  unplayed match is predicted once per candidate map, so a memo lives as long as a match is being processed
+default_history_memo_size = 8
+
+
+def new_history_memo(max_size=None):
+    return LRUCache(
+        "history_memo", default_history_memo_size if max_size == None else max_size
     )
 
 
-def generate_data_point(curr_map, played=True, map_info=None):
+# the history window of a roster before raw_date, memoized in history_memo (if given) along with the condition
+#  windows and packings the vectorized kernel builds on it. the history keeps performance_store alive, so its
+#  id can't be reused while it's memoized
+def match_history(history_ids, raw_date, performance_store=None, history_memo=None):
+    key = (id(performance_store), frozenset(history_ids), raw_date)
+    if history_memo != None:
+        found, _ = history_memo.get_many([key])
+        if key in found:
+            return found[key]
+    with stage_timer.stage("fetch"):
+        performances = (
+            performance_store.window(history_ids, raw_date)
+            if performance_store != None
+            else fetch_performances(history_ids, raw_date)
+        )
+    stage_timer.count("documents", len(performances))
+    history = SimpleNamespace(
+        performance_store=performance_store, performances=performances, windows={}
+    )
+    if history_memo != None:
+        history_memo.put_many({key: history})
+    return history
+
+
+# winner picks which side of a played map is team one (1 for teamOne), at random if it isn't given. without
+#  with_history only the features that don't need the map's history are filled in
+def generate_data_point(
+    curr_map,
+    played=True,
+    map_info=None,
+    performance_store=None,
+    window_builder=None,
+    history_memo=None,
+    winner=None,
+    with_history=True,
+):
     try:
-        w = {}
+        w = feature_schema.new_row()
         related_match = curr_map["match"][0] if played else None
-        related_event = curr_map["event"][0]
-        winner = np.random.randint(2) if played else 1
+        if not played:
+            winner = 1
+        elif winner == None:
+            winner = np.random.randint(2)
         raw_date = related_match["date"] if played else curr_map["date"]
         map_name = curr_map["mapType"] if played else map_info["map_name"]
         # TODO: deceiving, since sometimes match id if unplaeyd
@@ -464,27 +1502,21 @@ def generate_data_point(curr_map, played=True, map_info=None):
         )
         if len(team_one_ids) != 5 or len(team_two_ids) != 5:
             # print(w["map_id"], "Non-five team sizes")
+            stage_timer.count("skipped.team_size")
             return None
+        team_one_roster = roster(team_one_ids)
+        team_two_roster = roster(team_two_ids)
         online = related_match["online"] if played else curr_map["online"]
         w["online_bool"] = online
-        w["event_teamnum"] = related_event["teamNum"]
         w["bestof"] = related_match["numMaps"] if played else curr_map["numMaps"]
         # w["match_category"] = related_match["matchTypeCategory"]
-        event_team_rankings = np.array(
-            list(
-                map(
-                    # normalizes rankings by subtracting them by max observed ranking and turning to 0 if it's null
-                    lambda ranking: max_ranking - ranking if ranking != None else 0,
-                    related_event["teamRankings"],
-                )
-            )
+        event_stats = get_event_stats(
+            related_match.get("eventId") if played else curr_map.get("eventId"),
+            curr_map.get("event"),
         )
-        # mean and stdev of team rankings at event
-        event_team_rankings_analyzed = {
-            "event_avg_rankings": np.mean(event_team_rankings),
-            "event_stdev_rankings": np.std(event_team_rankings),
-        }
-        w |= event_team_rankings_analyzed
+        w["event_teamnum"] = event_stats["event_teamnum"]
+        w["event_avg_rankings"] = event_stats["event_avg_rankings"]
+        w["event_stdev_rankings"] = event_stats["event_stdev_rankings"]
 
         ranking_one = (
             max_ranking - curr_map["teamOneRanking"]
@@ -499,6 +1531,7 @@ def generate_data_point(curr_map, played=True, map_info=None):
         w["ranking_team_one"] = ranking_one if winner == 1 else ranking_two
         w["ranking_team_two"] = ranking_two if winner == 1 else ranking_one
 
+        min_birth_year = get_min_birth_year()
         team_one_ages = [default_birth_year - min_birth_year]
         team_two_ages = [default_birth_year - min_birth_year]
 
@@ -512,79 +1545,75 @@ def generate_data_point(curr_map, played=True, map_info=None):
 
         w["map_num"] = curr_map.get("mapNum", 0) if played else map_info["map_num"]
 
-        for player in (
-            curr_map["players_info"]
-            if played
-            else curr_map["players_info_first"] + curr_map["players_info_second"]
-        ):
-            if player["birthYear"] != None:
-                adjusted_birth_year = player["birthYear"] - min_birth_year
-                if str(player["hltvId"]) in team_one_ids:
-                    team_one_ages.append(adjusted_birth_year)
-                elif str(player["hltvId"]) in team_two_ids:
-                    team_two_ages.append(adjusted_birth_year)
+        with stage_timer.stage("players_info"):
+            birth_years = (
+                get_birth_years(
+                    curr_map.get("players", []), curr_map.get("players_info")
+                )
+                if played
+                else get_birth_years(
+                    None,
+                    curr_map["players_info_first"] + curr_map["players_info_second"],
+                )
+            )
+            for player_id, birth_year in birth_years.items():
+                if birth_year != None:
+                    adjusted_birth_year = birth_year - min_birth_year
+                    if in_roster(team_one_roster, player_id):
+                        team_one_ages.append(adjusted_birth_year)
+                    elif in_roster(team_two_roster, player_id):
+                        team_two_ages.append(adjusted_birth_year)
 
         w["age_avg_team_one"] = np.mean(team_one_ages)
         w["age_avg_team_two"] = np.mean(team_two_ages)
 
-        w |= get_map_vector(map_name)
-
-        performances = list(
-            maps.aggregate(
-                [
-                    {
-                        "$lookup": {
-                            "from": "matches",
-                            "localField": "matchId",
-                            "foreignField": "hltvId",
-                            "as": "match",
-                        }
-                    },
-                    {
-                        "$lookup": {
-                            "from": "events",
-                            "localField": "match.0.eventId",
-                            "foreignField": "hltvId",
-                            "as": "event",
-                        }
-                    },
-                    {
-                        "$match": {
-                            "$and": [
-                                {"date": {"$lt": raw_date}},
-                                {"date": {"$gte": raw_date - max_threshold}},
-                                {
-                                    "players": {
-                                        "$in": [
-                                            int(pid)
-                                            for pid in team_one_ids + team_two_ids
-                                        ]
-                                    }
-                                },
-                            ]
-                        }
-                    },
-                    {"$sort": {"date": -1}},
-                ]
-            )
-        )
-
-        # print(f"ID: {w['map_id']}, performance #: {len(performances)}")
+        w.set_slots(feature_schema.map_slots, [map_name in name for name in map_list])
+
+        if with_history:
+            condition_dict = {
+                matchup_category: matchup_condition(team_one_ids, team_two_ids),
+                "map": map_condition(map_name),
+                "online": online_condition(online),
+                "event": event_condition(event_stats["hltvId"]),
+                "rank": rank_condition(
+                    team_one_ids, w["ranking_team_one"], w["ranking_team_two"]
+                ),
+            }
 
-        condition_dict = {
-            matchup_category: matchup_condition(team_one_ids, team_two_ids),
-            "map": map_condition(map_name),
-            "online": online_condition(online),
-            "event": event_condition(related_event["hltvId"]),
-            "rank": rank_condition(
-                team_one_ids, w["ranking_team_one"], w["ranking_team_two"]
-            ),
-        }
+            if window_builder != None:
+                with stage_timer.stage("stats"):
+                    results_data = window_builder.round_rating_stats(
+                        team_one_ids, team_two_ids, condition_dict, raw_date
+                    )
+            else:
+                history = match_history(
+                    team_one_ids + team_two_ids,
+                    raw_date,
+                    performance_store,
+                    history_memo,
+                )
 
-        results_data = generate_round_rating_stats(
-            team_one_ids, team_two_ids, performances, condition_dict, raw_date
-        )
-        w |= results_data
+                # print(f"ID: {w['map_id']}, performance #: {len(history.performances)}")
+
+                with stage_timer.stage("stats"):
+                    if use_vectorized_stats:
+                        results_data = generate_round_rating_stats_vectorized(
+                            team_one_ids,
+                            team_two_ids,
+                            history.performances,
+                            condition_dict,
+                            raw_date,
+                            history=history,
+                        )
+                    else:
+                        results_data = generate_round_rating_stats(
+                            team_one_ids,
+                            team_two_ids,
+                            history.performances,
+                            condition_dict,
+                            raw_date,
+                        )
+            w |= results_data
 
         if played:
             team_one_score = (
@@ -606,27 +1635,119 @@ def generate_data_point(curr_map, played=True, map_info=None):
 
         return w
     except Exception as e:
+        stage_timer.count(f"failure.{type(e).__name__}")
         print("Unable to process map id", curr_map["hltvId"])
         print(traceback.format_exc())
         return None
 
 
-def process_maps(maps_to_process, frame_lock, feature_data, thread_idx):
+def is_complete_data_point(w, num_columns):
+    if w == None:
+        stage_timer.count("incomplete.none")
+        print("None datapoint")
+        return False
+    if len(w) < num_columns:
+        stage_timer.count("incomplete.partial")
+        print("Partial datapoint for map id", w["map_id"], "with length", len(w))
+        return False
+    return True
+
+
+# whether a map without a complete data point would never get one: its teams don't have five players, or its
+#  row is missing features. maps that failed, such as ones whose match isn't scraped yet, are left for later
+#  runs to retry
+def is_permanent_skip(curr_map, w):
+    if w != None:
+        return True
+    try:
+        return len(curr_map["teamOneStats"]) != 5 or len(curr_map["teamTwoStats"]) != 5
+    except (KeyError, TypeError):
+        return False
+
+
+# appends a map's data point to rows, or records the map as skipped if no later run would get one either
+def add_data_point(rows, curr_map, w):
+    if is_complete_data_point(w, len(rows.column_names)):
+        with stage_timer.stage("append"):
+            rows.append(w)
+    elif is_permanent_skip(curr_map, w):
+        rows.skip(curr_map["hltvId"])
+
+
+# streams the maps of map_ids, newest first, with their lookups, one page of batch_size ids at a time. the ids
+#  are the pending ones from the processed-id bitmap, so a page is an $in of known ids rather than a filter
+#  the server plans again for every page, and only one page is held in memory
+def stream_maps(map_ids, batch_size=map_batch_size):
+    for start in range(0, len(map_ids), batch_size):
+        page_ids = [int(map_id) for map_id in map_ids[start : start + batch_size]]
+        yield from list(
+            maps.aggregate(
+                [
+                    {"$match": {"hltvId": {"$in": page_ids}}},
+                    {"$sort": {"hltvId": -1}},
+                ]
+                + slice_lookup_aggregation,
+                allowDiskUse=True,
+            )
+        )
+
+
+# the maps of map_ids with their lookups, in the order of map_ids rather than newest first, paged as in
+#  stream_maps. ids whose map is gone are left out
+def stream_maps_in_order(map_ids, batch_size=map_batch_size):
+    for start in range(0, len(map_ids), batch_size):
+        page_ids = [int(map_id) for map_id in map_ids[start : start + batch_size]]
+        page = {
+            curr_map["hltvId"]: curr_map
+            for curr_map in stream_maps(page_ids, batch_size)
+        }
+        yield from (page[map_id] for map_id in page_ids if map_id in page)
+
+
+# the maps matching match_filter with their match, in match date order (hltvId breaking ties), which is the
+#  order a sliding history window walks them in. the match date is looked up, so the server sorts in memory
+def date_order_pipeline(match_filter):
+    return (
+        [{"$match": match_filter}]
+        + slice_lookup_aggregation
+        + [{"$sort": {"match.date": 1, "hltvId": 1}}]
+    )
+
+
+# without a performance_store, the maps' histories are fetched history_batch_size maps at a time, see
+#  performance_store.batch_histories
+def process_maps(
+    maps_to_process,
+    feature_data,
+    thread_idx,
+    performance_store=None,
+    num_maps=None,
+    history_batch_size=default_history_batch_size,
+):
+    from performance_store import batch_histories
+
     # print(f"New map processor started: [{thread_idx}]")
-    for map_idx in tqdm(
-        range(len(maps_to_process)), desc=f"Map Processor [{thread_idx}]", ncols=150
+    if num_maps == None and hasattr(maps_to_process, "__len__"):
+        num_maps = len(maps_to_process)
+    maps_to_process = stage_timer.timed(maps_to_process, "map_fetch")
+    map_histories = (
+        ((curr_map, performance_store) for curr_map in maps_to_process)
+        if performance_store != None
+        else batch_histories(maps_to_process, history_batch_size)
+    )
+    history_memo = new_history_memo()
+    for curr_map, history_store in tqdm(
+        map_histories,
+        total=num_maps,
+        desc=f"Map Processor [{thread_idx}]",
+        ncols=150,
     ):
-        curr_map = maps_to_process[map_idx]
         # print(f"[{thread_idx}] Processing map ID:", curr_map["hltvId"])
-        w = generate_data_point(curr_map)
-        if w == None or len(w.keys()) < feature_data.frame.shape[1]:
-            if w == None:
-                print("None datapoint")
-            else:
-                print(
-                    "Partial datapoint for map id", w["map_id"], "with length", len(w)
-                )
-            continue
-        with frame_lock:
-            feature_data.frame.loc[len(feature_data.frame.index)] = w
+        stage_timer.count("maps")
+        with stage_timer.stage("data_point"):
+            w = generate_data_point(
+                curr_map, performance_store=history_store, history_memo=history_memo
+            )
+        add_data_point(feature_data.rows, curr_map, w)
+    feature_data.rows.flush()
     print(f"[{thread_idx}] Done processing maps")
@@ -0,0 +1,114 @@
+import gc
+import os
+import multiprocessing
+from types import SimpleNamespace
+from tqdm import tqdm
+
+from processing_helper import (
+    maps,
+    slice_lookup_aggregation,
+    generate_data_point,
+    is_complete_data_point,
+    is_permanent_skip,
+    feature_constants,
+    new_history_memo,
+    build_store_columns,
+)
+from performance_store import batch_histories
+from stage_timing import stage_timer
+from memory_budget import apply_cache_sizes
+
+# with a performance store the workers are forked, so they share the parent's store (and its columns)
+#  copy-on-write instead of each loading their own. database drops the parent's Mongo client in
+#  a forked child, so every worker still owns its own. without one they're spawned, and each imports
+#  processing_helper fresh
+fork_context = multiprocessing.get_context("fork")
+spawn_context = multiprocessing.get_context("spawn")
+
+default_batch_size = 64
+
+# per-process state, filled in by init_worker
+worker_data = SimpleNamespace(performance_store=None)
+
+
+def init_worker(performance_store, parent_feature_constants, cache_sizes):
+    stage_timer.reset()
+    # so workers don't each query the constants again
+    feature_constants.update(parent_feature_constants)
+    apply_cache_sizes(cache_sizes)
+    worker_data.performance_store = performance_store
+
+
+# runs in a worker, returns (map id, data point, whether it's skipped for good if incomplete) for one batch of
+#  map ids, with the stage timings recorded while building them. without a store the batch's histories are
+#  fetched in one query
+def process_map_batch(map_ids):
+    data_points = []
+    batch_maps = stage_timer.timed(
+        maps.aggregate(
+            [{"$match": {"hltvId": {"$in": map_ids}}}] + slice_lookup_aggregation,
+            allowDiskUse=True,
+        ),
+        "map_fetch",
+    )
+    map_histories = (
+        ((curr_map, worker_data.performance_store) for curr_map in batch_maps)
+        if worker_data.performance_store != None
+        else batch_histories(batch_maps, len(map_ids))
+    )
+    history_memo = new_history_memo()
+    for curr_map, history_store in map_histories:
+        stage_timer.count("maps")
+        with stage_timer.stage("data_point"):
+            w = generate_data_point(
+                curr_map, performance_store=history_store, history_memo=history_memo
+            )
+        data_points.append((curr_map["hltvId"], w, is_permanent_skip(curr_map, w)))
+    return data_points, os.getpid(), stage_timer.take()
+
+
+def batch_map_ids(map_ids, batch_size=default_batch_size):
+    return [map_ids[i : i + batch_size] for i in range(0, len(map_ids), batch_size)]
+
+
+# feeds map id batches to worker_num processes; the calling process is the only writer to feature_data.rows.
+#  with performance_store, the workers take their histories from it, otherwise they fetch them per batch
+def process_pool(
+    map_ids,
+    feature_data,
+    worker_num,
+    batch_size=default_batch_size,
+    performance_store=None,
+    cache_sizes={},
+):
+    num_columns = len(feature_data.rows.column_names)
+    mp_context = spawn_context
+    if performance_store != None:
+        mp_context = fork_context
+        build_store_columns(performance_store)
+        # the collector would otherwise write to every object it tracks in the workers, copying the store's
+        #  pages one by one
+        gc.freeze()
+    try:
+        with mp_context.Pool(
+            worker_num,
+            initializer=init_worker,
+            initargs=(performance_store, dict(feature_constants), cache_sizes),
+        ) as pool, tqdm(
+            total=len(map_ids), desc="Map Processor Pool", ncols=150
+        ) as bar:
+            for data_points, worker_pid, worker_stats in pool.imap_unordered(
+                process_map_batch, batch_map_ids(map_ids, batch_size)
+            ):
+                stage_timer.merge_worker(f"process-{worker_pid}", worker_stats)
+                for map_id, w, permanent_skip in data_points:
+                    if is_complete_data_point(w, num_columns):
+                        with stage_timer.stage("append"):
+                            feature_data.rows.append(w)
+                    elif permanent_skip:
+                        feature_data.rows.skip(map_id)
+                bar.update(len(data_points))
+    finally:
+        gc.unfreeze()
+    feature_data.rows.flush()
+    print("Done processing maps")
@@ -0,0 +1,122 @@
+import numpy as np
+from types import SimpleNamespace
+
+from processing_helper import (
+    max_threshold,
+    apart_threshold,
+    quantize_timedelta,
+    build_pack_columns,
+)
+from metadata_cache import LRUCache
+from performance_store import to_datetime64
+
+# per roster, the maps any of its players played, oldest first, each with the start of the roster's epoch as of
+#  that map: the map where, walking back from it as generate_round_rating_stats does, the apart maps since the
+#  last map the five played together on one side reach apart_threshold. timetogether before a date is then one
+#  search for the newest map before it and a read of its epoch start, instead of a walk of the window, and the
+#  maps the five played together before a date are a read of a running count. a timeline covers the whole
+#  store and is built from the store's per-player columns the first time its roster is asked for, so rosters
+#  that never play again aren't built at all. the sliding window builder and the vectorized kernel's column
+#  path read them. where a performance raises, the kernels' walks stop short of its remaining players, so
+#  the walks that handle that are kept
+
+default_roster_timeline_size = 1024
+
+
+class RosterTimeline:
+    def __init__(self, performance_store, max_rosters=default_roster_timeline_size):
+        self.performance_store = performance_store
+        self.performances = performance_store.performances
+        self.timelines = LRUCache("roster_timelines", max_rosters)
+
+    # store idxs and dates of the roster's maps, and per map the store idx of the epoch start (-1 if the walk
+    #  from it runs out of maps first) and the number of maps up to it the roster played together
+    def build(self, roster):
+        store = self.performance_store
+        pack_columns = store.derived("pack_columns", build_pack_columns)
+        pids = [pid for pid in roster if pid in store.player_idxs]
+        if len(pids) == 0:
+            return SimpleNamespace(
+                idxs=np.empty(0, dtype=np.int64),
+                dates=np.empty(0, dtype="datetime64[us]"),
+                epoch_starts=np.empty(0, dtype=np.int64),
+                together_counts=np.empty(0, dtype=np.int64),
+            )
+        idxs, first, inverse = np.unique(
+            np.concatenate([store.player_idxs[pid] for pid in pids]),
+            return_index=True,
+            return_inverse=True,
+        )
+        # (maps x side) players of the roster on each side, side 0 being neither
+        side_counts = np.zeros((len(idxs), 3), dtype=np.int64)
+        np.add.at(
+            side_counts,
+            (inverse, np.concatenate([pack_columns.sides[pid] for pid in pids])),
+            1,
+        )
+        # the walk resets where the five played on one side, and adds the roster's players otherwise
+        together = (side_counts[:, 1] == 5) | (side_counts[:, 2] == 5)
+        apart_maps = np.where(together, 0, side_counts[:, 1] + side_counts[:, 2])
+        apart_after = np.cumsum(apart_maps)
+        apart_before = apart_after - apart_maps
+        positions = np.arange(len(idxs))
+        # first map of the run of apart maps each map is in
+        run_starts = np.maximum.accumulate(np.where(together, positions, -1)) + 1
+        # the newest map where the apart maps from it up to each map reach the threshold, the start of the
+        #  epoch if it's in the map's run
+        starts = (
+            apart_before.searchsorted(apart_after - apart_threshold, side="right") - 1
+        )
+        reached = ~together & (starts >= run_starts)
+        # a map whose walk doesn't reach the threshold in its run goes on past the together map that ended the
+        #  previous run, so it ends where the newest map before it that reached it does
+        newest_reached = np.maximum.accumulate(np.where(reached, positions, -1))
+        epoch_starts = np.where(
+            newest_reached >= 0,
+            idxs[starts[np.maximum(newest_reached, 0)]],
+            -1,
+        )
+        return SimpleNamespace(
+            idxs=idxs,
+            dates=np.concatenate([store.player_dates[pid] for pid in pids])[first],
+            epoch_starts=epoch_starts,
+            together_counts=np.cumsum(together),
+        )
+
+    def timeline(self, player_ids):
+        roster = tuple(sorted(int(pid) for pid in player_ids))
+        found, _ = self.timelines.get_many([roster])
+        if roster in found:
+            return found[roster]
+        timeline = self.build(roster)
+        self.timelines.put_many({roster: timeline})
+        return timeline
+
+    # position of the newest map of the timeline before raw_date, -1 if there is none
+    def newest_before(self, timeline, raw_date):
+        return (
+            int(timeline.dates.searchsorted(to_datetime64(raw_date), side="left")) - 1
+        )
+
+    # timetogether_* of the roster before raw_date, over the threshold window, or None where
+    #  generate_round_rating_stats leaves it to its default
+    def time_together(self, player_ids, raw_date, threshold=max_threshold):
+        timeline = self.timeline(player_ids)
+        k = self.newest_before(timeline, raw_date)
+        if k < 0 or timeline.epoch_starts[k] < 0:
+            return None
+        epoch_start = self.performances[timeline.epoch_starts[k]]["date"]
+        if epoch_start < raw_date - threshold:
+            return None
+        return quantize_timedelta(raw_date - epoch_start)
+
+    # maps before raw_date the five played together on one side, over the whole store
+    def maps_together(self, player_ids, raw_date):
+        timeline = self.timeline(player_ids)
+        k = self.newest_before(timeline, raw_date)
+        return int(timeline.together_counts[k]) if k >= 0 else 0
+
+
+# the store's roster timelines, shared by everything reading the store
+def store_roster_timeline(performance_store):
+    return performance_store.derived("roster_timeline", RosterTimeline)
@@ -0,0 +1,149 @@
+import time
+import threading
+import numpy as np
+import pandas as pd
+from stage_timing import stage_timer
+from feature_schema import feature_schema
+
+default_capacity = 1024
+default_chunk_size = 256
+
+
+def column_dtype(column_name):
+    if column_name == "map_id":
+        return np.int64
+    if column_name.endswith("_bool") or column_name.startswith("map_pick_"):
+        return np.bool_
+    return np.float64
+
+
+# accumulates feature rows column-wise in preallocated NumPy arrays. workers append into their own
+#  thread-local chunk, and a chunk only takes the lock when it's merged into the columns
+class RowBuffer:
+    def __init__(
+        self,
+        column_names,
+        capacity=default_capacity,
+        chunk_size=default_chunk_size,
+        checkpoint_size=None,
+        on_checkpoint=None,
+    ):
+        self.column_names = list(column_names)
+        self.dtypes = [column_dtype(name) for name in self.column_names]
+        self.slots = [feature_schema.slots[name] for name in self.column_names]
+        self.columns = [np.empty(capacity, dtype) for dtype in self.dtypes]
+        self.capacity = capacity
+        self.size = 0
+        # rows written since creation, including ones already handed to on_checkpoint
+        self.total = 0
+        self.chunk_size = chunk_size
+        # once checkpoint_size rows are buffered they're drained into on_checkpoint
+        self.checkpoint_size = checkpoint_size
+        self.on_checkpoint = on_checkpoint
+        self.lock = threading.Lock()
+        # held while on_checkpoint writes, so checkpoints are written one at a time without holding up appends
+        self.checkpoint_lock = threading.Lock()
+        self.local = threading.local()
+        self.chunks = []
+        # map ids that gave no data point and never will, handed to on_checkpoint(frame, skipped_ids) with
+        #  the rows
+        self.skipped_ids = []
+
+    def __len__(self):
+        return self.total
+
+    def local_chunk(self):
+        chunk = getattr(self.local, "chunk", None)
+        if chunk == None:
+            chunk = self.local.chunk = []
+            with self.lock:
+                self.chunks.append(chunk)
+        return chunk
+
+    def append(self, w):
+        chunk = self.local_chunk()
+        chunk.append(w)
+        if len(chunk) >= self.chunk_size:
+            self.flush()
+
+    def skip(self, map_id):
+        with self.lock:
+            self.skipped_ids.append(int(map_id))
+
+    # merges the calling thread's chunk into the columns. a checkpoint is drained under the lock but written
+    #  after it's released, so the other workers don't wait on the disk
+    def flush(self):
+        chunk = self.local_chunk()
+        checkpoint = None
+        wait_start = time.perf_counter()
+        with self.lock:
+            stage_timer.add_time("lock_wait", time.perf_counter() - wait_start)
+            self.write_rows(chunk)
+            chunk.clear()
+            if self.checkpoint_size != None and self.size >= self.checkpoint_size:
+                checkpoint = (self.drain_columns(), self.drain_skipped_ids())
+        if checkpoint != None:
+            with self.checkpoint_lock:
+                self.on_checkpoint(*checkpoint)
+
+    # doubles capacity as needed, so total copying stays linear in the number of rows
+    def reserve(self, num_rows):
+        if self.size + num_rows <= self.capacity:
+            return
+        new_capacity = max(self.capacity * 2, self.size + num_rows)
+        for i, column in enumerate(self.columns):
+            new_column = np.empty(new_capacity, self.dtypes[i])
+            new_column[: self.size] = column[: self.size]
+            self.columns[i] = new_column
+        self.capacity = new_capacity
+
+    # must be called with the lock held
+    def write_rows(self, rows):
+        num_rows = len(rows)
+        if num_rows == 0:
+            return
+        self.reserve(num_rows)
+        block = feature_schema.matrix(rows)
+        for i, slot in enumerate(self.slots):
+            self.columns[i][self.size : self.size + num_rows] = block[:, slot]
+        self.size += num_rows
+        self.total += num_rows
+
+    # must be called with the lock held
+    def columns_frame(self):
+        return pd.DataFrame(
+            {
+                column_name: self.columns[i][: self.size].copy()
+                for i, column_name in enumerate(self.column_names)
+            }
+        )
+
+    # must be called with the lock held
+    def drain_columns(self):
+        frame = self.columns_frame()
+        self.size = 0
+        return frame
+
+    # must be called with the lock held
+    def drain_skipped_ids(self):
+        skipped_ids = self.skipped_ids
+        self.skipped_ids = []
+        return skipped_ids
+
+    # must be called with the lock held
+    def merge_chunks(self):
+        for chunk in self.chunks:
+            self.write_rows(chunk)
+            chunk.clear()
+
+    # only call once the workers are done appending, since it merges every thread's chunk
+    def to_frame(self):
+        with self.lock:
+            self.merge_chunks()
+            return self.columns_frame()
+
+    # same as to_frame, but also empties the buffer. returns the skipped map ids along with the frame
+    def drain(self):
+        with self.lock:
+            self.merge_chunks()
+            return self.drain_columns(), self.drain_skipped_ids()
@@ -1,18 +1,13 @@
-import pymongo
-import os
+from database import LazyCollection, get_mongo_db
 
-client = pymongo.MongoClient(os.environ["MONGODB_URI"])
-db = client["scraped-hltv"]
-unplayed_matches = db["unplayedmatches"]
-matches = db["matches"]
-maps = db["maps"]
+unplayed_matches = LazyCollection("unplayedmatches", get_mongo_db)
+matches = LazyCollection("matches", get_mongo_db)
+maps = LazyCollection("maps", get_mongo_db)
 
 
 def maps_to_examine():
     map_list = []
-    all_unplayed = list(
-        unplayed_matches.find({"played": True}).sort([("date", pymongo.DESCENDING)])
-    )
+    all_unplayed = list(unplayed_matches.find({"played": True}).sort([("date", -1)]))
     for unplayed in all_unplayed:
         hltv_id = unplayed["hltvId"]
         played_match = matches.find_one({"hltvId": hltv_id})
@@ -1,11 +1,8 @@
-import pymongo
-import os
+from database import LazyCollection, get_mongo_db
 import jellyfish
 from datetime import timedelta
 
-client = pymongo.MongoClient(os.environ["MONGODB_URI"])
-db = client["scraped-hltv"]
-unplayed_matches = db["unplayedmatches"]
+unplayed_matches = LazyCollection("unplayedmatches", get_mongo_db)
 
 # conditions to be added to aggregation pipeline
 aggregate_list = [
@@ -1,13 +1,10 @@
-import pymongo
-import os
+from database import LazyCollection, get_mongo_db
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
-client = pymongo.MongoClient(os.environ["MONGODB_URI"])
-db = client["scraped-hltv"]
-wagers = db["wagers"]
+wagers = LazyCollection("wagers", get_mongo_db)
 
 
 def wager_exists(wager_id):
@@ -22,10 +19,12 @@ def insert_wager(wager):
 
 
 def update_wager_result(wager_id, new_result):
+    from pymongo import ReturnDocument
+
     return wagers.find_one_and_update(
         {"wagerId": wager_id},
         {"$set": {"result": new_result}},
-        return_document=pymongo.ReturnDocument.AFTER,
+        return_document=ReturnDocument.AFTER,
     )
 
 
@@ -36,4 +35,4 @@ def get_first_wager():
 def get_all_finished_wagers():
     return wagers.find(
         {"$and": [{"result": {"$ne": None}}, {"result": {"$ne": "UNFINISHED"}}]}
-    ).sort("creationDate", pymongo.DESCENDING)
+    ).sort("creationDate", -1)
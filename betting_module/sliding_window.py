@@ -0,0 +1,403 @@
+import numpy as np
+from tqdm import tqdm
+from stage_timing import stage_timer
+from roster_timeline import store_roster_timeline
+
+from processing_helper import (
+    max_threshold,
+    max_ranking,
+    ranking_threshold,
+    team_suffixes,
+    sided_stats,
+    category_stat_types,
+    category_defaults,
+    default_side_stat,
+    default_side_winrate,
+    packed_value_num,
+    sided_end,
+    winrate_end,
+    quantize_timedelta,
+    aggregate_round_rating_stats,
+    generate_round_rating_stats_vectorized,
+    generate_data_point,
+    add_data_point,
+    MapCondition,
+    OnlineCondition,
+    EventCondition,
+    RankCondition,
+    MatchupCondition,
+)
+
+# a (performance, player) contribution is [1, values, values ** 2], values in the order of append_packed_values
+contribution_size = 1 + 2 * packed_value_num
+totals_key = None
+
+
+class MalformedPerformance(Exception):
+    pass
+
+
+# relative_ranking (from the player's side) that correct_ranking accepts for these rankings, or None
+def ranking_bucket(home_ranking, away_ranking):
+    ranking_diff = home_ranking - away_ranking
+    if np.abs(ranking_diff) < ranking_threshold:
+        return 0
+    if ranking_diff > ranking_threshold:
+        return 1
+    if ranking_diff < -1 * ranking_threshold:
+        return -1
+    return None
+
+
+# every player's packed values and category keys for one performance. raises MalformedPerformance wherever
+#  generate_round_rating_stats would print an error or fail the map, so those windows can be left to it
+def performance_contributions(performance):
+    try:
+        team_one_stats = performance["teamOneStats"]
+        team_two_stats = performance["teamTwoStats"]
+        if team_one_stats.keys() & team_two_stats.keys():
+            raise MalformedPerformance("player on both teams")
+        # the window is selected by "players" but stats are read by key, so the two have to agree
+        if set(str(pid) for pid in performance["players"]) != (
+            team_one_stats.keys() | team_two_stats.keys()
+        ):
+            raise MalformedPerformance("players don't match stats")
+        related_match = performance["match"][0]
+        shared_keys = [
+            ("map", performance["mapType"]),
+            ("online", related_match["online"]),
+            ("event", related_match["eventId"]),
+        ]
+        rankings = [
+            performance["teamOneRanking"] or max_ranking,
+            performance["teamTwoRanking"] or max_ranking,
+        ]
+        contributions = {}
+        for side, team_stats in enumerate([team_one_stats, team_two_stats]):
+            team_key = ["teamOne", "teamTwo"][side]
+            away_key = ["teamTwo", "teamOne"][side]
+            team_score = performance["score"][team_key]
+            away_team_score = performance["score"][away_key]
+            home_score = team_score["ct"] + team_score["t"] + team_score["ot"]
+            away_score = (
+                away_team_score["ct"] + away_team_score["t"] + away_team_score["ot"]
+            )
+            bucket = ranking_bucket(rankings[side], rankings[1 - side])
+            keys = shared_keys + ([("rank", bucket)] if bucket != None else [])
+            for pid, player_stats in team_stats.items():
+                ct_stats = player_stats["ctStats"]
+                t_stats = player_stats["tStats"]
+                values = np.array(
+                    [
+                        ct_stats["kast"],
+                        t_stats["kast"],
+                        ct_stats["rating"],
+                        t_stats["rating"],
+                        ct_stats["fkDiff"],
+                        t_stats["fkDiff"],
+                        team_score["t"] / (team_score["t"] + away_team_score["ct"]),
+                        team_score["ct"] / (team_score["ct"] + away_team_score["t"]),
+                        # kept error behavior (e) of generate_round_rating_stats
+                        team_score["ot"]
+                        + 1 / (team_score["ot"] + away_team_score["ot"] + 1),
+                        team_score["ct"],
+                        team_score["t"],
+                        ct_stats["rating"],
+                        t_stats["rating"],
+                    ],
+                    dtype=np.float64,
+                )
+                if not np.isfinite(values).all():
+                    raise MalformedPerformance("non-finite stat value")
+                for key in keys:
+                    # unhashable values can still be compared by the conditions, but not looked up
+                    hash(key)
+                contributions[pid] = (
+                    side + 1,
+                    np.concatenate([[1.0], values, values**2]),
+                    keys,
+                    (home_score > away_score) - (away_score > home_score),
+                )
+        return contributions
+    except MalformedPerformance:
+        raise
+    except Exception as e:
+        raise MalformedPerformance(e)
+
+
+# per-player running sums over the last max_threshold of performances, updated as maps enter and leave
+#  the window. data points have to be requested in date order; anything the accumulators can't reproduce
+#  exactly (malformed performances in the window, conditions other than the standard ones, dates going
+#  backwards) is computed from the store window with the vectorized kernel instead
+class SlidingWindowFeatureBuilder:
+    def __init__(self, performance_store, threshold=max_threshold):
+        self.performance_store = performance_store
+        self.performances = performance_store.performances
+        self.threshold = threshold
+        # pid -> category key -> summed contributions, totals_key holds every performance
+        self.accumulators = {}
+        # performance idx -> contributions, for performances inside the window
+        self.contributions = {}
+        # pid -> number of malformed performances of theirs inside the window
+        self.malformed = {}
+        # pid -> (date of the newest win, date of the newest loss) added so far
+        self.last_results = {}
+        self.added = 0
+        self.removed = 0
+        self.raw_date = None
+        self.fallback_num = 0
+        self.roster_timeline = store_roster_timeline(performance_store)
+
+    def __len__(self):
+        return self.added - self.removed
+
+    def add_performance(self, idx):
+        performance = self.performances[idx]
+        try:
+            contributions = performance_contributions(performance)
+        except MalformedPerformance:
+            for pid in set(str(pid) for pid in performance.get("players") or []):
+                self.malformed[pid] = self.malformed.get(pid, 0) + 1
+            return
+        self.contributions[idx] = contributions
+        for pid, (_, contribution, keys, result) in contributions.items():
+            player_accumulators = self.accumulators.setdefault(pid, {})
+            for key in [totals_key] + keys:
+                if key in player_accumulators:
+                    player_accumulators[key] += contribution
+                else:
+                    player_accumulators[key] = contribution.copy()
+            if result != 0:
+                last_win, last_loss = self.last_results.get(pid, (None, None))
+                self.last_results[pid] = (
+                    performance["date"] if result > 0 else last_win,
+                    performance["date"] if result < 0 else last_loss,
+                )
+
+    def remove_performance(self, idx):
+        performance = self.performances[idx]
+        contributions = self.contributions.pop(idx, None)
+        if contributions == None:
+            for pid in set(str(pid) for pid in performance.get("players") or []):
+                self.malformed[pid] -= 1
+                if self.malformed[pid] == 0:
+                    del self.malformed[pid]
+            return
+        for pid, (_, contribution, keys, _) in contributions.items():
+            player_accumulators = self.accumulators[pid]
+            for key in [totals_key] + keys:
+                player_accumulators[key] -= contribution
+                # dropping empty sums also drops the rounding error they picked up
+                if player_accumulators[key][0] == 0:
+                    del player_accumulators[key]
+            if len(player_accumulators) == 0:
+                del self.accumulators[pid]
+
+    # moves the window to [raw_date - threshold, raw_date)
+    def advance(self, raw_date):
+        while (
+            self.added < len(self.performances)
+            and self.performances[self.added]["date"] < raw_date
+        ):
+            self.add_performance(self.added)
+            self.added += 1
+        while (
+            self.removed < self.added
+            and self.performances[self.removed]["date"] < raw_date - self.threshold
+        ):
+            self.remove_performance(self.removed)
+            self.removed += 1
+        self.raw_date = raw_date
+
+    # per-player category keys for each condition, or None if one of them isn't a standard condition
+    def category_keys(self, condition_dict, player_ids, num_team_one):
+        category_keys = []
+        for condition in condition_dict.values():
+            if isinstance(condition, MapCondition):
+                keys = [("map", condition.map_name)] * len(player_ids)
+            elif isinstance(condition, OnlineCondition):
+                keys = [("online", condition.online)] * len(player_ids)
+            elif isinstance(condition, EventCondition):
+                keys = [("event", condition.event_id)] * len(player_ids)
+            elif isinstance(condition, RankCondition):
+                keys = [
+                    (
+                        "rank",
+                        condition.relative_ranking
+                        if j < num_team_one
+                        else -1 * condition.relative_ranking,
+                    )
+                    for j in range(len(player_ids))
+                ]
+            elif isinstance(condition, MatchupCondition):
+                keys = [condition] * len(player_ids)
+            else:
+                return None
+            category_keys.append(keys)
+        return category_keys
+
+    # window idxs of each player's performances, oldest first
+    def player_window_idxs(self, player_ids, raw_date):
+        start = np.datetime64(raw_date - self.threshold, "us")
+        end = np.datetime64(raw_date, "us")
+        idx_slices = []
+        for pid in player_ids:
+            dates = self.performance_store.player_dates.get(int(pid))
+            if dates is None:
+                idx_slices.append(np.empty(0, dtype=np.int64))
+                continue
+            idx_slices.append(
+                self.performance_store.player_idxs[int(pid)][
+                    dates.searchsorted(start, side="left") : dates.searchsorted(
+                        end, side="left"
+                    )
+                ]
+            )
+        return idx_slices
+
+    # performances where at least 3 of each team's players were present, the only ones a matchup
+    #  condition can accept
+    def matchup_candidates(self, team_idx_slices):
+        candidates = None
+        for idx_slices in team_idx_slices:
+            idxs, counts = np.unique(np.concatenate(idx_slices), return_counts=True)
+            team_candidates = idxs[counts >= 3]
+            candidates = (
+                team_candidates
+                if candidates is None
+                else np.intersect1d(candidates, team_candidates)
+            )
+        return candidates
+
+    # summed contributions of the performances a matchup condition accepts, per player
+    def matchup_accumulators(self, condition, player_ids, candidates):
+        player_accumulators = [np.zeros(contribution_size) for _ in player_ids]
+        for idx in candidates:
+            if not condition.test(self.performances[idx]):
+                continue
+            contributions = self.contributions[idx]
+            for j, pid in enumerate(player_ids):
+                if pid in contributions:
+                    player_accumulators[j] += contributions[pid][1]
+        return player_accumulators
+
+    def fallback(self, team_one_ids, team_two_ids, condition_dict, raw_date):
+        self.fallback_num += 1
+        stage_timer.count("window_fallbacks")
+        return generate_round_rating_stats_vectorized(
+            team_one_ids,
+            team_two_ids,
+            self.performance_store.window(team_one_ids + team_two_ids, raw_date),
+            condition_dict,
+            raw_date,
+        )
+
+    # same output as generate_round_rating_stats over the store window before raw_date
+    def round_rating_stats(self, team_one_ids, team_two_ids, condition_dict, raw_date):
+        player_ids = team_one_ids + team_two_ids
+        num_team_one = len(team_one_ids)
+        category_keys = self.category_keys(condition_dict, player_ids, num_team_one)
+        if self.raw_date != None and raw_date < self.raw_date:
+            return self.fallback(team_one_ids, team_two_ids, condition_dict, raw_date)
+        with stage_timer.stage("window_advance"):
+            self.advance(raw_date)
+        if (
+            len(player_ids) != 10
+            or len(set(player_ids)) != len(player_ids)
+            or category_keys == None
+            or any(pid in self.malformed for pid in player_ids)
+        ):
+            return self.fallback(team_one_ids, team_two_ids, condition_dict, raw_date)
+
+        idx_slices = self.player_window_idxs(player_ids, raw_date)
+        team_idx_slices = [idx_slices[:num_team_one], idx_slices[num_team_one:]]
+        matchup_candidates = None
+        totals = np.zeros((len(player_ids), contribution_size))
+        category_sums = np.zeros(
+            (len(player_ids), len(category_keys), contribution_size)
+        )
+        for j, pid in enumerate(player_ids):
+            player_accumulators = self.accumulators.get(pid, {})
+            if totals_key in player_accumulators:
+                totals[j] = player_accumulators[totals_key]
+        for c, keys in enumerate(category_keys):
+            if isinstance(keys[0], MatchupCondition):
+                if matchup_candidates is None:
+                    matchup_candidates = self.matchup_candidates(team_idx_slices)
+                category_sums[:, c] = self.matchup_accumulators(
+                    keys[0], player_ids, matchup_candidates
+                )
+                continue
+            for j, pid in enumerate(player_ids):
+                player_accumulators = self.accumulators.get(pid, {})
+                if keys[j] in player_accumulators:
+                    category_sums[j, c] = player_accumulators[keys[j]]
+
+        results_dict = {}
+        for suffix_idx, suffix in enumerate(team_suffixes):
+            team_ids = [player_ids[:num_team_one], player_ids[num_team_one:]][
+                suffix_idx
+            ]
+            time_together = self.roster_timeline.time_together(
+                team_ids, raw_date, self.threshold
+            )
+            if time_together != None:
+                results_dict[f"timetogether_{suffix}"] = time_together
+            for r, result in enumerate(["lastwin", "lastloss"]):
+                dates = [
+                    self.last_results[pid][r]
+                    for pid in team_ids
+                    if pid in self.last_results and self.last_results[pid][r] != None
+                ]
+                if len(dates) != 0 and max(dates) >= raw_date - self.threshold:
+                    results_dict[f"{result}_{suffix}"] = quantize_timedelta(
+                        raw_date - max(dates)
+                    )
+
+        def sum_mean_std(sums, defaults):
+            counts = sums[..., :1] + 1
+            means = (sums[..., 1 : 1 + packed_value_num] + defaults) / counts
+            squares = (sums[..., 1 + packed_value_num :] + defaults**2) / counts
+            return means, np.sqrt(np.maximum(squares - means**2, 0)), counts[..., 0]
+
+        sided_defaults = np.zeros(packed_value_num)
+        sided_defaults[:sided_end] = default_side_stat
+        sided_defaults[sided_end:winrate_end] = default_side_winrate
+        means, stdevs, _ = sum_mean_std(totals, sided_defaults)
+        category_value_defaults = np.zeros(packed_value_num)
+        category_value_defaults[winrate_end:] = category_defaults.flatten()
+        category_means, category_stdevs, category_counts = sum_mean_std(
+            category_sums, category_value_defaults
+        )
+        sided_shape = (len(player_ids), len(sided_stats), 2)
+        category_shape = category_means.shape[:2] + (len(category_stat_types), 2)
+        with stage_timer.stage("aggregation"):
+            return aggregate_round_rating_stats(
+                results_dict,
+                num_team_one,
+                list(condition_dict.keys()),
+                category_means[..., winrate_end:].reshape(category_shape),
+                category_stdevs[..., winrate_end:].reshape(category_shape),
+                category_counts,
+                means[:, :sided_end].reshape(sided_shape),
+                stdevs[:, :sided_end].reshape(sided_shape),
+                means[:, sided_end:winrate_end],
+            )
+
+
+# builds data points for maps that are already sorted by match date, moving one window along with them
+def process_maps_stream(maps_to_process, feature_data, window_builder, num_maps=None):
+    for curr_map in tqdm(
+        stage_timer.timed(maps_to_process, "map_fetch"),
+        total=num_maps,
+        desc="Map Processor [stream]",
+        ncols=150,
+    ):
+        stage_timer.count("maps")
+        with stage_timer.stage("data_point"):
+            w = generate_data_point(curr_map, window_builder=window_builder)
+        add_data_point(feature_data.rows, curr_map, w)
+    feature_data.rows.flush()
+    print(
+        f"Done processing maps, {window_builder.fallback_num} fell back to the store window"
+    )
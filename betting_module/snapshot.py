@@ -0,0 +1,629 @@
+import os
+import json
+import array
+import shutil
+import argparse
+from datetime import datetime
+import numpy as np
+from tqdm import tqdm
+
+default_snapshot_folder = "../cached/snapshot/"
+
+# field kinds, and how null (or missing) values are stored:
+#  "int" int64 (null_int), "number" float64 (NaN), "bool" int8 (-1), "string" int32 codes into the
+#  collection's vocabularies (-1), "date" datetime64[us] (NaT), "ints" variable-length int64 lists
+null_int = np.iinfo(np.int64).min
+kind_typecodes = {
+    "int": "q",
+    "number": "d",
+    "bool": "b",
+    "string": "i",
+    "date": "q",
+}
+
+# mirrors the mongoose models in scraping_module/models, minus the fields processing never reads
+collection_schemas = {
+    "maps": {
+        "hltvId": "int",
+        "matchId": "int",
+        "mapType": "string",
+        "score.teamOne.ct": "int",
+        "score.teamOne.t": "int",
+        "score.teamOne.ot": "int",
+        "score.teamTwo.ct": "int",
+        "score.teamTwo.t": "int",
+        "score.teamTwo.ot": "int",
+        "teamOneRanking": "int",
+        "teamTwoRanking": "int",
+        "date": "date",
+        "players": "ints",
+        "pickedBy": "string",
+        "mapNum": "int",
+    },
+    "matches": {
+        "hltvId": "int",
+        "eventId": "int",
+        "title": "string",
+        "date": "date",
+        "format": "string",
+        "numMaps": "int",
+        "online": "bool",
+        "matchType": "string",
+        "formatCategory": "number",
+        "matchTypeCategory": "number",
+    },
+    "events": {
+        "hltvId": "int",
+        "title": "string",
+        "startDate": "date",
+        "endDate": "date",
+        "prizePool": "number",
+        "teamNum": "int",
+        "teamRankings": "ints",
+        "location": "string",
+        "online": "bool",
+    },
+    "players": {
+        "hltvId": "int",
+        "name": "string",
+        "birthYear": "int",
+        "nationality": "string",
+    },
+}
+
+# teamOneStats/teamTwoStats are flattened into one row per (map, team, player). duelMap isn't kept
+stats_teams = ["teamOneStats", "teamTwoStats"]
+half_stats = [
+    "kills",
+    "hsKills",
+    "assists",
+    "flashAssists",
+    "deaths",
+    "kast",
+    "adr",
+    "fkDiff",
+    "rating",
+]
+player_stat_fields = [
+    f"{half}.{stat}" for half in ["ctStats", "tStats"] for stat in half_stats
+]
+
+
+def get_path(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict) or not key in doc:
+            return None
+        doc = doc[key]
+    return doc
+
+
+def set_path(doc, keys, value):
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+
+def encode_int(value, field):
+    if value == None:
+        return null_int
+    if int(value) != value:
+        raise ValueError(f"{field} isn't an integer: {value}")
+    return int(value)
+
+
+def encode_number(value):
+    return np.nan if value == None else float(value)
+
+
+def encode_date(value):
+    return (
+        null_int if value == None else int(np.datetime64(value, "us").astype(np.int64))
+    )
+
+
+# builds one collection's columns while its documents are streamed from Mongo
+class CollectionWriter:
+    def __init__(self, name):
+        self.name = name
+        self.schema = collection_schemas[name]
+        self.columns = {}
+        self.vocabularies = {}
+        for field, kind in self.schema.items():
+            if kind == "ints":
+                self.columns[field + ".offsets"] = array.array("q", [0])
+                self.columns[field + ".values"] = array.array("q")
+            else:
+                self.columns[field] = array.array(kind_typecodes[kind])
+            if kind == "string":
+                self.vocabularies[field] = {}
+        self.has_stats = name == "maps"
+        if self.has_stats:
+            self.columns["stats.offsets"] = array.array("q", [0])
+            self.columns["stats.playerId"] = array.array("q")
+            for stat_field in player_stat_fields:
+                self.columns["stats." + stat_field] = array.array("d")
+        self.count = 0
+
+    def append(self, doc):
+        for field, kind in self.schema.items():
+            value = get_path(doc, field)
+            if kind == "ints":
+                values = self.columns[field + ".values"]
+                values.extend(encode_int(item, field) for item in value or [])
+                self.columns[field + ".offsets"].append(len(values))
+            elif kind == "int":
+                self.columns[field].append(encode_int(value, field))
+            elif kind == "number":
+                self.columns[field].append(encode_number(value))
+            elif kind == "bool":
+                self.columns[field].append(-1 if value == None else int(bool(value)))
+            elif kind == "string":
+                vocabulary = self.vocabularies[field]
+                self.columns[field].append(
+                    -1
+                    if value == None
+                    else vocabulary.setdefault(value, len(vocabulary))
+                )
+            elif kind == "date":
+                self.columns[field].append(encode_date(value))
+        if self.has_stats:
+            for team_stats_key in stats_teams:
+                for pid, player_stats in (doc.get(team_stats_key) or {}).items():
+                    self.columns["stats.playerId"].append(
+                        encode_int(int(pid), "stats.playerId")
+                    )
+                    for stat_field in player_stat_fields:
+                        self.columns["stats." + stat_field].append(
+                            encode_number(get_path(player_stats, stat_field))
+                        )
+                self.columns["stats.offsets"].append(
+                    len(self.columns["stats.playerId"])
+                )
+        self.count += 1
+
+    def save(self, folder):
+        collection_folder = os.path.join(folder, self.name)
+        os.makedirs(collection_folder, exist_ok=True)
+        for column_name, values in self.columns.items():
+            column = np.frombuffer(values, dtype=values.typecode)
+            if self.schema.get(column_name) == "date":
+                column = column.view("datetime64[us]")
+            np.save(os.path.join(collection_folder, column_name + ".npy"), column)
+        with open(os.path.join(collection_folder, "vocabularies.json"), "w") as f:
+            json.dump(
+                {
+                    field: list(vocab.keys())
+                    for field, vocab in self.vocabularies.items()
+                },
+                f,
+            )
+
+
+# dumps maps, matches, events and players into typed column files under folder, swapped in once complete
+def export_snapshot(db, folder=default_snapshot_folder):
+    folder = folder.rstrip("/")
+    tmp_folder = folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    counts = {}
+    for name in collection_schemas.keys():
+        writer = CollectionWriter(name)
+        for doc in tqdm(
+            db[name].find({}),
+            total=db[name].estimated_document_count(),
+            desc=f"Snapshot {name}",
+            ncols=150,
+        ):
+            writer.append(doc)
+        writer.save(tmp_folder)
+        counts[name] = writer.count
+    with open(os.path.join(tmp_folder, "manifest.json"), "w") as f:
+        json.dump({"exported": datetime.utcnow().isoformat(), "counts": counts}, f)
+    old_folder = folder + ".old"
+    shutil.rmtree(old_folder, ignore_errors=True)
+    if os.path.exists(folder):
+        os.replace(folder, old_folder)
+    os.replace(tmp_folder, folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+    print(f"Snapshot written to {folder}:", counts)
+
+
+# which rows of a collection a query or pipeline has selected, plus the rows its $lookup stages joined
+class RowSelection:
+    def __init__(self, rows):
+        self.rows = rows
+        # alias -> (collection, joined row per selected row or -1), or (collection, None) for list joins
+        self.joins = {}
+
+    def take(self, idxs):
+        self.rows = self.rows[idxs]
+        for alias, (collection, join_rows) in self.joins.items():
+            if join_rows is not None:
+                self.joins[alias] = (collection, join_rows[idxs])
+
+
+# read-only stand-in for a pymongo collection, backed by memory-mapped columns. covers the find, count and
+#  aggregate calls processing makes: top-level comparisons, $in, $and/$or, $sort/$skip/$limit and
+#  $lookup on hltvId. null and missing fields both read back as None
+class SnapshotCollection:
+    def __init__(self, snapshot, name):
+        self.snapshot = snapshot
+        self.name = name
+        self.schema = collection_schemas[name]
+        self.folder = os.path.join(snapshot.folder, name)
+        self.loaded_columns = {}
+        with open(os.path.join(self.folder, "vocabularies.json")) as f:
+            self.vocabularies = json.load(f)
+        self.vocabulary_codes = {
+            field: {value: code for code, value in enumerate(vocab)}
+            for field, vocab in self.vocabularies.items()
+            if all(isinstance(value, str) for value in vocab)
+        }
+        self.hltv_id_order = None
+
+    def __len__(self):
+        return len(self.column("hltvId"))
+
+    def column(self, column_name):
+        if not column_name in self.loaded_columns:
+            self.loaded_columns[column_name] = np.load(
+                os.path.join(self.folder, column_name + ".npy"), mmap_mode="r"
+            )
+        return self.loaded_columns[column_name]
+
+    # rows holding the given hltvIds, -1 where there's none
+    def rows_by_hltv_id(self, hltv_ids):
+        if self.hltv_id_order is None:
+            hltv_id_column = self.column("hltvId")
+            self.hltv_id_order = np.argsort(hltv_id_column, kind="stable")
+            self.sorted_hltv_ids = hltv_id_column[self.hltv_id_order]
+        sorted_ids = self.sorted_hltv_ids
+        hltv_ids = np.asarray(hltv_ids, dtype=np.int64)
+        if len(sorted_ids) == 0:
+            return np.full(len(hltv_ids), -1, dtype=np.int64)
+        positions = np.minimum(sorted_ids.searchsorted(hltv_ids), len(sorted_ids) - 1)
+        rows = self.hltv_id_order[positions]
+        return np.where(sorted_ids[positions] == hltv_ids, rows, -1)
+
+    # (collection, field, rows) a dotted path resolves to, following $lookup aliases
+    def resolve(self, selection, path):
+        keys = path.split(".")
+        if keys[0] in selection.joins:
+            collection, join_rows = selection.joins[keys[0]]
+            if join_rows is None:
+                raise NotImplementedError(f"snapshot can't query list lookup {path}")
+            keys = keys[2:] if len(keys) > 1 and keys[1] == "0" else keys[1:]
+            return collection, ".".join(keys), join_rows
+        return self, path, selection.rows
+
+    # values of a scalar field at rows, and where they're null or the row is missing
+    def field_values(self, field, rows):
+        kind = self.schema.get(field)
+        if kind == None or kind == "ints":
+            raise NotImplementedError(f"snapshot can't compare {self.name}.{field}")
+        column = self.column(field)
+        values = column[np.maximum(rows, 0)] if len(column) else column[:0]
+        if kind == "number":
+            nulls = np.isnan(values)
+        elif kind == "date":
+            nulls = np.isnat(values)
+        elif kind == "int":
+            nulls = values == null_int
+        else:
+            nulls = values == -1
+        return kind, values, nulls | (rows < 0)
+
+    def encode_value(self, field, kind, value):
+        if kind == "date":
+            return np.datetime64(value, "us")
+        if kind == "string":
+            return self.vocabulary_codes.get(field, {}).get(value, -2)
+        if kind == "bool":
+            return int(bool(value))
+        return value
+
+    def list_field_mask(self, field, rows, values):
+        offsets = self.column(field + ".offsets")
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        value_rows = np.repeat(np.arange(len(rows)), lengths)
+        # position of each value within its own list, plus where that list starts
+        value_idxs = (
+            np.arange(lengths.sum())
+            - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            + np.repeat(starts, lengths)
+        )
+        list_values = self.column(field + ".values")[value_idxs]
+        mask = np.zeros(len(rows), dtype=np.bool_)
+        mask[
+            value_rows[np.isin(list_values, np.asarray(values, dtype=np.int64))]
+        ] = True
+        return mask
+
+    def field_mask(self, selection, path, condition):
+        collection, field, rows = self.resolve(selection, path)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = np.ones(len(rows), dtype=np.bool_)
+        if collection.schema.get(field) == "ints":
+            for op, value in condition.items():
+                if op == "$in":
+                    mask &= collection.list_field_mask(field, rows, value)
+                elif op == "$eq":
+                    mask &= collection.list_field_mask(field, rows, [value])
+                else:
+                    raise NotImplementedError(f"snapshot can't apply {op} to {path}")
+            return mask
+        kind, values, nulls = collection.field_values(field, rows)
+        for op, value in condition.items():
+            if op in ["$eq", "$ne"] and value == None:
+                op_mask = nulls
+            elif op in ["$eq", "$ne"]:
+                op_mask = ~nulls & (
+                    values == collection.encode_value(field, kind, value)
+                )
+            elif op in ["$in", "$nin"]:
+                codes = [
+                    collection.encode_value(field, kind, item)
+                    for item in value
+                    if item != None
+                ]
+                op_mask = ~nulls & np.isin(values, np.array(codes, dtype=values.dtype))
+                if None in value:
+                    op_mask |= nulls
+            elif op in ["$gt", "$gte", "$lt", "$lte"]:
+                encoded = collection.encode_value(field, kind, value)
+                compare = {
+                    "$gt": np.greater,
+                    "$gte": np.greater_equal,
+                    "$lt": np.less,
+                    "$lte": np.less_equal,
+                }[op]
+                op_mask = ~nulls & compare(values, encoded)
+            else:
+                raise NotImplementedError(f"snapshot can't apply {op} to {path}")
+            mask &= ~op_mask if op in ["$ne", "$nin"] else op_mask
+        return mask
+
+    def query_mask(self, selection, query):
+        mask = np.ones(len(selection.rows), dtype=np.bool_)
+        for key, condition in query.items():
+            if key == "$and":
+                for sub_query in condition:
+                    mask &= self.query_mask(selection, sub_query)
+            elif key == "$or":
+                or_mask = np.zeros(len(selection.rows), dtype=np.bool_)
+                for sub_query in condition:
+                    or_mask |= self.query_mask(selection, sub_query)
+                mask &= or_mask
+            else:
+                mask &= self.field_mask(selection, key, condition)
+        return mask
+
+    # nulls sort first, like Mongo
+    def sort_selection(self, selection, sort_keys):
+        lexsort_keys = []
+        for path, direction in reversed(list(sort_keys)):
+            collection, field, rows = self.resolve(selection, path)
+            kind, values, nulls = collection.field_values(field, rows)
+            if kind == "string":
+                raise NotImplementedError(f"snapshot can't sort on {path}")
+            if kind == "date":
+                values = values.astype(np.int64)
+            values = np.where(nulls, 0, values).astype(np.float64)
+            if direction == -1:
+                lexsort_keys += [-values, nulls]
+            else:
+                lexsort_keys += [values, ~nulls]
+        if len(lexsort_keys) != 0:
+            selection.take(np.lexsort(lexsort_keys))
+
+    def lookup(self, selection, stage):
+        foreign = self.snapshot[stage["from"]]
+        if stage["foreignField"] != "hltvId":
+            raise NotImplementedError("snapshot only looks up by hltvId")
+        collection, field, rows = self.resolve(selection, stage["localField"])
+        if collection.schema.get(field) == "ints":
+            selection.joins[stage["as"]] = (foreign, None)
+            return
+        kind, values, nulls = collection.field_values(field, rows)
+        join_rows = foreign.rows_by_hltv_id(np.where(nulls, -1, values))
+        selection.joins[stage["as"]] = (foreign, np.where(nulls, -1, join_rows))
+
+    def find(self, query={}, projection=None):
+        selection = RowSelection(np.arange(len(self), dtype=np.int64))
+        selection.take(np.nonzero(self.query_mask(selection, query))[0])
+        fields = None
+        if projection != None:
+            fields = [
+                key for key, value in projection.items() if value and key != "_id"
+            ]
+        return SnapshotCursor(self, selection, fields)
+
+    def find_one(self, query={}, projection=None):
+        return next(iter(self.find(query, projection).limit(1)), None)
+
+    def count_documents(self, query):
+        selection = RowSelection(np.arange(len(self), dtype=np.int64))
+        return int(np.count_nonzero(self.query_mask(selection, query)))
+
+    def estimated_document_count(self):
+        return len(self)
+
+    def aggregate(self, pipeline, **kwargs):
+        selection = RowSelection(np.arange(len(self), dtype=np.int64))
+        list_join_fields = {}
+        for stage in pipeline:
+            ((op, value),) = stage.items()
+            if op == "$match":
+                selection.take(np.nonzero(self.query_mask(selection, value))[0])
+            elif op == "$sort":
+                self.sort_selection(selection, value.items())
+            elif op == "$skip":
+                selection.take(slice(int(value), None))
+            elif op == "$limit":
+                selection.take(slice(0, int(value)))
+            elif op == "$lookup":
+                self.lookup(selection, value)
+                if selection.joins[value["as"]][1] is None:
+                    list_join_fields[value["as"]] = value["localField"]
+            else:
+                raise NotImplementedError(f"snapshot doesn't support {op}")
+        return SnapshotCursor(self, selection, None, list_join_fields)
+
+    # documents for rows, shaped like the Mongo ones. fields limits them to some top-level fields
+    def documents(self, rows, fields=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        docs = [{} for _ in rows]
+        for field, kind in self.schema.items():
+            keys = field.split(".")
+            if fields != None and not keys[0] in fields:
+                continue
+            if kind == "ints":
+                offsets = self.column(field + ".offsets")
+                list_values = self.column(field + ".values")
+                for doc, start, end in zip(
+                    docs, offsets[rows].tolist(), offsets[rows + 1].tolist()
+                ):
+                    set_path(
+                        doc,
+                        keys,
+                        [
+                            None if value == null_int else value
+                            for value in list_values[start:end].tolist()
+                        ],
+                    )
+                continue
+            values = self.column(field)[rows].tolist()
+            if kind == "int":
+                values = [None if value == null_int else value for value in values]
+            elif kind == "number":
+                values = [None if value != value else value for value in values]
+            elif kind == "bool":
+                values = [None if value == -1 else bool(value) for value in values]
+            elif kind == "string":
+                vocab = self.vocabularies[field]
+                values = [None if value == -1 else vocab[value] for value in values]
+            for doc, value in zip(docs, values):
+                set_path(doc, keys, value)
+        if self.name == "maps" and (
+            fields == None or any(key in fields for key in stats_teams)
+        ):
+            self.add_player_stats(docs, rows)
+        return docs
+
+    # stats rows are laid out map by map, teamOneStats then teamTwoStats
+    def add_player_stats(self, docs, rows):
+        offsets = self.column("stats.offsets")
+        starts = offsets[rows * 2].tolist()
+        splits = offsets[rows * 2 + 1].tolist()
+        ends = offsets[rows * 2 + 2].tolist()
+        stat_rows = np.concatenate(
+            [np.arange(start, end) for start, end in zip(starts, ends)] + [[]]
+        ).astype(np.int64)
+        player_ids = self.column("stats.playerId")[stat_rows].tolist()
+        stat_values = [
+            (
+                field.split("."),
+                [
+                    None if value != value else value
+                    for value in self.column("stats." + field)[stat_rows].tolist()
+                ],
+            )
+            for field in player_stat_fields
+        ]
+        i = 0
+        for r, doc in enumerate(docs):
+            team_bounds = [starts[r], splits[r], ends[r]]
+            for t, team_stats_key in enumerate(stats_teams):
+                team_stats = {}
+                for _ in range(team_bounds[t + 1] - team_bounds[t]):
+                    player_stats = {}
+                    for keys, values in stat_values:
+                        set_path(player_stats, keys, values[i])
+                    team_stats[str(player_ids[i])] = player_stats
+                    i += 1
+                doc[team_stats_key] = team_stats
+
+
+# stand-in for pymongo cursors: rows are selected up front, documents are built lazily in batches
+class SnapshotCursor:
+    batch_size = 1024
+
+    def __init__(self, collection, selection, fields, list_join_fields={}):
+        self.collection = collection
+        self.selection = selection
+        self.fields = fields
+        # alias -> local field of the $lookup stages joining on an array
+        self.list_join_fields = list_join_fields
+
+    def sort(self, key, direction=1):
+        sort_keys = key if isinstance(key, list) else [(key, direction)]
+        self.collection.sort_selection(self.selection, sort_keys)
+        return self
+
+    def skip(self, num):
+        self.selection.take(slice(int(num), None))
+        return self
+
+    def limit(self, num):
+        if num:
+            self.selection.take(slice(0, int(num)))
+        return self
+
+    def next(self):
+        return next(iter(self))
+
+    def __iter__(self):
+        rows = self.selection.rows
+        for start in range(0, len(rows), self.batch_size):
+            batch = slice(start, start + self.batch_size)
+            docs = self.collection.documents(rows[batch], self.fields)
+            for alias, (foreign, join_rows) in self.selection.joins.items():
+                if join_rows is None:
+                    self.add_list_join(docs, alias, foreign)
+                    continue
+                batch_join_rows = join_rows[batch]
+                present = batch_join_rows >= 0
+                foreign_docs = iter(foreign.documents(batch_join_rows[present]))
+                for doc, is_present in zip(docs, present):
+                    doc[alias] = [next(foreign_docs)] if is_present else []
+            yield from docs
+
+    # joined in the foreign collection's order with duplicates dropped, the way $lookup on an array does
+    def add_list_join(self, docs, alias, foreign):
+        local_field = self.list_join_fields[alias]
+        for doc in docs:
+            hltv_ids = [
+                value for value in get_path(doc, local_field) or [] if value != None
+            ]
+            join_rows = np.unique(foreign.rows_by_hltv_id(hltv_ids))
+            doc[alias] = foreign.documents(join_rows[join_rows >= 0])
+
+
+# an exported snapshot, indexed like a pymongo database
+class Snapshot:
+    def __init__(self, folder=default_snapshot_folder):
+        self.folder = folder
+        with open(os.path.join(folder, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if not name in self.collections:
+            self.collections[name] = SnapshotCollection(self, name)
+        return self.collections[name]
+
+
+if __name__ == "__main__":
+    import pymongo
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(
+        description="Exports the scraped-hltv collections processing reads into memory-mapped column files"
+    )
+    parser.add_argument("--folder", default=default_snapshot_folder)
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = pymongo.MongoClient(os.environ["MONGODB_URI"])
+    export_snapshot(client["scraped-hltv"], args.folder)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+# always-on stage timers and counters for the processing loops. every thread records into its own stats,
+#  so recording never takes a lock; reports merge them. worker processes hand theirs back with their results
+
+
+class StageStats:
+    def __init__(self):
+        # stage -> [count, total seconds, max seconds]
+        self.timings = {}
+        self.counters = {}
+
+    def add_time(self, name, seconds):
+        timing = self.timings.get(name)
+        if timing == None:
+            self.timings[name] = [1, seconds, seconds]
+            return
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+    def count(self, name, num=1):
+        self.counters[name] = self.counters.get(name, 0) + num
+
+    def merge(self, stats_dict):
+        for name, (count, total, max_seconds) in stats_dict["timings"].items():
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += count
+            timing[1] += total
+            timing[2] = max(timing[2], max_seconds)
+        for name, num in stats_dict["counters"].items():
+            self.count(name, num)
+
+    def to_dict(self):
+        return {
+            "timings": {
+                name: list(timing) for name, timing in dict(self.timings).items()
+            },
+            "counters": dict(self.counters),
+        }
+
+
+def report_stats(stats_dict):
+    return {
+        "timings": {
+            name: {
+                "count": count,
+                "total_s": round(total, 6),
+                "mean_ms": round(total / count * 1000, 4),
+                "max_ms": round(max_seconds * 1000, 4),
+            }
+            for name, (count, total, max_seconds) in sorted(
+                stats_dict["timings"].items()
+            )
+        },
+        "counters": dict(sorted(stats_dict["counters"].items())),
+    }
+
+
+class Stage:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+
+
+class StageTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # worker name -> StageStats, for this process's threads and any worker processes merged in
+        self.workers = {}
+        self.start_time = time.perf_counter()
+
+    # the calling thread's stats
+    def stats(self):
+        stats = getattr(self.local, "stats", None)
+        if stats == None:
+            stats = self.local.stats = StageStats()
+            with self.lock:
+                self.workers[f"{os.getpid()}-{threading.current_thread().name}"] = stats
+        return stats
+
+    def stage(self, name):
+        return Stage(self.stats(), name)
+
+    def add_time(self, name, seconds):
+        self.stats().add_time(name, seconds)
+
+    def count(self, name, num=1):
+        self.stats().count(name, num)
+
+    # yields from iterable, timing how long each item takes to arrive
+    def timed(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    # in a worker process: everything this process recorded since the last call, then starts over
+    def take(self):
+        with self.lock:
+            merged = StageStats()
+            for stats in self.workers.values():
+                merged.merge(stats.to_dict())
+            self.workers = {}
+            self.local = threading.local()
+        return merged.to_dict()
+
+    # forgets everything recorded so far. a forked worker process starts with a copy of its parent's stats,
+    #  which are the parent's to report
+    def reset(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.workers = {}
+
+    def merge_worker(self, worker_name, stats_dict):
+        with self.lock:
+            self.workers.setdefault(worker_name, StageStats()).merge(stats_dict)
+
+    def report(self):
+        with self.lock:
+            workers = {name: stats.to_dict() for name, stats in self.workers.items()}
+        total = StageStats()
+        for stats_dict in workers.values():
+            total.merge(stats_dict)
+        return {
+            "time": datetime.now().isoformat(),
+            "elapsed_s": round(time.perf_counter() - self.start_time, 3),
+            "total": report_stats(total.to_dict()),
+            "workers": {
+                name: report_stats(stats_dict)
+                for name, stats_dict in sorted(workers.items())
+            },
+        }
+
+    # appends one JSON line per report
+    def dump(self, file_path):
+        report = self.report()
+        with open(file_path, "a") as f:
+            f.write(json.dumps(report) + "\n")
+        return report
+
+    def start_periodic_dump(self, file_path, interval):
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                self.dump(file_path)
+
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+
+stage_timer = StageTimer()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the processing modules import each other flat, the way they do when run from betting_module/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
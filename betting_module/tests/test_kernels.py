@@ -0,0 +1,116 @@
+import io
+import os
+import contextlib
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_data import generate_collections, in_memory_db
+
+# the list-based, vectorized and sliding window kernels give the same data points on a small synthetic
+#  snapshot, including over the malformed performances whose error behaviors are kept on purpose (see the
+#  list above generate_round_rating_stats in processing_helper)
+
+num_maps = 600
+num_teams = 20
+num_targets = 150
+
+
+# breaks a few of the store's performances shortly before the targets, in their history windows, the ways
+#  real documents are broken. the snapshot keeps stats in fixed columns, so they're broken after loading
+def break_performances(performances):
+    first_id = 100000 + num_maps - num_targets - 60
+    history = [
+        performance
+        for performance in performances
+        if first_id <= performance["hltvId"] < first_id + 60
+    ]
+    step = len(history) // 6
+    # (d) a None stat value
+    player_stats = next(iter(history[step]["teamOneStats"].values()))
+    player_stats["tStats"]["kast"] = None
+    # (b) stats that raise partway through a player
+    player_stats = next(iter(history[2 * step]["teamTwoStats"].values()))
+    del player_stats["tStats"]
+    # (a) a winrate over zero rounds
+    history[3 * step]["score"]["teamOne"]["t"] = 0
+    history[3 * step]["score"]["teamTwo"]["ct"] = 0
+    # (a) a side's stats that can't be read
+    del history[4 * step]["teamTwoStats"]
+    # stats that don't match the players, which only the store's pack columns check
+    history[5 * step]["players"] = history[5 * step]["players"][:-1]
+
+
+@pytest.fixture(scope="module")
+def snapshot_store(tmp_path_factory):
+    from snapshot import export_snapshot
+
+    folder = str(tmp_path_factory.mktemp("snapshot"))
+    collections = generate_collections(num_maps, num_teams, 0)
+    with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        export_snapshot(in_memory_db(collections), folder)
+    os.environ["DATA_BACKEND"] = "snapshot"
+    os.environ["SNAPSHOT_FOLDER"] = folder + "/"
+
+    import processing_helper
+    from performance_store import PerformanceStore
+
+    with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        performance_store = PerformanceStore.load()
+    break_performances(performance_store.performances)
+    targets = list(
+        processing_helper.maps.aggregate(
+            [{"$sort": {"hltvId": -1}}, {"$limit": num_targets}]
+            + processing_helper.slice_lookup_aggregation
+        )
+    )
+    targets = [target for target in targets if len(target["match"]) != 0]
+    targets.sort(key=lambda target: (target["match"][0]["date"], target["hltvId"]))
+    return performance_store, targets
+
+
+def data_points(targets, **kwargs):
+    import processing_helper
+
+    points = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for target in targets:
+            np.random.seed(target["hltvId"])
+            w = processing_helper.generate_data_point(target, **kwargs)
+            points.append(None if w == None else {k: float(w[k]) for k in w.keys()})
+    return points
+
+
+# the kernels sum in different orders, so values only agree up to rounding
+def same_point(a, b):
+    if a == None or b == None:
+        return a == b
+    return a.keys() == b.keys() and all(
+        np.isclose(a[k], b[k], rtol=1e-9, atol=1e-12, equal_nan=True) for k in a
+    )
+
+
+def test_kernels_match(snapshot_store, monkeypatch):
+    import processing_helper
+    from sliding_window import SlidingWindowFeatureBuilder
+
+    performance_store, targets = snapshot_store
+    monkeypatch.setattr(processing_helper, "use_vectorized_stats", False)
+    list_points = data_points(targets, performance_store=performance_store)
+    monkeypatch.setattr(processing_helper, "use_vectorized_stats", True)
+    vectorized_points = data_points(targets, performance_store=performance_store)
+    # the window only moves forward, so the targets are walked once in date order
+    window_points = data_points(
+        targets, window_builder=SlidingWindowFeatureBuilder(performance_store)
+    )
+
+    assert len(targets) > num_targets // 2
+    assert sum(w != None for w in list_points) > len(targets) // 2
+    for target, list_point, vectorized_point, window_point in zip(
+        targets, list_points, vectorized_points, window_points
+    ):
+        assert same_point(list_point, vectorized_point), target["hltvId"]
+        assert same_point(list_point, window_point), target["hltvId"]